@@ -2,7 +2,9 @@ import logging
 
 from cloud_snitch import settings
 from neo4j.v1 import GraphDatabase
+from cloud_snitch import digests
 from cloud_snitch import models
+from cloud_snitch import snapshot
 
 logger = logging.getLogger(__name__)
 
@@ -41,6 +43,9 @@ def main():
                     label=_model.label,
                     prop=_model.identity_property)
                 )
+            for statement in snapshot.SCHEMA + digests.SCHEMA:
+                tx.run(statement)
+            tx.run('CREATE INDEX ON :Timeline(identity)')
     driver.close()
 
 
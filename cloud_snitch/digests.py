@@ -0,0 +1,74 @@
+"""Digests of collected payloads that have been ingested.
+
+The collector replaces a payload identical to the previous run with an
+unchanged marker carrying the digest of that payload. Markers can only
+be trusted if the payload they refer to reached the graph, so the
+digest of every ingested payload is recorded per environment and file.
+
+    (d:IngestedDigest {key, digest, time})
+
+Digest nodes are not attached to environments so that walks over the
+versioned graph do not see them.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = [
+    'CREATE CONSTRAINT ON (d:IngestedDigest) ASSERT d.key IS UNIQUE'
+]
+
+_GET_QUERY = """
+    MATCH (d:IngestedDigest {key: $key})
+    RETURN d.digest AS digest
+"""
+
+_SET_QUERY = """
+    MERGE (d:IngestedDigest {key: $key})
+    SET d.digest = $digest, d.time = $time
+"""
+
+
+def digest_key(environment, filename):
+    """Compute the key of the payloads of one collected file.
+
+    :param environment: Environment identity
+    :type environment: str
+    :param filename: Name of the file without directories, such as
+        dpkg_list_<host>.json
+    :type filename: str
+    :returns: Key of the digest
+    :rtype: str
+    """
+    return '{}:{}'.format(environment, filename)
+
+
+def ingested(session, key):
+    """Get the digest of the last ingested payload.
+
+    :param session: neo4j driver session
+    :type session: neo4j.v1.session.BoltSession
+    :param key: Key from digest_key()
+    :type key: str
+    :returns: Digest or None if nothing was recorded
+    :rtype: str|None
+    """
+    record = session.run(_GET_QUERY, key=key).single()
+    if record is None:
+        return None
+    return record['digest']
+
+
+def record(session, key, digest, time_in_ms):
+    """Record the digest of an ingested payload.
+
+    :param session: neo4j driver session
+    :type session: neo4j.v1.session.BoltSession
+    :param key: Key from digest_key()
+    :type key: str
+    :param digest: Digest of the payload
+    :type digest: str
+    :param time_in_ms: Time of the run in milliseconds
+    :type time_in_ms: int
+    """
+    session.run(_SET_QUERY, key=key, digest=digest, time=time_in_ms)
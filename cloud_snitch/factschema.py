@@ -0,0 +1,169 @@
+"""Schema of the ansible facts consumed by cloud snitch.
+
+The host snitcher reads host properties from ansible facts using the
+key maps below. The fact_snitch collector uses the same maps to project
+the full facts dict down to only the consumed paths before writing.
+
+This module must remain free of third party imports and compatible with
+python 2 since it is also loaded by the ansible action plugins.
+"""
+
+# Ansible key -> host kwarg map
+EASY_KEY_MAP = {
+    'ansible_architecture': 'arcitecture',
+    'ansible_bios_date': 'bios_date',
+    'ansible_bios_version': 'bios_version',
+    'ansible_kernel': 'kernel',
+    'ansible_memtotal_mb': 'memtotal_mb',
+    'ansible_fqdn': 'fqdn',
+    'ansible_pkg_mgr': 'pkg_mgr',
+    'ansible_processor_cores': 'processor_cores',
+    'ansible_processor_count': 'processor_count',
+    'ansible_processor_threads_per_core': 'processors_threads_per_core',
+    'ansible_processor_vcpus': 'processor_vcpus',
+    'ansible_python_version': 'python_version',
+    'ansible_service_mgr': 'service_mgr',
+    'ansible_selinux': 'selinux',
+}
+
+COMPLEX_KEY_MAP = {
+    'ansible_default_ipv4:address': 'default_ipv4_address',
+    'ansible_default_ipv6:address': 'default_ipv6_address',
+    'ansible_lsb:codename': 'lsb_codename',
+    'ansible_lsb:description': 'lsb_description',
+    'ansible_lsb:id': 'lsb_id',
+    'ansible_lsb:major_release': 'lsb_major_release',
+    'ansible_lsb:release': 'lsb_release',
+    'ansible_python:executable': 'python_executable',
+    'ansible_python:type': 'python_type',
+    'ansible_version:full': 'ansible_version_full'
+}
+
+MOUNT_KEY_MAP = {
+    'mount': 'mount',
+    'fstype': 'fstype',
+    'size_total': 'size_total',
+    'device': 'device'
+}
+
+DEVICE_KEY_MAP = {
+    'removable': 'removable',
+    'rotational': 'rotational',
+    'size': 'size'
+}
+
+PARTITION_KEY_MAP = {
+    'size': 'size',
+    'start': 'start'
+}
+
+INTERFACE_KEY_MAP = {
+    'ansible_{}:active': 'active',
+    'ansible_{}:macaddress': 'macaddress',
+    'ansible_{}:mtu': 'mtu',
+    'ansible_{}:promisc': 'promisc',
+    'ansible_{}:device': 'device',
+    'ansible_{}:ipv4:address': 'ipv4_address',
+    'ansible_{}:ipv6:address': 'ipv6_address'
+}
+
+NAMESERVERS_KEY = 'ansible_dns:nameservers'
+INTERFACES_KEY = 'ansible_interfaces'
+INTERFACE_KEY = 'ansible_{}'
+MOUNTS_KEY = 'ansible_mounts'
+DEVICES_KEY = 'ansible_devices'
+PARTITIONS_KEY = 'partitions'
+
+
+def _copy_path(complexkey, src, dest, keydelimiter=':'):
+    """Copy the value at a complex key from src into dest.
+
+    Intermediate dicts are created in dest as needed. Nothing is copied
+    if the path does not exist in src.
+
+    :param complexkey: Complex key describing a path through nested dicts
+    :type complexkey: str
+    :param src: Dict to copy from
+    :type src: dict
+    :param dest: Dict to copy into
+    :type dest: dict
+    :param keydelimiter: Delimiter to indicate a path
+    :type keydelimiter: str
+    """
+    keys = complexkey.split(keydelimiter)
+    for key in keys[:-1]:
+        if not isinstance(src, dict) or key not in src:
+            return
+        src = src[key]
+        if not isinstance(src, dict):
+            return
+        dest = dest.setdefault(key, {})
+    if isinstance(src, dict) and keys[-1] in src:
+        dest[keys[-1]] = src[keys[-1]]
+
+
+def _project_dict(d, keymap):
+    """Keep only keys of d that appear in keymap.
+
+    :param d: Dict to project
+    :type d: dict
+    :param keymap: Key map whose keys are kept
+    :type keymap: dict
+    :returns: Projected dict
+    :rtype: dict
+    """
+    return {k: v for k, v in d.items() if k in keymap}
+
+
+def project(facts):
+    """Project a full ansible facts dict down to the consumed paths.
+
+    :param facts: Ansible facts keyed by fact name
+    :type facts: dict
+    :returns: Facts containing only the paths read by the host snitcher
+    :rtype: dict
+    """
+    projected = {}
+
+    for key in EASY_KEY_MAP:
+        if key in facts:
+            projected[key] = facts[key]
+
+    for complexkey in COMPLEX_KEY_MAP:
+        _copy_path(complexkey, facts, projected)
+
+    _copy_path(NAMESERVERS_KEY, facts, projected)
+
+    # Interfaces are listed by name and described by ansible_<name>
+    names = facts.get(INTERFACES_KEY)
+    if names is not None:
+        projected[INTERFACES_KEY] = names
+        for name in names:
+            interface_key = INTERFACE_KEY.format(name)
+            if facts.get(interface_key) is None:
+                continue
+            projected[interface_key] = {}
+            for complexkey in INTERFACE_KEY_MAP:
+                _copy_path(complexkey.format(name), facts, projected)
+
+    mounts = facts.get(MOUNTS_KEY)
+    if mounts is not None:
+        projected[MOUNTS_KEY] = [
+            _project_dict(m, MOUNT_KEY_MAP) for m in mounts
+        ]
+
+    devices = facts.get(DEVICES_KEY)
+    if devices is not None:
+        projected_devices = {}
+        for name, devicedict in devices.items():
+            projected_device = _project_dict(devicedict, DEVICE_KEY_MAP)
+            partitions = devicedict.get(PARTITIONS_KEY)
+            if partitions is not None:
+                projected_device[PARTITIONS_KEY] = {
+                    pname: _project_dict(pdict, PARTITION_KEY_MAP)
+                    for pname, pdict in partitions.items()
+                }
+            projected_devices[name] = projected_device
+        projected[DEVICES_KEY] = projected_devices
+
+    return projected
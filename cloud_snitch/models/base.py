@@ -2,6 +2,7 @@ import json
 import logging
 import pprint
 from cloud_snitch import utils
+from cloud_snitch import writeset
 from cloud_snitch.decorators import transient_retry
 from cloud_snitch.exc import PropertyAlreadyExistsError
 
@@ -77,6 +78,10 @@ class VersionedEdgeSet(object):
         old_edges = current_edges - new_edges
         logger.debug("Old edges: {}".format(old_edges))
 
+        add_edges = new_edges - current_edges
+        if old_edges or add_edges:
+            writeset.record(self.dest_type.label)
+
         for old_identity in old_edges:
             cypher = """
                 MATCH (s:{} {{ {}:$srcIdentity}})
@@ -105,7 +110,6 @@ class VersionedEdgeSet(object):
             )
 
         # Merge in new edges
-        add_edges = new_edges - current_edges
         for add_identity in add_edges:
             cypher = """
                 MATCH (s:{} {{ {}:$srcIdentity }})
@@ -357,6 +361,7 @@ class VersionedEntity(object):
 
         if dirty:
             logger.debug("Data is dirty, making a new state.")
+            writeset.record(self.label)
 
             # Mark current state as old
             cypher = """
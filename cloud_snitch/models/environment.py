@@ -7,6 +7,18 @@ from .uservar import UservarEntity
 
 logger = logging.getLogger(__name__)
 
+# Timelines are kept apart from the versioned graph so walks over the
+# graph do not see them.
+TIMELINE_QUERY = """
+    MATCH (t:Timeline {label: $label, identity: $identity})
+    RETURN t.times AS times
+"""
+
+TIMELINE_UPDATE = """
+    MERGE (t:Timeline {label: $label, identity: $identity})
+    SET t.times = $times, t.version = coalesce(t.version, 0) + 1
+"""
+
 
 class EnvironmentEntity(VersionedEntity):
     """Model environment nodes in the graph."""
@@ -61,6 +73,48 @@ class EnvironmentEntity(VersionedEntity):
         result = tx.run(cypher, identity=self.identity)
         return [r['t'] for r in result]
 
+    def _timeline(self, tx):
+        """Read the stored timeline of the environment.
+
+        :param tx: neo4j transaction context.
+        :type tx: neo4j.v1.api.Transaction
+        :returns: Timestamps newest first or None if there is no timeline
+        :rtype: list|None
+        """
+        result = tx.run(
+            TIMELINE_QUERY,
+            label=self.label,
+            identity=self.identity
+        )
+        record = result.single()
+        if record is None or record['times'] is None:
+            return None
+        return list(record['times'])
+
+    def record_update(self, session, time_in_ms):
+        """Add a time to the timeline of the environment.
+
+        Environments without a timeline are seeded by walking the graph.
+        The data version of the environment is incremented so that
+        cached results of the web api keyed on it are no longer used.
+
+        :param session: neo4j driver session
+        :type session: neo4j.v1.session.BoltSession
+        :param time_in_ms: Time of the update in milliseconds
+        :type time_in_ms: int
+        """
+        with session.begin_transaction() as tx:
+            times = self._timeline(tx)
+            if times is None:
+                times = [t for t in self._times_updated(tx) if t is not None]
+            times = sorted(set(times) | set([time_in_ms]), reverse=True)
+            tx.run(
+                TIMELINE_UPDATE,
+                label=self.label,
+                identity=self.identity,
+                times=times
+            )
+
     def times_updated(self, session):
         """Query for list of times an environment was updated.
 
@@ -70,6 +124,9 @@ class EnvironmentEntity(VersionedEntity):
         :rtype: list
         """
         with session.begin_transaction() as tx:
+            times = self._timeline(tx)
+            if times is not None:
+                return times
             return self._times_updated(tx)
 
     def last_update(self, session):
@@ -81,6 +138,10 @@ class EnvironmentEntity(VersionedEntity):
         :rtype: int
         """
         with session.begin_transaction() as tx:
+            times = self._timeline(tx)
+            if times is not None:
+                return times[0] if times else None
+
             cypher = self._times_query()
             cypher += ' LIMIT 1'
             result = tx.run(cypher, identity=self.identity)
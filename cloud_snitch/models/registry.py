@@ -125,11 +125,13 @@ class Registry:
     def __init__(self):
         """Init the registry."""
         self.models = {}
+        self._lists = {}
         self.load_models()
         self.forest = Forest(self.models)
 
     def load_models(self):
         """Load installed models from entry points."""
+        self._lists = {}
         for ep in iter_entry_points(group='cloud_snitch_models'):
             try:
                 self.models[ep.name] = ep.load()
@@ -138,6 +140,24 @@ class Registry:
                     'Unable to load cloud snitch model {}'.format(ep.name)
                 )
 
+    def _cached_list(self, key, build):
+        """Get a copy of a list computed once per key.
+
+        Models do not change once loaded so derived lists are computed
+        once and copied out so callers may modify them.
+
+        :param key: Cache key
+        :type key: tuple
+        :param build: Callable returning the list or None
+        :type build: callable
+        :returns: Copy of the list or None
+        :rtype: list|None
+        """
+        if key not in self._lists:
+            self._lists[key] = build()
+        value = self._lists[key]
+        return None if value is None else list(value)
+
     def identity_property(self, model):
         """Return the identity property of a targeted model.
 
@@ -159,10 +179,12 @@ class Registry:
         :returns: List of state properties or None
         :rtype: list|None
         """
-        klass = self.models.get(model)
-        if klass is None:
-            return None
-        return sorted(klass.state_properties)
+        def build():
+            klass = self.models.get(model)
+            if klass is None:
+                return None
+            return sorted(klass.state_properties)
+        return self._cached_list(('state_properties', model), build)
 
     def static_properties(self, model):
         """Return the static properties of a model
@@ -172,10 +194,12 @@ class Registry:
         :returns: List of static properties or None
         :rtype: list|None
         """
-        klass = self.models.get(model)
-        if klass is None:
-            return None
-        return sorted(klass.static_properties)
+        def build():
+            klass = self.models.get(model)
+            if klass is None:
+                return None
+            return sorted(klass.static_properties)
+        return self._cached_list(('static_properties', model), build)
 
     def children(self, model):
         """Return the children of a model
@@ -236,23 +260,25 @@ class Registry:
         :returns: List of properties.
         :rtype: list
         """
-        prop_set = set()
+        def build():
+            prop_set = set()
 
-        if model is None:
-            models = self.models.keys()
-        else:
-            models = [model]
+            if model is None:
+                models = self.models.keys()
+            else:
+                models = [model]
 
-        for model in models:
-            klass = self.models.get(model)
-            if klass is not None:
-                prop_set.add(klass.identity_property)
-                for prop in klass.static_properties:
-                    prop_set.add(prop)
-                for prop in klass.state_properties:
-                    prop_set.add(prop)
+            for name in models:
+                klass = self.models.get(name)
+                if klass is not None:
+                    prop_set.add(klass.identity_property)
+                    for prop in klass.static_properties:
+                        prop_set.add(prop)
+                    for prop in klass.state_properties:
+                        prop_set.add(prop)
 
-        return sorted(list(prop_set))
+            return sorted(list(prop_set))
+        return self._cached_list(('properties', model), build)
 
     def path(self, label):
         """Get path of a label within forest.
@@ -262,4 +288,7 @@ class Registry:
         :returns: List of (label, relationship name) tuples
         :rtype: list|None
         """
-        return self.forest.path(label)
+        return self._cached_list(
+            ('path', label),
+            lambda: self.forest.path(label)
+        )
@@ -0,0 +1,349 @@
+"""Materialised snapshots of the current view of each environment.
+
+After each sync the current rows of every label beneath an environment
+are flattened and stored on a snapshot so that searches at the present
+time can read precomputed rows instead of walking versioned paths.
+
+    (s:Snapshot {environment, time, until})-[:HAS_ROW]->(row:SnapshotRow)
+
+A snapshot is valid for times in [time, until). Rows hold a property for
+each label in the path of row.label named 'Label.prop' along with a key
+made from the identities along the path and a hash of the properties.
+Snapshots are not attached to environments so that walks over the
+versioned graph do not see them.
+"""
+import hashlib
+import json
+import logging
+import time
+
+from cloud_snitch import utils
+from cloud_snitch.driver import DriverContext
+from cloud_snitch.models import EnvironmentEntity
+from cloud_snitch.models import registry
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = [
+    'CREATE CONSTRAINT ON (s:Snapshot) ASSERT s.environment IS UNIQUE',
+    'CREATE INDEX ON :SnapshotRow(label)'
+]
+
+_SNAPSHOT_QUERY = """
+    MATCH (s:Snapshot {environment: $environment})
+    RETURN s.until AS until
+"""
+
+_CREATE_QUERY = """
+    CREATE (s:Snapshot {environment: $environment, time: $time})
+    SET s.until = $eot
+"""
+
+_CLOSE_QUERY = """
+    MATCH (s:Snapshot {environment: $environment})
+    WHERE s.until = $eot
+    SET s.until = $time
+"""
+
+_OPEN_QUERY = """
+    MATCH (s:Snapshot {environment: $environment})
+    SET s.time = CASE WHEN $changed THEN $time ELSE s.time END,
+        s.until = $eot
+"""
+
+_HASHES_QUERY = """
+    MATCH (s:Snapshot {environment: $environment})-[:HAS_ROW]->
+        (row:SnapshotRow {label: $label})
+    RETURN row.key AS key, row.hash AS hash
+"""
+
+_DELETE_QUERY = """
+    MATCH (s:Snapshot {environment: $environment})-[:HAS_ROW]->
+        (row:SnapshotRow {label: $label})
+    WHERE row.key IN $keys
+    DETACH DELETE row
+"""
+
+_INSERT_QUERY = """
+    MATCH (s:Snapshot {environment: $environment})
+    UNWIND $rows AS r
+    CREATE (s)-[:HAS_ROW]->(row:SnapshotRow)
+    SET row = r
+"""
+
+
+def environment_identity(run):
+    """Get the identity of the environment of a run.
+
+    :param run: Date run instance
+    :type run: cloud_snitch.runs.Run
+    :returns: Environment identity
+    :rtype: str
+    """
+    return '-'.join([
+        run.environment_account_number,
+        run.environment_name
+    ])
+
+
+def snapshot_labels():
+    """Get labels of all models beneath the environment.
+
+    :returns: Set of labels including the environment label
+    :rtype: set
+    """
+    return descendants([EnvironmentEntity.label])
+
+
+def descendants(labels):
+    """Get labels and all labels beneath them in the model forest.
+
+    :param labels: Iterable of labels
+    :type labels: iterable
+    :returns: Set of labels
+    :rtype: set
+    """
+    found = set()
+    stack = [
+        registry.forest.nodes[label] for label in labels
+        if label in registry.forest.nodes
+    ]
+    while stack:
+        node = stack.pop()
+        if node.label in found:
+            continue
+        found.add(node.label)
+        stack.extend(node.children.values())
+    return found
+
+
+def _path_labels(label):
+    """Get labels along the path to a label, ending with the label.
+
+    :param label: Model label
+    :type label: str
+    :returns: List of labels
+    :rtype: list
+    """
+    return [p for p, _ in registry.path(label) or []] + [label]
+
+
+def _rows_query(label):
+    """Create the query for current rows of a label in an environment.
+
+    :param label: Model label
+    :type label: str
+    :returns: Cypher query with $environment and $eot parameters
+    :rtype: str
+    """
+    labels = _path_labels(label)
+    root = labels[0]
+    path = []
+    for i, (_, relname) in enumerate(registry.path(label) or []):
+        path.append('({}:{})'.format(labels[i].lower(), labels[i]))
+        path.append('-[:{} {{to: $eot}}]->'.format(relname))
+    if path:
+        path[0] = '({}:{} {{{}: $environment}})'.format(
+            root.lower(),
+            root,
+            registry.identity_property(root)
+        )
+        path.append('({}:{})'.format(label.lower(), label))
+    else:
+        path.append('({}:{} {{{}: $environment}})'.format(
+            label.lower(),
+            label,
+            registry.identity_property(label)
+        ))
+
+    cypher = 'MATCH ' + ''.join(path)
+    state_template = ' \nMATCH ({})-[:HAS_STATE {{to: $eot}}]->({}:{})'
+    returns = []
+    for path_label in labels:
+        var = path_label.lower()
+        returns.append(var)
+        if registry.state_properties(path_label):
+            cypher += state_template.format(
+                var,
+                '{}_state'.format(var),
+                registry.models[path_label].state_label
+            )
+            returns.append('{}_state'.format(var))
+    cypher += ' \nRETURN ' + ', '.join(returns)
+    return cypher
+
+
+def _flatten(label, record):
+    """Flatten a record of the rows query into a snapshot row.
+
+    :param label: Model label
+    :type label: str
+    :param record: Record from the rows query
+    :type record: neo4j.Record
+    :returns: Snapshot row properties
+    :rtype: dict
+    """
+    props = {}
+    keys = []
+    for path_label in _path_labels(label):
+        var = path_label.lower()
+        node = record[var]
+        keys.append(node[registry.identity_property(path_label)])
+        values = dict(node.items())
+        if registry.state_properties(path_label):
+            values.update(record['{}_state'.format(var)].items())
+        for prop, value in values.items():
+            props['{}.{}'.format(path_label, prop)] = value
+
+    digest = hashlib.md5(
+        json.dumps(props, sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()
+    props['label'] = label
+    props['key'] = json.dumps(keys)
+    props['hash'] = digest
+    return props
+
+
+def _rebuild_label(tx, identity, label):
+    """Bring the snapshot rows of one label up to date.
+
+    Rows are compared by hash so only changed rows are rewritten.
+
+    :param tx: neo4j transaction context
+    :type tx: neo4j.v1.api.Transaction
+    :param identity: Environment identity
+    :type identity: str
+    :param label: Model label
+    :type label: str
+    :returns: Whether any rows were written or deleted
+    :rtype: bool
+    """
+    current = {}
+    for record in tx.run(_rows_query(label), environment=identity,
+                         eot=utils.EOT):
+        row = _flatten(label, record)
+        current[row['key']] = row
+
+    existing = {}
+    for record in tx.run(_HASHES_QUERY, environment=identity, label=label):
+        existing[record['key']] = record['hash']
+
+    stale = [
+        key for key, digest in existing.items()
+        if key not in current or current[key]['hash'] != digest
+    ]
+    fresh = [
+        row for key, row in current.items()
+        if existing.get(key) != row['hash']
+    ]
+    logger.debug("Snapshot {} {}: {} stale, {} fresh rows".format(
+        identity, label, len(stale), len(fresh)
+    ))
+    if stale:
+        tx.run(_DELETE_QUERY, environment=identity, label=label, keys=stale)
+    if fresh:
+        tx.run(_INSERT_QUERY, environment=identity, rows=fresh)
+    return bool(stale or fresh)
+
+
+def close(driver, identity, time_in_ms):
+    """Stop a snapshot from answering for times from time_in_ms on.
+
+    Called before syncing a run so that searches fall back to the
+    versioned graph until the snapshot is rebuilt.
+
+    :param driver: Neo4J database driver instance
+    :type driver: neo4j.v1.GraphDatabase.driver
+    :param identity: Environment identity
+    :type identity: str
+    :param time_in_ms: Time of the run in milliseconds
+    :type time_in_ms: int
+    """
+    with driver.session() as session:
+        with session.begin_transaction() as tx:
+            tx.run(
+                _CLOSE_QUERY,
+                environment=identity,
+                time=time_in_ms,
+                eot=utils.EOT
+            )
+
+
+def rebuild(driver, identity, time_in_ms, labels=None):
+    """Rebuild the snapshot of an environment as of time_in_ms.
+
+    Only rows of the given labels and the labels beneath them are
+    rebuilt. Every label is rebuilt when labels is None or when the
+    snapshot is missing or was not closed by the run at time_in_ms.
+
+    :param driver: Neo4J database driver instance
+    :type driver: neo4j.v1.GraphDatabase.driver
+    :param identity: Environment identity
+    :type identity: str
+    :param time_in_ms: Time of the last change in milliseconds
+    :type time_in_ms: int
+    :param labels: Labels changed since the last rebuild
+    :type labels: iterable|None
+    """
+    with driver.session() as session:
+        with session.begin_transaction() as tx:
+            record = tx.run(_SNAPSHOT_QUERY, environment=identity).single()
+            if record is None:
+                tx.run(
+                    _CREATE_QUERY,
+                    environment=identity,
+                    time=time_in_ms,
+                    eot=utils.EOT
+                )
+                labels = None
+            elif record['until'] != time_in_ms:
+                labels = None
+
+            if labels is None:
+                affected = snapshot_labels()
+            else:
+                affected = descendants(labels) & snapshot_labels()
+
+            changed = labels is None
+            for label in sorted(affected):
+                changed = _rebuild_label(tx, identity, label) or changed
+
+            tx.run(
+                _OPEN_QUERY,
+                environment=identity,
+                time=time_in_ms,
+                changed=changed,
+                eot=utils.EOT
+            )
+    logger.info("Rebuilt snapshot of {} for {} labels".format(
+        identity, len(affected)
+    ))
+
+
+def main():
+    start = time.time()
+    with DriverContext() as driver:
+        with driver.session() as session:
+            cypher = 'MATCH (e:{}) RETURN e.{} AS identity'.format(
+                EnvironmentEntity.label,
+                EnvironmentEntity.identity_property
+            )
+            identities = [r['identity'] for r in session.run(cypher)]
+
+        for identity in identities:
+            with driver.session() as session:
+                env = EnvironmentEntity.find(session, identity)
+                last_update = env.last_update(session)
+            if last_update is None:
+                continue
+            try:
+                rebuild(driver, identity, last_update)
+            except Exception:
+                logger.exception(
+                    'Unable to rebuild snapshot of {}'.format(identity)
+                )
+    logger.info("Finished in {} seconds".format(time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
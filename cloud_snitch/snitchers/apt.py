@@ -1,4 +1,3 @@
-import json
 import logging
 
 from .base import BaseSnitcher
@@ -51,6 +50,13 @@ class AptSnitcher(BaseSnitcher):
         for hostname, filename in self._find_host_tuples(self.file_pattern):
             aptpkgs = []
 
+            # Read data from file. Current versions extend through this
+            # run if unchanged.
+            aptdata = self._read_doc(session, hostname, filename)
+            if aptdata is None:
+                continue
+            aptlist = aptdata.get('data', [])
+
             # Find host in graph, continue if host not found.
             host = HostEntity(hostname=hostname, environment=env.identity)
             host = HostEntity.find(session, host.identity)
@@ -60,14 +66,10 @@ class AptSnitcher(BaseSnitcher):
                 )
                 continue
 
-            # Read data from file
-            with open(filename, 'r') as f:
-                aptdata = json.loads(f.read())
-                aptlist = aptdata.get('data', [])
-
             # Iterate over package maps
             for aptdict in aptlist:
                 aptpkg = self._update_apt_package(session, aptdict)
                 if aptpkg is not None:
                     aptpkgs.append(aptpkg)
             host.aptpackages.update(session, aptpkgs, self.time_in_ms)
+            self._ingested(session, aptdata, filename)
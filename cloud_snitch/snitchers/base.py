@@ -1,8 +1,10 @@
+import json
 import logging
 import os
 import re
 import time
 
+from cloud_snitch import digests
 from cloud_snitch import utils
 
 logger = logging.getLogger(__name__)
@@ -53,6 +55,115 @@ class BaseSnitcher(object):
 
         return host_tuples
 
+    def _digest_key(self, filename):
+        """Compute the key of ingested digests for a collected file.
+
+        :param filename: Path of the collected file
+        :type filename: str
+        :returns: Key of the digest
+        :rtype: str
+        """
+        environment = '-'.join([
+            self.run.environment_account_number,
+            self.run.environment_name
+        ])
+        return digests.digest_key(environment, os.path.basename(filename))
+
+    def _referenced_doc(self, doc, filename):
+        """Load the full payload an unchanged marker refers to.
+
+        The marker names the run that carried the full payload. That run
+        is still on disk if it was skipped or failed to sync.
+
+        :param doc: Unchanged marker
+        :type doc: dict
+        :param filename: Path of the marker
+        :type filename: str
+        :returns: Document with the full payload or None
+        :rtype: dict|None
+        """
+        if not doc.get('run'):
+            return None
+        path = os.path.join(
+            os.path.dirname(os.path.normpath(self.run.path)),
+            doc['run'],
+            os.path.basename(filename)
+        )
+        try:
+            with open(path, 'r') as f:
+                full = json.loads(f.read())
+        except (IOError, ValueError):
+            return None
+        if full.get('unchanged') or full.get('digest') != doc['digest']:
+            return None
+        return full
+
+    def _read_doc(self, session, hostname, filename):
+        """Read a collected document, resolving unchanged markers.
+
+        The collector writes a marker instead of the payload when the
+        payload is identical to an earlier run. Nothing needs to be
+        updated if that payload was ingested since current edges and
+        states remain current. Otherwise the full payload is read from
+        the run the marker refers to.
+
+        :param session: neo4j driver session
+        :type session: neo4j.v1.session.BoltSession
+        :param hostname: Name of the host the document belongs to
+        :type hostname: str
+        :param filename: Path of the collected file
+        :type filename: str
+        :returns: Document to ingest or None if there is nothing to do
+        :rtype: dict|None
+        """
+        with open(filename, 'r') as f:
+            doc = json.loads(f.read())
+        if not doc.get('unchanged'):
+            return doc
+
+        key = self._digest_key(filename)
+        if digests.ingested(session, key) == doc.get('digest'):
+            logger.debug("No changes for {} {}".format(
+                self.__class__.__name__,
+                hostname
+            ))
+            return None
+
+        full = self._referenced_doc(doc, filename)
+        if full is not None:
+            logger.info("Ingesting payload of {} from run {}".format(
+                os.path.basename(filename),
+                doc['run']
+            ))
+            return full
+
+        logger.error(
+            "Payload of {} from run {} was never ingested and is no longer "
+            "available. Collect with CLOUD_SNITCH_FULL_RUN=1 to resend it."
+            .format(os.path.basename(filename), doc.get('run'))
+        )
+        return None
+
+    def _ingested(self, session, doc, filename):
+        """Record the digest of an ingested payload.
+
+        Later unchanged markers with the same digest are then skipped.
+
+        :param session: neo4j driver session
+        :type session: neo4j.v1.session.BoltSession
+        :param doc: Ingested document
+        :type doc: dict
+        :param filename: Path of the collected file
+        :type filename: str
+        """
+        if doc.get('digest') is not None:
+            digests.record(
+                session,
+                self._digest_key(filename),
+                doc['digest'],
+                self.time_in_ms
+            )
+
     def _snitch(self, session):
         """All subclasses must implement this.
 
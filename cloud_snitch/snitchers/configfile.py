@@ -1,5 +1,4 @@
 import hashlib
-import json
 import logging
 import os
 
@@ -26,15 +25,17 @@ class ConfigfileSnitcher(BaseSnitcher):
         :param filename: Name of file
         :type filename: str
         """
-        # Extract config and environment data.
-        with open(filename, 'r') as f:
-            configdata = json.loads(f.read())
-            envdict = configdata.get('environment', {})
-            env = EnvironmentEntity(
-                account_number=envdict.get('account_number'),
-                name=envdict.get('name')
-            )
-            configdata = configdata.get('data', {})
+        # Extract config and environment data. Current versions extend
+        # through this run if unchanged.
+        configdoc = self._read_doc(session, hostname, filename)
+        if configdoc is None:
+            return
+        envdict = configdoc.get('environment', {})
+        env = EnvironmentEntity(
+            account_number=envdict.get('account_number'),
+            name=envdict.get('name')
+        )
+        configdata = configdoc.get('data', {})
 
         # Find parent host object - return early if not exists.
         host = HostEntity(hostname=hostname, environment=env.identity)
@@ -45,15 +46,15 @@ class ConfigfileSnitcher(BaseSnitcher):
 
         # Iterate over configration files in the host's directory
         configfiles = []
-        for filename, contents in configdata.items():
-            _, name = os.path.split(filename)
+        for path, contents in configdata.items():
+            _, name = os.path.split(path)
             md5 = hashlib.md5()
             md5.update(contents.encode('utf-8'))
             md5 = md5.hexdigest()
 
             # Update configfile node
             configfile = ConfigfileEntity(
-                path=filename,
+                path=path,
                 host=host.identity,
                 md5=md5,
                 contents=contents,
@@ -64,6 +65,7 @@ class ConfigfileSnitcher(BaseSnitcher):
 
         # Update host -> configfile relationships.
         host.configfiles.update(session, configfiles, self.time_in_ms)
+        self._ingested(session, configdoc, filename)
 
     def _snitch(self, session):
         """Update the apt part of the graph..
@@ -2,6 +2,18 @@ import json
 import logging
 
 from .base import BaseSnitcher
+from cloud_snitch.factschema import COMPLEX_KEY_MAP
+from cloud_snitch.factschema import DEVICE_KEY_MAP
+from cloud_snitch.factschema import DEVICES_KEY
+from cloud_snitch.factschema import EASY_KEY_MAP
+from cloud_snitch.factschema import INTERFACE_KEY
+from cloud_snitch.factschema import INTERFACE_KEY_MAP
+from cloud_snitch.factschema import INTERFACES_KEY
+from cloud_snitch.factschema import MOUNT_KEY_MAP
+from cloud_snitch.factschema import MOUNTS_KEY
+from cloud_snitch.factschema import NAMESERVERS_KEY
+from cloud_snitch.factschema import PARTITION_KEY_MAP
+from cloud_snitch.factschema import PARTITIONS_KEY
 from cloud_snitch.models import EnvironmentEntity
 from cloud_snitch.models import DeviceEntity
 from cloud_snitch.models import HostEntity
@@ -13,65 +25,6 @@ from cloud_snitch.utils import complex_get
 
 logger = logging.getLogger(__name__)
 
-# Ansible key -> host kwarg map
-_EASY_KEY_MAP = {
-    'ansible_architecture': 'arcitecture',
-    'ansible_bios_date': 'bios_date',
-    'ansible_bios_version': 'bios_version',
-    'ansible_kernel': 'kernel',
-    'ansible_memtotal_mb': 'memtotal_mb',
-    'ansible_fqdn': 'fqdn',
-    'ansible_pkg_mgr': 'pkg_mgr',
-    'ansible_processor_cores': 'processor_cores',
-    'ansible_processor_count': 'processor_count',
-    'ansible_processor_threads_per_core': 'processors_threads_per_core',
-    'ansible_processor_vcpus': 'processor_vcpus',
-    'ansible_python_version': 'python_version',
-    'ansible_service_mgr': 'service_mgr',
-    'ansible_selinux': 'selinux',
-}
-
-_COMPLEX_KEY_MAP = {
-    'ansible_default_ipv4:address': 'default_ipv4_address',
-    'ansible_default_ipv6:address': 'default_ipv6_address',
-    'ansible_lsb:codename': 'lsb_codename',
-    'ansible_lsb:description': 'lsb_description',
-    'ansible_lsb:id': 'lsb_id',
-    'ansible_lsb:major_release': 'lsb_major_release',
-    'ansible_lsb:release': 'lsb_release',
-    'ansible_python:executable': 'python_executable',
-    'ansible_python:type': 'python_type',
-    'ansible_version:full': 'ansible_version_full'
-}
-
-_MOUNT_KEY_MAP = {
-    'mount': 'mount',
-    'fstype': 'fstype',
-    'size_total': 'size_total',
-    'device': 'device'
-}
-
-_DEVICE_KEY_MAP = {
-    'removable': 'removable',
-    'rotational': 'rotational',
-    'size': 'size'
-}
-
-_PARTITION_KEY_MAP = {
-    'size': 'size',
-    'start': 'start'
-}
-
-_INTERFACE_KEY_MAP = {
-    'ansible_{}:active': 'active',
-    'ansible_{}:macaddress': 'macaddress',
-    'ansible_{}:mtu': 'mtu',
-    'ansible_{}:promisc': 'promisc',
-    'ansible_{}:device': 'device',
-    'ansible_{}:ipv4:address': 'ipv4_address',
-    'ansible_{}:ipv6:address': 'ipv6_address'
-}
-
 
 class HostSnitcher(BaseSnitcher):
     """Models path to update graph entities for an environment."""
@@ -91,9 +44,9 @@ class HostSnitcher(BaseSnitcher):
         interfaces = []
 
         # Obtain list of interfaces from ansible
-        names = ansibledict.get('ansible_interfaces', [])
+        names = ansibledict.get(INTERFACES_KEY, [])
         for name in names:
-            interfacedict = ansibledict.get('ansible_{}'.format(name))
+            interfacedict = ansibledict.get(INTERFACE_KEY.format(name))
             if interfacedict is None:
                 continue
 
@@ -102,7 +55,7 @@ class HostSnitcher(BaseSnitcher):
                 'host': host.identity
             }
 
-            for ansible_key, interface_key in _INTERFACE_KEY_MAP.items():
+            for ansible_key, interface_key in INTERFACE_KEY_MAP.items():
                 ansible_key = ansible_key.format(name)
                 val = complex_get(ansible_key, ansibledict)
                 if val is not None:
@@ -126,7 +79,7 @@ class HostSnitcher(BaseSnitcher):
         partitions = []
 
         # Iterate over partition dicts from ansible
-        ansiblepartitions = devicedict.get('partitions', {})
+        ansiblepartitions = devicedict.get(PARTITIONS_KEY, {})
         for name, partitiondict in ansiblepartitions.items():
             partitionkwargs = {
                 'name': name,
@@ -134,7 +87,7 @@ class HostSnitcher(BaseSnitcher):
             }
 
             # Create kwargs from key map
-            for ansible_key, partition_key in _PARTITION_KEY_MAP.items():
+            for ansible_key, partition_key in PARTITION_KEY_MAP.items():
                 val = partitiondict.get(ansible_key)
                 if val is not None:
                     partitionkwargs[partition_key] = val
@@ -160,7 +113,7 @@ class HostSnitcher(BaseSnitcher):
         devices = []
 
         # Iterate over device dicts from ansible
-        ansibledevices = ansibledict.get('ansible_devices', {})
+        ansibledevices = ansibledict.get(DEVICES_KEY, {})
         for name, devicedict in ansibledevices.items():
             devicekwargs = {
                 'host': host.identity,
@@ -168,7 +121,7 @@ class HostSnitcher(BaseSnitcher):
             }
 
             # Create kwargs from key map
-            for ansible_key, device_key in _DEVICE_KEY_MAP.items():
+            for ansible_key, device_key in DEVICE_KEY_MAP.items():
                 val = devicedict.get(ansible_key)
                 if val is not None:
                     devicekwargs[device_key] = val
@@ -196,12 +149,12 @@ class HostSnitcher(BaseSnitcher):
         mounts = []
 
         # Iterate over mount dicts from ansible
-        ansiblemounts = ansibledict.get('ansible_mounts', [])
+        ansiblemounts = ansibledict.get(MOUNTS_KEY, [])
         for ansiblemount in ansiblemounts:
             mountkwargs = {'host': host.identity}
 
             # Create kwargs from key map
-            for ansible_key, mount_key in _MOUNT_KEY_MAP.items():
+            for ansible_key, mount_key in MOUNT_KEY_MAP.items():
                 val = ansiblemount.get(ansible_key)
                 if val is not None:
                     mountkwargs[mount_key] = val
@@ -223,7 +176,7 @@ class HostSnitcher(BaseSnitcher):
         :param ansibledict: Ansible fact dict
         :type ansibledict: dict
         """
-        nameserver_list = complex_get('ansible_dns:nameservers', ansibledict)
+        nameserver_list = complex_get(NAMESERVERS_KEY, ansibledict)
 
         # Return early if no nameservers.
         if nameserver_list is None:
@@ -266,13 +219,13 @@ class HostSnitcher(BaseSnitcher):
                     ansibledict[k] = v
 
             # Create properties that require little intervention
-            for ansible_key, host_key in _EASY_KEY_MAP.items():
+            for ansible_key, host_key in EASY_KEY_MAP.items():
                 val = ansibledict.get(ansible_key)
                 if val is not None:
                     hostkwargs[host_key] = val
 
             # Create properties that can be found by path
-            for complexkey, host_key in _COMPLEX_KEY_MAP.items():
+            for complexkey, host_key in COMPLEX_KEY_MAP.items():
                 val = complex_get(complexkey, ansibledict)
                 if val is not None:
                     hostkwargs[host_key] = val
@@ -1,4 +1,3 @@
-import json
 import logging
 
 from .base import BaseSnitcher
@@ -73,6 +72,12 @@ class PipSnitcher(BaseSnitcher):
 
         for hostname, filename in self._find_host_tuples(self.file_pattern):
             virtualenvs = []
+            # Current versions extend through this run if unchanged.
+            pipdata = self._read_doc(session, hostname, filename)
+            if pipdata is None:
+                continue
+            pipdict = pipdata.get('data', {})
+
             host = HostEntity(hostname=hostname, environment=env.identity)
             host = HostEntity.find(session, host.identity)
             if host is None:
@@ -81,10 +86,6 @@ class PipSnitcher(BaseSnitcher):
                 )
                 continue
 
-            with open(filename, 'r') as f:
-                pipdict = json.loads(f.read())
-                pipdict = pipdict.get('data', {})
-
             for path, pkglist in pipdict.items():
                 virtualenv = self._update_virtualenv(
                     session,
@@ -94,3 +95,4 @@ class PipSnitcher(BaseSnitcher):
                 )
                 virtualenvs.append(virtualenv)
             host.virtualenvs.update(session, virtualenvs, self.time_in_ms)
+            self._ingested(session, pipdata, filename)
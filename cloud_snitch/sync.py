@@ -21,7 +21,9 @@ from cloud_snitch.snitchers.pip import PipSnitcher
 from cloud_snitch.snitchers.uservars import UservarsSnitcher
 
 from cloud_snitch import runs
+from cloud_snitch import snapshot
 from cloud_snitch import utils
+from cloud_snitch import writeset
 from cloud_snitch.driver import DriverContext
 from cloud_snitch.exc import RunInvalidStatusError
 from cloud_snitch.exc import RunAlreadySyncedError
@@ -86,6 +88,43 @@ def consume(driver, run):
         snitcher.snitch()
 
 
+def record_update(driver, e_id, time_in_ms):
+    """Add the time of a run to the timeline of its environment.
+
+    :param driver: Neo4J database driver instance
+    :type driver: neo4j.v1.GraphDatabase.driver
+    :param e_id: Environment identity
+    :type e_id: str
+    :param time_in_ms: Run completion time in milliseconds
+    :type time_in_ms: int
+    """
+    with driver.session() as session:
+        e = EnvironmentEntity.find(session, e_id)
+        if e is not None:
+            e.record_update(session, time_in_ms)
+
+
+def rebuild_snapshot(driver, e_id, time_in_ms, write_set):
+    """Rebuild the snapshot of an environment after a run.
+
+    Failures are logged and leave the snapshot closed so searches fall
+    back to the versioned graph.
+
+    :param driver: Neo4J database driver instance
+    :type driver: neo4j.v1.GraphDatabase.driver
+    :param e_id: Environment identity
+    :type e_id: str
+    :param time_in_ms: Run completion time in milliseconds
+    :type time_in_ms: int
+    :param write_set: Labels changed by the run
+    :type write_set: cloud_snitch.writeset.WriteSet
+    """
+    try:
+        snapshot.rebuild(driver, e_id, time_in_ms, write_set.labels)
+    except Exception:
+        logger.exception('Unable to rebuild snapshot of {}.'.format(e_id))
+
+
 def sync(paths):
     with DriverContext() as driver:
         for path in paths:
@@ -95,10 +134,19 @@ def sync(paths):
                     check_run_time(driver, run)
                     run.start()
                     logger.info("Starting collection on {}".format(run.path))
-                    consume(driver, run)
-                    logger.info("Run completion time: {}".format(
-                        utils.milliseconds(run.completed)
-                    ))
+                    e_id = snapshot.environment_identity(run)
+                    time_in_ms = utils.milliseconds(run.completed)
+                    snapshot.close(driver, e_id, time_in_ms)
+                    write_set = writeset.WriteSet()
+                    writeset.set_current(write_set)
+                    try:
+                        consume(driver, run)
+                    finally:
+                        writeset.unset_current()
+                        if write_set.labels:
+                            record_update(driver, e_id, time_in_ms)
+                    logger.info("Run completion time: {}".format(time_in_ms))
+                    rebuild_snapshot(driver, e_id, time_in_ms, write_set)
                     run.finish()
                 except RunAlreadySyncedError as e:
                     logger.info(e)
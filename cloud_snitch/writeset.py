@@ -0,0 +1,58 @@
+"""Record which labels changed while syncing a run.
+
+Versioned entities and edge sets report changes here so that work done
+after a sync, such as rebuilding snapshots, can be limited to the labels
+that actually changed.
+"""
+
+_CURRENT_WRITE_SET = None
+
+
+class WriteSet:
+    """Labels whose entities, states or edges changed during a run."""
+
+    def __init__(self):
+        """Init the write set."""
+        self.labels = set()
+
+    def add(self, label):
+        """Record a change to a label.
+
+        :param label: Label of the changed model
+        :type label: str
+        """
+        self.labels.add(label)
+
+
+def set_current(write_set):
+    """Set the current write set
+
+    :param write_set: Write set instance
+    :type write_set: WriteSet
+    """
+    global _CURRENT_WRITE_SET
+    _CURRENT_WRITE_SET = write_set
+
+
+def get_current():
+    """Get the current write set
+
+    :returns: Current write set or None
+    :rtype: WriteSet|None
+    """
+    return _CURRENT_WRITE_SET
+
+
+def unset_current():
+    """Unset the current write set."""
+    set_current(None)
+
+
+def record(label):
+    """Record a change to a label in the current write set, if any.
+
+    :param label: Label of the changed model
+    :type label: str
+    """
+    if _CURRENT_WRITE_SET is not None:
+        _CURRENT_WRITE_SET.add(label)
@@ -2,6 +2,8 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 import os
+import sys
+import yaml
 
 
 # Try the ansible 2.1+ style first
@@ -19,6 +21,29 @@ except ImportError:
             self.runner = runner
 
 
+# Attempt to load configuration
+conf_file = os.environ.get(
+    'CLOUD_SNITCH_CONF_FILE',
+    '/etc/cloud_snitch/cloud_snitch.yml')
+with open(conf_file, 'r') as f:
+    settings = yaml.load(f.read())
+
+# The fact schema lives in the cloud_snitch package at the repo root.
+_REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__)
+)))
+if _REPO_DIR not in sys.path:
+    sys.path.append(_REPO_DIR)
+
+try:
+    from cloud_snitch import factschema
+except ImportError:
+    factschema = None
+
+# Set fact_snitch_full_capture to true to skip projecting facts.
+_FULL_CAPTURE = settings.get('fact_snitch_full_capture', False)
+
+
 class ActionModule(ActionBase):
 
     def get_facts(self, task_vars):
@@ -40,6 +65,10 @@ class ActionModule(ActionBase):
             if key.startswith('ansible_'):
                 facts[key] = val
 
+        # Keep only the facts consumed by the host snitcher.
+        if not _FULL_CAPTURE and factschema is not None:
+            facts = factschema.project(facts)
+
         return facts
 
     def run(self, *args, **kwargs):
@@ -30,7 +30,11 @@ with open(conf_file, 'r') as f:
 class ActionModule(ActionBase):
 
     def _build_args(self):
-        return dict(file_list=settings.get('file_snitch_list', []))
+        return dict(
+            file_list=settings.get('file_snitch_list', []),
+            mask_flags=settings.get('file_snitch_mask_flags', []),
+            mask_patterns=settings.get('file_snitch_mask_patterns', [])
+        )
 
     def run_old(
         self,
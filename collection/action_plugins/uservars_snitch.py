@@ -2,9 +2,17 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 import glob
+import json
 import os
+import re
 import yaml
 
+# Prefer the libyaml backed loader when it is available.
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
 # Try the ansible 2.1+ style first
 try:
     from ansible.plugins.action import ActionBase
@@ -20,6 +28,19 @@ except ImportError:
             self.runner = runner
 
 
+# Attempt to load configuration
+conf_file = os.environ.get(
+    'CLOUD_SNITCH_CONF_FILE',
+    '/etc/cloud_snitch/cloud_snitch.yml')
+with open(conf_file, 'r') as f:
+    settings = yaml.load(f.read(), Loader=Loader)
+
+# Parsed uservar keys are cached here by path, mtime and size.
+USERVAR_CACHE_FILE = settings.get(
+    'uservars_cache_file',
+    os.path.join(os.path.dirname(conf_file), 'uservars_cache.json')
+)
+
 USERVAR_GLOB = '/etc/openstack_deploy/user_*.yml'
 
 EXCLUDES = set([
@@ -33,21 +54,123 @@ EXCLUDES_CONTAINS = [
     'password'
 ]
 
+EXCLUDES_CONTAINS_EXP = re.compile(
+    '|'.join(re.escape(ex) for ex in EXCLUDES_CONTAINS)
+)
+
+# Types of keys json returns unchanged. Keys are unicode on python 2.
+try:
+    STRING_TYPES = (str, unicode)
+except NameError:
+    STRING_TYPES = (str,)
+
 
 class ActionModule(ActionBase):
 
-    def iter_uservar_files(self):
-        """Iterate over all user variable files."""
+    def _load_cache(self):
+        """Load cached uservar keys from disk.
+
+        :returns: Cache entries keyed by filename
+        :rtype: dict
+        """
+        try:
+            with open(USERVAR_CACHE_FILE, 'r') as f:
+                cache = json.loads(f.read())
+                if isinstance(cache, dict):
+                    return cache
+        except (IOError, ValueError):
+            pass
+        return {}
+
+    def _save_cache(self, cache):
+        """Save cached uservar keys to disk.
+
+        Failure to save the cache is not fatal.
+
+        :param cache: Cache entries keyed by filename
+        :type cache: dict
+        """
+        tmpname = '{}.tmp'.format(USERVAR_CACHE_FILE)
+        try:
+            with open(tmpname, 'w') as f:
+                f.write(json.dumps(cache))
+            os.rename(tmpname, USERVAR_CACHE_FILE)
+        except (IOError, OSError, TypeError, ValueError):
+            pass
+
+    def _parse_keys(self, filename):
+        """Parse a uservar file and return its top level keys.
+
+        :param filename: Name of the file
+        :type filename: str
+        :returns: List of keys or None if the file is not a yaml dict
+        :rtype: list|None
+        """
+        try:
+            with open(filename, 'r') as f:
+                data = yaml.load(f.read(), Loader=Loader)
+                if isinstance(data, dict):
+                    return list(data.keys())
+        except Exception:
+            pass
+        return None
+
+    def _cacheable(self, keys):
+        """Determine if parsed keys survive a round trip through json.
+
+        Json turns non string keys such as ints and bools into strings,
+        so files with such keys are parsed on every run instead.
+
+        :param keys: Keys parsed from a file or None
+        :type keys: list|None
+        :returns: True if the keys may be cached
+        :rtype: bool
+        """
+        return keys is None or all(isinstance(k, STRING_TYPES) for k in keys)
+
+    def iter_uservar_keys(self):
+        """Iterate over keys of all user variable files.
+
+        Files are only parsed when their mtime or size differ from the
+        cached entry.
+
+        :yields: List of keys for each user variable file
+        :ytype: list
+        """
+        cache = self._load_cache()
+        fresh = {}
         for filename in glob.glob(USERVAR_GLOB):
             if filename in EXCLUDES:
                 continue
             try:
-                with open(filename, 'r') as f:
-                    data = yaml.load(f.read())
-                    if isinstance(data, dict):
-                        yield data
-            except Exception:
-                pass
+                stat = os.stat(filename)
+            except OSError:
+                continue
+
+            entry = cache.get(filename)
+            if (
+                entry is None or
+                entry.get('mtime') != stat.st_mtime or
+                entry.get('size') != stat.st_size
+            ):
+                entry = dict(
+                    mtime=stat.st_mtime,
+                    size=stat.st_size,
+                    keys=self._parse_keys(filename)
+                )
+            fresh[filename] = entry
+
+        cacheable = {
+            filename: entry for filename, entry in fresh.items()
+            if self._cacheable(entry['keys'])
+        }
+        if cacheable != cache:
+            self._save_cache(cacheable)
+
+        for filename in sorted(fresh):
+            keys = fresh[filename]['keys']
+            if keys is not None:
+                yield keys
 
     def filter_contains(self, key):
         """Filter keys containing exludes.
@@ -57,18 +180,15 @@ class ActionModule(ActionBase):
         :returns: True for keep, false otherwise
         :rtype: bool
         """
-        for ex in EXCLUDES_CONTAINS:
-            if ex in key:
-                return False
-        return True
+        return EXCLUDES_CONTAINS_EXP.search(key) is None
 
     def get_vars(self, task_vars):
         """Get uservar values from taskvars using keys found in uservars."""
         result = {}
         keys = set()
         filters = [self.filter_contains]
-        for data in self.iter_uservar_files():
-            for key in data:
+        for filekeys in self.iter_uservar_keys():
+            for key in filekeys:
                 if all([_filter(key) for _filter in filters]):
                     keys.add(key)
 
@@ -0,0 +1,186 @@
+"""Benchmark the file_snitch masking engine against the legacy masker.
+
+Masks every line of a corpus of configuration files with both the legacy
+per-line regexes and the precompiled MaskEngine, reports timings and
+lists any lines where the two disagree.
+
+Requires ansible to be importable since file_snitch is an ansible module.
+
+example:
+    python mask_engine.py '/etc/**/*.conf' '/etc/**/*.ini'
+"""
+import argparse
+import glob
+import importlib.machinery
+import importlib.util
+import os
+import re
+import time
+
+FILE_SNITCH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+    'library',
+    'file_snitch'
+)
+
+parser = argparse.ArgumentParser(
+    description="Compare legacy and precompiled file_snitch masking."
+)
+parser.add_argument(
+    'corpus',
+    nargs='+',
+    help="Globs of files to mask. Recursive ** globs are supported."
+)
+parser.add_argument(
+    '--repeat',
+    type=int,
+    default=5,
+    help="How many times to mask the corpus with each engine."
+)
+parser.add_argument(
+    '--show',
+    type=int,
+    default=10,
+    help="Maximum number of mismatched lines to print."
+)
+
+# Legacy masking, kept verbatim for comparison.
+_LEGACY_FLAGS = [
+    'token',
+    'key',
+    'password',
+    'pass',
+    'pwd',
+    'passwd',
+    'passwrd',
+    'secret'
+]
+_left = r'^(?P<left>[^:=]*\w+)'
+_op = r'(?P<op>(\s*)(=|:)(\s*))'
+_LEGACY_ASSIGNMENT_EXP = re.compile(
+    '{}{}(?P<right>.+)$'.format(_left, _op)
+)
+_right = r'(?P<protouser>[\w\+]+://[\w]+:)(?P<password>[\w]+)(?P<rest>@.*)'
+_LEGACY_URL_EXP = re.compile('{}{}{}'.format(_left, _op, _right))
+
+
+def legacy_mask_line(line):
+    """Mask a line the way file_snitch did before MaskEngine.
+
+    :param line: Line to mask
+    :type line: str
+    :returns: Censored line
+    :rtype: str
+    """
+    match = _LEGACY_ASSIGNMENT_EXP.search(line)
+    if match:
+        left = match.group('left').lower()
+        if any([left.endswith(flag) for flag in _LEGACY_FLAGS]):
+            return "{}{}{}".format(
+                match.group('left'),
+                match.group('op'),
+                '*' * 8 + '\n'
+            )
+    match = _LEGACY_URL_EXP.search(line)
+    if match:
+        return '{}{}{}{}{}'.format(
+            match.group('left'),
+            match.group('op'),
+            match.group('protouser'),
+            '*' * 8,
+            match.group('rest') + '\n'
+        )
+    return line
+
+
+def load_file_snitch():
+    """Import the file_snitch module from the library directory.
+
+    :returns: Loaded module
+    :rtype: module
+    """
+    loader = importlib.machinery.SourceFileLoader('file_snitch', FILE_SNITCH)
+    spec = importlib.util.spec_from_loader('file_snitch', loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def load_corpus(patterns):
+    """Read lines of every readable file matching patterns.
+
+    :param patterns: List of globs
+    :type patterns: list
+    :returns: List of lines
+    :rtype: list
+    """
+    lines = []
+    seen = set()
+    for pattern in patterns:
+        for filename in glob.glob(pattern, recursive=True):
+            realpath = os.path.realpath(filename)
+            if realpath in seen or not os.path.isfile(realpath):
+                continue
+            seen.add(realpath)
+            try:
+                with open(realpath, 'r') as f:
+                    lines += f.readlines()
+            except (IOError, UnicodeDecodeError):
+                continue
+    return lines, len(seen)
+
+
+def timed(func, lines, repeat):
+    """Mask all lines repeat times and return the best time and output.
+
+    :param func: Masking function
+    :type func: callable
+    :param lines: Lines to mask
+    :type lines: list
+    :param repeat: Number of repetitions
+    :type repeat: int
+    :returns: Tuple of (best time in seconds, masked lines)
+    :rtype: tuple
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        masked = [func(line) for line in lines]
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, masked
+
+
+def main():
+    args = parser.parse_args()
+    file_snitch = load_file_snitch()
+    engine = file_snitch.MaskEngine()
+
+    lines, filecount = load_corpus(args.corpus)
+    print("Corpus: {} files, {} lines".format(filecount, len(lines)))
+    if not lines:
+        return
+
+    legacy_time, legacy = timed(legacy_mask_line, lines, args.repeat)
+    engine_time, masked = timed(engine.mask, lines, args.repeat)
+
+    print("Legacy: {:.4f}s".format(legacy_time))
+    print("Engine: {:.4f}s".format(engine_time))
+    if engine_time:
+        print("Speedup: {:.2f}x".format(legacy_time / engine_time))
+
+    mismatches = [
+        (line, old, new)
+        for line, old, new in zip(lines, legacy, masked)
+        if old != new
+    ]
+    print("Mismatched lines: {}".format(len(mismatches)))
+    for line, old, new in mismatches[:args.show]:
+        print("  input:  {!r}".format(line))
+        print("  legacy: {!r}".format(old))
+        print("  engine: {!r}".format(new))
+
+
+if __name__ == '__main__':
+    main()
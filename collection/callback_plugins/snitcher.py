@@ -2,8 +2,10 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 import datetime
+import hashlib
 import json
 import os
+import time
 import yaml
 
 try:
@@ -28,19 +30,131 @@ DOCUMENTATION = '''
       - This callback dumps apt_sniffer module results to a file
       - Environment Variable CLOUD_SNITCH_ENABLED
       - Environment Variable CLOUD_SNITCH_CONF_FILE
+      - Environment Variable CLOUD_SNITCH_FULL_RUN
+      - Unchanged dpkg, pip and file payloads are written as markers
+        naming the run that carried the full payload. Set
+        CLOUD_SNITCH_FULL_RUN=1 for one run, or change_detection false
+        in cloud_snitch.yml, to write every payload in full.
+        change_detection_max_age sets how many seconds a full payload
+        may be repeated by markers, 24 hours by default.
     requirements:
 '''
 
 
+# Doctypes whose payloads are replaced by a marker when unchanged.
+CHANGE_DETECTION_DOCTYPES = set([
+    'dpkg_list',
+    'pip_list',
+    'file_dict'
+])
+
+
+class DigestStore:
+    """Persists the digest of the last full payload per (doctype, host).
+
+    Each digest is kept with the run that carried the payload so that
+    markers can refer to it and the sync can recover the payload from
+    that run if it was never ingested.
+    """
+
+    def __init__(self, filename, max_age=None):
+        """Init the store.
+
+        :param filename: Name of the file holding digests
+        :type filename: str
+        :param max_age: Seconds a full payload may be repeated by markers
+        :type max_age: int
+        """
+        self.filename = filename
+        self.max_age = max_age
+        self.digests = {}
+        self.dirty = False
+
+    def _key(self, doctype, host):
+        """Compute the key of a doctype and host.
+
+        :param doctype: Type of the document
+        :type doctype: str
+        :param host: The host
+        :type host: str
+        :returns: Key into digests
+        :rtype: str
+        """
+        return '{}:{}'.format(doctype, host)
+
+    def load(self):
+        """Load digests from file. Missing or bad files are ignored."""
+        try:
+            with open(self.filename, 'r') as f:
+                self.digests = json.loads(f.read())
+        except (IOError, ValueError):
+            self.digests = {}
+
+    def save(self):
+        """Save digests to file if any have changed."""
+        if not self.dirty:
+            return
+        tmpname = '{}.tmp'.format(self.filename)
+        with open(tmpname, 'w') as f:
+            f.write(json.dumps(self.digests))
+        os.rename(tmpname, self.filename)
+        self.dirty = False
+
+    def get(self, doctype, host):
+        """Get the last full payload for a doctype and host.
+
+        Entries older than max_age are ignored so that full payloads are
+        written again periodically.
+
+        :param doctype: Type of the document
+        :type doctype: str
+        :param host: The host
+        :type host: str
+        :returns: Dict with digest, run and time or None
+        :rtype: dict|None
+        """
+        entry = self.digests.get(self._key(doctype, host))
+
+        # Entries of older releases do not name a run.
+        if not isinstance(entry, dict):
+            return None
+        if self.max_age is not None and \
+                time.time() - entry.get('time', 0) > self.max_age:
+            return None
+        return entry
+
+    def set(self, doctype, host, digest, run):
+        """Set the last full payload for a doctype and host.
+
+        :param doctype: Type of the document
+        :type doctype: str
+        :param host: The host
+        :type host: str
+        :param digest: Digest of the payload
+        :type digest: str
+        :param run: Name of the run directory holding the payload
+        :type run: str
+        """
+        self.digests[self._key(doctype, host)] = {
+            'digest': digest,
+            'run': run,
+            'time': time.time()
+        }
+        self.dirty = True
+
+
 class FileHandler:
 
-    def __init__(self, writedir):
+    def __init__(self, writedir, digests=None):
         """Init the file handler
 
         :param writedir: Directory to write to
         :type writedir: str
+        :param digests: Optional store of previous payload digests
+        :type digests: DigestStore
         """
         self.basedir = writedir
+        self.digests = digests
         if self.basedir is None:
             raise Exception("No data directory configured.")
 
@@ -64,7 +178,10 @@ class FileHandler:
         """Writes payload as json to file.
 
         Stores md5 of json. Used to determine if change
-        has occurred.
+        has occurred. Unchanged payloads are written as a marker
+        with `unchanged` set to true, no data and the run that
+        carried the full payload. Digests are only stored once the
+        full payload has been written.
 
         Filenames will be:
             <doctype>_<host>.json, <doctype>_<host>.json
@@ -81,7 +198,29 @@ class FileHandler:
         self._outfile_name = os.path.join(self.basedir, outfile_name)
         self._doc['host'] = host
         self._doc['data'] = result.get('payload', {})
-        self._save()
+
+        if self.digests is None or doctype not in CHANGE_DETECTION_DOCTYPES:
+            self._save()
+            return
+
+        # Replace unchanged payloads with a marker.
+        data = json.dumps(self._doc['data'], sort_keys=True)
+        digest = hashlib.md5(data.encode('utf-8')).hexdigest()
+        self._doc['digest'] = digest
+        previous = self.digests.get(doctype, host)
+        if previous is not None and previous['digest'] == digest:
+            self._doc['unchanged'] = True
+            self._doc['data'] = None
+            self._doc['run'] = previous['run']
+            self._save()
+        else:
+            self._save()
+            self.digests.set(
+                doctype,
+                host,
+                digest,
+                os.path.basename(os.path.normpath(self.basedir))
+            )
 
 
 class SingleFileHandler(FileHandler):
@@ -147,6 +286,7 @@ class CallbackModule(CallbackBase):
         """Enables or disables plugin based on environment."""
         super(CallbackModule, self).__init__(display)
         self.basedir = settings.get('data_dir')
+        self.digests = None
         if os.environ.get('CLOUD_SNITCH_ENABLED', False):
             self.disabled = False
             if not self.basedir:
@@ -168,7 +308,7 @@ class CallbackModule(CallbackBase):
         if doctype not in TARGET_DOCTYPES:
             return
         handler = DOCTYPE_HANDLERS.get(doctype, FileHandler)
-        handler(self.dirpath).handle(doctype, host, result)
+        handler(self.dirpath, self.digests).handle(doctype, host, result)
 
     def _run_data_filename(self):
         """Compute filename of run data.
@@ -209,6 +349,19 @@ class CallbackModule(CallbackBase):
         if not os.path.exists(self.dirpath):
             os.makedirs(self.dirpath)
 
+        # Load digests of previous payloads unless disabled. A full run
+        # writes every payload and stores fresh digests.
+        if settings.get('change_detection', True):
+            self.digests = DigestStore(
+                settings.get(
+                    'digest_file',
+                    os.path.join(os.path.dirname(conf_file), 'digests.json')
+                ),
+                max_age=settings.get('change_detection_max_age', 60 * 60 * 24)
+            )
+            if not os.environ.get('CLOUD_SNITCH_FULL_RUN'):
+                self.digests.load()
+
         # Saved some stats
         self._write_run_data({
             'status': 'running',
@@ -230,3 +383,7 @@ class CallbackModule(CallbackBase):
         data['status'] = 'finished'
         data['completed'] = now.isoformat()
         self._write_run_data(data)
+
+        # Only remember digests of runs that finished.
+        if self.digests is not None:
+            self.digests.save()
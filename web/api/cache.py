@@ -1,3 +1,6 @@
+import pickle
+import zlib
+
 from base64 import b64encode
 
 
@@ -22,3 +25,25 @@ def cache_key(args, kwargs, prefix='', index=0):
     key = str.encode(key)
     key = b64encode(key)
     return key
+
+
+def compress(value):
+    """Pickle and compress a value for storage in the cache.
+
+    :param value: Picklable value
+    :type value: object
+    :returns: Compressed bytes
+    :rtype: bytes
+    """
+    return zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def decompress(data):
+    """Decompress and unpickle a value made by compress().
+
+    :param data: Compressed bytes
+    :type data: bytes
+    :returns: Original value
+    :rtype: object
+    """
+    return pickle.loads(zlib.decompress(data))
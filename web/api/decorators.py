@@ -8,7 +8,7 @@ from .cache import cache_key
 logger = logging.getLogger(__name__)
 
 
-def _cached_result(prefix='', timeout=None, index=0):
+def _cached_result(prefix='', timeout=None, index=0, version=None):
     """Decorator called by the class and non class cached result.
 
     :param prefix: Prefix for cache
@@ -17,6 +17,9 @@ def _cached_result(prefix='', timeout=None, index=0):
     :type timeout: integer
     :param index: Position of args to key from
     :type index: integer
+    :param version: Optional function of the decorated function's args
+        returning a data version to include in the key
+    :type version: function
     :returns: decorator function.
     :rtype: function
     """
@@ -25,7 +28,10 @@ def _cached_result(prefix='', timeout=None, index=0):
 
     def wrapper(func):
         def _decorated(*args, **kwargs):
-            key = cache_key(args, kwargs, prefix=prefix, index=index)
+            key_prefix = prefix
+            if version is not None:
+                key_prefix = '{}@{}'.format(prefix, version(*args, **kwargs))
+            key = cache_key(args, kwargs, prefix=key_prefix, index=index)
             value = cache.get(key)
 
             if value is None:
@@ -39,35 +45,41 @@ def _cached_result(prefix='', timeout=None, index=0):
     return wrapper
 
 
-def cls_cached_result(prefix='', timeout=None):
+def cls_cached_result(prefix='', timeout=None, version=None):
     """Caching decorator for class functions.
 
     :param prefix: Cache key prefix
     :type prefix: str
     :param timeout: TTL in seconds
     :type timeout: int
+    :param version: Optional function returning a data version
+    :type version: function
     :returns: decorator function.
     :rtype: function
     """
     return _cached_result(
         prefix=prefix,
         timeout=timeout,
-        index=1
+        index=1,
+        version=version
     )
 
 
-def cached_result(prefix='', timeout=None):
+def cached_result(prefix='', timeout=None, version=None):
     """Caching decorator for non class functions.
 
     :param prefix: Cache key prefix
     :type prefix: str
     :param timeout: TTL in seconds
     :type timeout: int
+    :param version: Optional function returning a data version
+    :type version: function
     :returns: decorator function
     :rtype: function
     """
     return _cached_result(
         prefix=prefix,
         timeout=timeout,
-        index=0
+        index=0,
+        version=version
     )
@@ -1,7 +1,16 @@
 import logging
+import sys
+import threading
+
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from time import monotonic
 
 from cloud_snitch.models import registry
-from .query import Query
+from .cache import compress
+from .cache import decompress
+from .query import SubtreeQuery
 
 logger = logging.getLogger(__name__)
 
@@ -9,29 +18,178 @@ LEFT = 'left'
 RIGHT = 'right'
 BOTH = 'both'
 
+# Number of nodes stored together when results are cached in pages
+PAGE_SIZE = 500
+
+# Sides are stored as bit flags so a side seen from both becomes BOTH.
+_SIDE_BITS = {LEFT: 1, RIGHT: 2}
+_SIDE_NAMES = {1: LEFT, 2: RIGHT, 3: BOTH}
+_BOTH_BITS = 3
+
+
+def _pack(values):
+    """Pack property values into a tuple without trailing missing ones.
+
+    Positions past the end of a tuple are missing properties, so values
+    moved to both by cleaning leave the empty tuple behind.
+
+    :param values: Property values by position
+    :type values: list
+    :returns: Tuple of values
+    :rtype: tuple
+    """
+    end = len(values)
+    while end and values[end - 1] is None:
+        end -= 1
+    return tuple(values[:end])
+
+
+class Schema:
+    """Property names of one label shared by all of its nodes.
+
+    Nodes store property values in tuples ordered by the schema instead
+    of dicts. Names are interned and the values left on one side after
+    cleaning are shared between nodes changed the same way.
+    """
+
+    __slots__ = ('label', 'names', 'index', 'identity', '_values')
+
+    def __init__(self, label):
+        """Init the schema.
+
+        :param label: Type|Label of the nodes
+        :type label: str
+        """
+        self.label = sys.intern(label)
+        self.names = []
+        self.index = {}
+        self.identity = registry.identity_property(label)
+        self._values = {}
+
+    def position(self, name):
+        """Get the position of a property, adding it if new.
+
+        :param name: Name of the property
+        :type name: str
+        :returns: Position in value tuples
+        :rtype: int
+        """
+        pos = self.index.get(name)
+        if pos is None:
+            pos = len(self.names)
+            name = sys.intern(name)
+            self.names.append(name)
+            self.index[name] = pos
+        return pos
+
+    def share(self, values):
+        """Get a shared tuple equal to values of one side after cleaning.
+
+        Values holding the identity are unique to one node so they are
+        not shared and do not grow the shared set.
+
+        :param values: Property values by position
+        :type values: tuple
+        :returns: Shared tuple or values
+        :rtype: tuple
+        """
+        pos = self.index.get(self.identity)
+        if pos is not None and pos < len(values) and \
+                values[pos] is not None:
+            return values
+        try:
+            return self._values.setdefault(values, values)
+        except TypeError:
+            return values
+
+    def release(self):
+        """Stop sharing value tuples so unused ones can be freed."""
+        self._values = {}
+
+    def todict(self, values):
+        """Convert a value tuple to a dict of properties.
+
+        Positions holding None are missing properties.
+
+        :param values: Property values by position
+        :type values: tuple
+        :returns: Property name -> value
+        :rtype: dict
+        """
+        return {
+            self.names[i]: value
+            for i, value in enumerate(values)
+            if value is not None
+        }
+
 
 class Node:
-    """Model a node in a graph of the differences."""
+    """Model a node in a graph of the differences.
+
+    Properties live in value tuples laid out by a per label schema and
+    relationships are arrays of integer node ids, so a diff of a large
+    environment holds few objects per node.
+    """
 
-    def __init__(self, identity, model):
+    __slots__ = (
+        'id', 'model', 'identity', 'schema', 'left', 'right', 'both',
+        'parents', 'child_ids', 'child_sides', 'changed', 'cleaned',
+        'rel_changed'
+    )
+
+    def __init__(self, identity, model, node_id=0, schema=None):
         """Init the node.
 
         :param identity: Identity of the node
         :type identity: str
         :param model: Type|Label of the node
         :type model: str
+        :param node_id: Integer id of the node within its diff
+        :type node_id: int
+        :param schema: Schema shared by nodes of model
+        :type schema: Schema
         """
-        self.model = model
+        self.id = node_id
+        self.schema = schema if schema is not None else Schema(model)
+        self.model = self.schema.label
         self.identity = identity
-        self.parents = set()
-        self.left_props = {}
-        self.both_props = {}
-        self.right_props = {}
-        self.children = {}
+        self.left = ()
+        self.right = ()
+        self.both = ()
+        self.parents = array('l')
+        self.child_ids = array('l')
+        self.child_sides = bytearray()
         self.changed = False
         self.cleaned = False
         self.rel_changed = False
 
+    @property
+    def left_props(self):
+        """Properties only on the left.
+
+        :returns: Property name -> value
+        :rtype: dict
+        """
+        return self.schema.todict(self.left)
+
+    @property
+    def right_props(self):
+        """Properties only on the right.
+
+        :returns: Property name -> value
+        :rtype: dict
+        """
+        return self.schema.todict(self.right)
+
+    @property
+    def both_props(self):
+        """Properties with the same value on both sides.
+
+        :returns: Property name -> value
+        :rtype: dict
+        """
+        return self.schema.todict(self.both)
+
     @property
     def dirty(self):
         """Determine if this node's properties are dirty.
@@ -40,7 +198,58 @@ class Node:
         :rtype: bool
         """
         self.clean()
-        return self.left_props or self.right_props or self.rel_changed
+        return any(v is not None for v in self.left) or \
+            any(v is not None for v in self.right) or \
+            self.rel_changed
+
+    def _values(self, side):
+        """Get the values of a side as a list long enough for the schema.
+
+        :param side: Which side (left|right|both)
+        :type side: str
+        :returns: List of values by position
+        :rtype: list
+        """
+        values = list(getattr(self, side))
+        values.extend([None] * (len(self.schema.names) - len(values)))
+        return values
+
+    def differs(self):
+        """Determine if the node differs between sides without cleaning.
+
+        :returns: True if properties or relationships differ
+        :rtype: bool
+        """
+        if any(bits != _BOTH_BITS for bits in self.child_sides):
+            return True
+        left = self._values(LEFT)
+        right = self._values(RIGHT)
+        return any(value != right[i] for i, value in enumerate(left))
+
+    def split(self):
+        """Split properties into left, both and right without cleaning.
+
+        :returns: Left, both and right property dicts
+        :rtype: tuple
+        """
+        left, right, both = {}, {}, {}
+        names = self.schema.names
+        values = zip(
+            self._values(LEFT),
+            self._values(RIGHT),
+            self._values(BOTH)
+        )
+        for i, (lvalue, rvalue, bvalue) in enumerate(values):
+            if bvalue is not None:
+                both[names[i]] = bvalue
+            elif lvalue is not None and lvalue == rvalue:
+                both[names[i]] = lvalue
+            else:
+                if lvalue is not None:
+                    left[names[i]] = lvalue
+                if rvalue is not None:
+                    right[names[i]] = rvalue
+        return left, both, right
 
     def update(self, d, side):
         """Update properties by d
@@ -50,8 +259,16 @@ class Node:
         :param side: Which side is d coming from(left|right)
         :type side: str
         """
+        schema = self.schema
+        values = list(getattr(self, side))
         for key, value in d.items():
-            self.add_property(key, value, side)
+            pos = schema.index.get(key)
+            if pos is None:
+                pos = schema.position(key)
+            if pos >= len(values):
+                values.extend([None] * (pos + 1 - len(values)))
+            values[pos] = value
+        setattr(self, side, _pack(values))
 
     def clean(self):
         """Collect properties that are the same on both."""
@@ -59,23 +276,22 @@ class Node:
         if self.cleaned:
             return
 
-        # Start a list of properties that can be moved.
-        toremove = []
-        for key, value in self.left_props.items():
-            if value == self.right_props.get(key):
-                toremove.append(key)
-                self.both_props[key] = value
-
-        # Remove properties from both sides
-        for i in toremove:
-            del self.left_props[i]
-            del self.right_props[i]
+        # Move properties with equal values from both sides.
+        left = self._values(LEFT)
+        right = self._values(RIGHT)
+        both = self._values(BOTH)
+        for i, value in enumerate(left):
+            if value is not None and value == right[i]:
+                both[i] = value
+                left[i] = None
+                right[i] = None
+        self.left = self.schema.share(_pack(left))
+        self.right = self.schema.share(_pack(right))
+        self.both = _pack(both)
 
         # Check relationships:
-        for model, modeldict in self.children.items():
-            for identity, reldict in modeldict.items():
-                if reldict['side'] != 'both':
-                    self.rel_changed = True
+        if any(bits != _BOTH_BITS for bits in self.child_sides):
+            self.rel_changed = True
 
         # Mark as cleaned.
         self.cleaned = True
@@ -90,66 +306,121 @@ class Node:
         :param side: Which side is the property coming from.
         :type side: str
         """
-        if side == LEFT:
-            this = self.left_props
-        else:
-            this = self.right_props
-        this[key] = value
+        self.update({key: value}, side)
+
+    def add_parent(self, node_id):
+        """Add a parent to the node.
 
-    def add_child(self, model, node, side):
+        Only repeats of the last parent are skipped. Other duplicates are
+        merged by compact().
+
+        :param node_id: Id of the parent node
+        :type node_id: int
+        """
+        if not self.parents or self.parents[-1] != node_id:
+            self.parents.append(node_id)
+
+    def _child_index(self, node_id):
+        """Find the position of a child.
+
+        :param node_id: Id of the child node
+        :type node_id: int
+        :returns: Position in child arrays or None
+        :rtype: int|None
+        """
+        try:
+            return self.child_ids.index(node_id)
+        except ValueError:
+            return None
+
+    def add_child(self, node_id, side):
         """Add child to the node.
 
-        :param model: Type|Label of the child node.
-        :type model: str
-        :param node: Node to add
-        :type node: Node
+        Children are usually added from both sides in a row, so only the
+        last child is checked. Other duplicates are merged by compact().
+
+        :param node_id: Id of the child node
+        :type node_id: int
         :param side: Which side is the node coming from?
         :type side: str
         """
-        model_rel = self.children.setdefault(model, {})
-        node_rel = model_rel.setdefault(node.identity, {
-            'side': side,
-            'node': node
-        })
-        if side != node_rel['side']:
-            node_rel['side'] = BOTH
+        if self.child_ids and self.child_ids[-1] == node_id:
+            self.child_sides[-1] |= _SIDE_BITS[side]
+        else:
+            self.child_ids.append(node_id)
+            self.child_sides.append(_SIDE_BITS[side])
 
-    def remove_child(self, model, identity):
-        """Remove a child.
+    def link_child(self, node_id, side):
+        """Add a side to a child that may have been added before.
 
-        :param model: Type|Label of the node to remove
-        :type model: str
-        :param identity: Identity of the node
-        :type identity: str
+        Unlike add_child() all children are checked, so repeats fed from
+        other parts of the tree are merged right away.
+
+        :param node_id: Id of the child node
+        :type node_id: int
+        :param side: Which side is the node coming from?
+        :type side: str
+        """
+        index = self._child_index(node_id)
+        if index is None:
+            self.add_child(node_id, side)
+        else:
+            self.child_sides[index] |= _SIDE_BITS[side]
+
+    def compact(self):
+        """Merge relationships that were added more than once."""
+        if len(self.child_ids) > 1:
+            merged = {}
+            for node_id, bits in zip(self.child_ids, self.child_sides):
+                merged[node_id] = merged.get(node_id, 0) | bits
+            if len(merged) < len(self.child_ids):
+                self.child_ids = array('l', merged.keys())
+                self.child_sides = bytearray(merged.values())
+
+        if len(self.parents) > 1:
+            parents = dict.fromkeys(self.parents)
+            if len(parents) < len(self.parents):
+                self.parents = array('l', parents)
+
+    def remove_child(self, node_id):
+        """Remove a child that is on both sides.
+
+        :param node_id: Id of the child node
+        :type node_id: int
+        :returns: True if removed, False otherwise
+        :rtype: bool
         """
-        if model in self.children:
-            if identity in self.children[model]:
-                if self.children[model][identity]['side'] == 'both':
-                    del self.children[model][identity]
-                    return True
+        index = self._child_index(node_id)
+        if index is not None and self.child_sides[index] == _BOTH_BITS:
+            del self.child_ids[index]
+            del self.child_sides[index]
+            return True
         return False
 
     def todict(self):
         """Dictionary representation of the node.
 
-        :param rel_side: Which side does the node belong to
-        :type rel_side: str
         :returns: Dict representation of node
         :rtype: dict
         """
+        left, both, right = self.split()
         d = {
             'model': self.model,
-            'left': self.left_props,
-            'both': self.both_props,
-            'right': self.right_props,
+            'left': left,
+            'both': both,
+            'right': right,
         }
         return d
 
-    def toframe(self, rel_side=None):
+    def toframe(self, nodes, rel_side=None, keep=None):
         """Create structural representation of the node.
 
+        :param nodes: Nodes of the diff indexed by id
+        :type nodes: list
         :param rel_side: Which side of the diff is the node on?
         :type rel_side: string
+        :param keep: Ids of nodes to include or None for all
+        :type keep: set|None
         :returns: Dict representation of structure.
         :rtype: dict
         """
@@ -160,12 +431,118 @@ class Node:
             'id': self.identity,
             'children': children
         }
-        for model, modeldict in self.children.items():
-            for identity, nodedict in modeldict.items():
-                children.append(nodedict['node'].toframe(nodedict['side']))
+        for node_id, bits in zip(self.child_ids, self.child_sides):
+            if keep is not None and node_id not in keep:
+                continue
+            children.append(
+                nodes[node_id].toframe(nodes, _SIDE_NAMES[bits], keep)
+            )
+        children.sort(key=lambda c: (c['model'], c['id']))
         return d
 
 
+class Side:
+    """Tree of an object at one time in compact form.
+
+    Sides are taken from a diff before it is cleaned so they can be
+    cached and fed to later diffs sharing a time instead of querying
+    the database again.
+    """
+
+    def __init__(self, names, nodes, edges):
+        """Init the side.
+
+        :param names: Model -> tuple of property names
+        :type names: dict
+        :param nodes: List of (model, identity, values) tuples. Values
+            are ordered by the names of the model.
+        :type nodes: list
+        :param edges: Parent and child positions in nodes, in pairs
+        :type edges: array.array
+        """
+        self.names = names
+        self.nodes = nodes
+        self.edges = edges
+
+    @classmethod
+    def fromdiff(cls, diff, side):
+        """Take one side of a diff that has been fed but not cleaned.
+
+        :param diff: Diff to take the side from
+        :type diff: Diff
+        :param side: Which side (left|right)
+        :type side: str
+        :returns: The side
+        :rtype: Side
+        """
+        bit = _SIDE_BITS[side]
+        names = {}
+        nodes = []
+        positions = {}
+        for node in diff.table:
+            values = getattr(node, side)
+            if not values:
+                continue
+            positions[node.id] = len(nodes)
+            nodes.append((node.model, node.identity, values))
+            names[node.model] = tuple(node.schema.names)
+
+        edges = array('l')
+        for node in diff.table:
+            parent = positions.get(node.id)
+            if parent is None:
+                continue
+            for node_id, bits in zip(node.child_ids, node.child_sides):
+                if bits & bit and node_id in positions:
+                    edges.append(parent)
+                    edges.append(positions[node_id])
+        return cls(names, nodes, edges)
+
+    def feed(self, diff, side):
+        """Feed the side to a diff.
+
+        :param diff: Diff to feed
+        :type diff: Diff
+        :param side: Which side of the diff to feed (left|right)
+        :type side: str
+        """
+        ids = []
+        for model, identity, values in self.nodes:
+            props = {
+                name: value
+                for name, value in zip(self.names[model], values)
+                if value is not None
+            }
+            node = diff.getnode(model, props)
+            node.update(props, side)
+            ids.append(node.id)
+
+        for i in range(0, len(self.edges), 2):
+            parent = diff.table[ids[self.edges[i]]]
+            child = diff.table[ids[self.edges[i + 1]]]
+            parent.add_child(child.id, side)
+            child.add_parent(parent.id)
+
+    def dump(self):
+        """Compress the side for caching.
+
+        :returns: Compressed bytes
+        :rtype: bytes
+        """
+        return compress((self.names, self.nodes, self.edges))
+
+    @classmethod
+    def load(cls, data):
+        """Load a side compressed by dump().
+
+        :param data: Compressed bytes
+        :type data: bytes
+        :returns: The side
+        :rtype: Side
+        """
+        return cls(*decompress(data))
+
+
 class DiffResult:
     """Convenience class for interfacing with a diffdict."""
     def __init__(self, diffdict):
@@ -209,15 +586,178 @@ class DiffResult:
         """
         return self.diffdict['frame']
 
+    def progress(self):
+        """Get how much of the diff has been computed.
+
+        Results cached before progress was tracked are complete.
+
+        :returns: Parts done, total parts and whether complete
+        :rtype: dict
+        """
+        return self.diffdict.get(
+            'progress',
+            {'done': 0, 'total': 0, 'complete': True}
+        )
+
+    def complete(self):
+        """Determine if the diff has been fully computed.
+
+        :returns: True if complete, False for a partial result
+        :rtype: bool
+        """
+        return self.progress()['complete']
+
+    def header(self, pagesize=PAGE_SIZE):
+        """Get everything but the nodes for storing nodes in pages.
+
+        :param pagesize: Number of nodes per page
+        :type pagesize: int
+        :returns: Diff dict without nodes
+        :rtype: dict
+        """
+        header = {
+            k: v for k, v in self.diffdict.items() if k != 'nodes'
+        }
+        header['pagesize'] = pagesize
+        return header
+
+    def pages(self, pagesize=PAGE_SIZE):
+        """Split the nodes into pages.
+
+        :param pagesize: Number of nodes per page
+        :type pagesize: int
+        :returns: List of lists of nodes
+        :rtype: list
+        """
+        nodes = self.diffdict['nodes']
+        return [
+            nodes[i:(i + pagesize)]
+            for i in range(0, len(nodes), pagesize)
+        ]
+
+
+class PagedDiffResult(DiffResult):
+    """DiffResult that loads pages of nodes only when needed."""
+    def __init__(self, header, loadpages):
+        """Init the PagedDiffResult
+
+        :param header: Diff dict without nodes from DiffResult.header()
+        :type header: dict
+        :param loadpages: Called with page indexes to get lists of nodes
+        :type loadpages: callable
+        """
+        super(PagedDiffResult, self).__init__(header)
+        self.loadpages = loadpages
+
+    def _nodes(self, start, stop):
+        """Load the nodes with indexes in [start, stop).
+
+        :param start: First index
+        :type start: int
+        :param stop: Index after the last
+        :type stop: int
+        :returns: List of nodes
+        :rtype: list
+        """
+        stop = min(stop, self.diffdict['nodecount'])
+        if start >= stop:
+            return []
+        pagesize = self.diffdict['pagesize']
+        first = start // pagesize
+        last = (stop - 1) // pagesize
+        nodes = []
+        for page in self.loadpages(list(range(first, last + 1))):
+            nodes.extend(page)
+        offset = first * pagesize
+        return nodes[(start - offset):(stop - offset)]
+
+    def getnodes(self, offset, limit):
+        """Get up to limit nodes starting at offset.
+
+        :param offset: Where to start
+        :type offset: int
+        :param limit: Maximum number of nodes to retrieve
+        :type limit: int
+        """
+        return self._nodes(offset, offset + limit)
+
+    def getnode(self, model, identity):
+        """Get a specific node identified by model and id.
+
+        :param model: Name of the model
+        :type model: str
+        :param identity: Id of an object
+        :type identity: str
+        :returns: Dict representation of node or None
+        :rtype: dict|None
+        """
+        index = self.diffdict['nodemap'].get(model, {}).get(identity)
+        if index is not None:
+            return self._nodes(index, index + 1)[0]
+        return None
+
+
+class Throttle:
+    """Limit how often partial results are built and published.
+
+    Building a partial result walks every node fed so far and storing it
+    compresses every page, so doing it after each part makes a diff of
+    many parts quadratic. The first part is published right away so
+    readers see something early, later parts at most once per interval.
+    The last part is never published since the complete result follows.
+    """
+
+    def __init__(self, progress, interval):
+        """Init the throttle
+
+        :param progress: Called with a partial result or None to skip
+        :type progress: callable|None
+        :param interval: Minimum seconds between partial results
+        :type interval: float
+        """
+        self.progress = progress
+        self.interval = interval
+        self.last = None
+
+    def update(self, done, total, result):
+        """Publish a partial result if one is due.
+
+        :param done: Number of parts done
+        :type done: int
+        :param total: Number of parts
+        :type total: int
+        :param result: Builds the partial result
+        :type result: callable
+        :returns: True if a partial result was published
+        :rtype: bool
+        """
+        if self.progress is None or done >= total:
+            return False
+        now = monotonic()
+        if self.last is not None and now - self.last < self.interval:
+            return False
+        self.last = now
+        self.progress(result())
+        return True
+
 
 class Diff:
     """Models a graph that is a diff of two objects."""
 
-    pagesize = 1000
+    # Number of threads fetching parts of the tree concurrently
+    workers = 4
 
-    def __init__(self, model, identity, left_time, right_time):
+    # Minimum seconds between partial results
+    interval = 5
+
+    def __init__(self, model, identity, left_time, right_time,
+                 progress=None, left_side=None, right_side=None,
+                 keep_sides=False):
         """Init the diff
 
+        Sides already known from earlier diffs are fed from memory and
+        only the missing times are queried.
+
         :param model: Type|Label of the root node
         :type model: str
         :param identity: Identity of the root node
@@ -226,24 +766,55 @@ class Diff:
         :type left_time: int
         :param right_time: Second timestamp in milliseconds
         :type right_time: int
+        :param progress: Called with a partial result as parts finish
+        :type progress: callable|None
+        :param left_side: Tree at left_time if already known
+        :type left_side: Side|None
+        :param right_side: Tree at right_time if already known
+        :type right_side: Side|None
+        :param keep_sides: Whether to keep queried sides in self.sides
+        :type keep_sides: bool
         """
+        # Model -> identity -> node id
         self.nodes = {}
+
+        # Nodes indexed by id and schemas keyed by model
+        self.table = []
+        self.schemas = {}
+
         self.model = model
         self.identity = identity
         self.left_time = left_time
         self.right_time = right_time
 
-        # Feed data from the left
-        self.feedleft()
+        self.progress = progress
+        self.parts_done = 0
+        self.parts_total = 0
+        self.complete = False
+
+        # Side -> known Side and side -> Side taken from queried data
+        self.known = {LEFT: left_side, RIGHT: right_side}
+        self.keep_sides = keep_sides
+        self.sides = {}
+
+        # Feed data from both sides
+        self.feed()
+        for node in self.table:
+            node.compact()
 
-        # Feed data from the right
-        self.feedright()
+        # Take queried sides before they are cleaned.
+        if keep_sides:
+            for side, known in self.known.items():
+                if known is None:
+                    self.sides[side] = Side.fromdiff(self, side)
+        self.known = None
 
         # Move unchanged properties to both
         self.clean()
 
         # Remove unchanged nodes with unchanged children.
         self.prune()
+        self.complete = True
 
     def getnode(self, model, data):
         """Get a node of model type matching data.
@@ -257,112 +828,252 @@ class Diff:
         :returns: Node with matching data
         :rtype: Node
         """
-        identity = data[registry.identity_property(model)]
+        return self.node(model, data[registry.identity_property(model)])
+
+    def node(self, model, identity):
+        """Get a node of model type by identity.
+
+        Create a new node if one does not exist.
+
+        :param model: Name of the model
+        :type model: str
+        :param identity: Identity of the node within the diff
+        :type identity: str
+        :returns: Node with matching identity
+        :rtype: Node
+        """
         nodemap = self.nodes.setdefault(model, {})
-        node = nodemap.setdefault(identity, Node(identity, model))
-        return node
+        node_id = nodemap.get(identity)
+        if node_id is None:
+            schema = self.schemas.get(model)
+            if schema is None:
+                schema = self.schemas.setdefault(model, Schema(model))
+            node_id = len(self.table)
+            self.table.append(Node(identity, model, node_id, schema))
+            nodemap[identity] = node_id
+        return self.table[node_id]
+
+    def feedrecord(self, record, touched=None):
+        """Feed one record of the tree to the diff.
+
+        :param record: Record from a SubtreeQuery
+        :type record: neo4j.Record|dict
+        :param touched: Optional sets collecting ids of fed nodes and
+            (parent id, child id) pairs of fed relationships
+        :type touched: tuple
+        """
+        label = record['label']
+        props = dict(record['node'].items())
+        node = self.getnode(label, props)
+
+        parent = None
+        if record['parent'] is not None:
+            parent = self.getnode(record['parent_label'], record['parent'])
+
+        if touched is not None:
+            touched[0].add(node.id)
+            if parent is not None:
+                touched[1].add((parent.id, node.id))
+
+        # Ancestors of changes are returned by every part that holds
+        # changes below them. Relationships fed before are merged in
+        # place instead of being added again.
+        linked = parent is not None and parent.id in node.parents
+
+        # A node is on a side if it is in the tree at that time through
+        # any parent, even when the path of this record is not valid.
+        for side, present, valid, state in [
+            (LEFT, record['in_left'], record['on_left'],
+             record['left_state']),
+            (RIGHT, record['in_right'], record['on_right'],
+             record['right_state'])
+        ]:
+            # Update diff with the node and its state on this side
+            if present:
+                data = dict(props)
+                if state is not None:
+                    data.update(state.items())
+                node.update(data, side)
+            if not valid:
+                continue
+
+            # Make parent -> child relationship
+            if linked:
+                parent.link_child(node.id, side)
+            elif parent is not None:
+                parent.add_child(node.id, side)
+                node.add_parent(parent.id)
+
+    def feed(self):
+        """Feed the tree at both times to the diff.
+
+        The tree is split into independent parts fetched concurrently on
+        separate sessions. Records are fed one at a time under a lock.
+        As parts finish, partial results are passed to the progress
+        callback at the rate allowed by a Throttle.
+
+        Known sides are fed first. Unless whole sides must be kept only
+        nodes that differ and their ancestors are returned by the query,
+        which still walks the tree in the database. With one side
+        known the rest of the other side is copied from it. No partial
+        results are published then since they would show the uncopied
+        side as removed.
+        """
+        known = [s for s in [LEFT, RIGHT] if self.known[s] is not None]
+        for side in known:
+            self.known[side].feed(self, side)
+        if len(known) == 2:
+            return
+
+        changed_only = bool(known) or not self.keep_sides
+        touched = (set(), set()) if known else None
+        throttle = Throttle(None if known else self.progress, self.interval)
+        parts = SubtreeQuery(
+            self.model,
+            self.identity,
+            self.left_time,
+            self.right_time,
+            changed_only=changed_only
+        ).partitions()
+        lock = threading.Lock()
+
+        def feedpart(q):
+            for record in q.iter_records():
+                with lock:
+                    self.feedrecord(record, touched)
+
+        self.parts_total = len(parts)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(feedpart, q) for q in parts]
+            for future in as_completed(futures):
+                future.result()
+                with lock:
+                    self.parts_done += 1
+                    throttle.update(
+                        self.parts_done,
+                        self.parts_total,
+                        self.result
+                    )
+
+        if known:
+            self.fill(known[0], *touched)
 
-    def feedpath(self, path, time, side):
-        """Feed all of a path from a side to the diff.
+    def fill(self, side, nodes, rels):
+        """Copy a known side to the other side where nothing changed.
 
-        :param path: List of models indicating path through data to a model
-        :type path: list
-        :param time: Integer milliseconds since epoch
-        :type time: int
-        :param side: Which side to feed the diff from.
+        Nodes and relationships missing from a query of changes are the
+        same at both times. Nodes returned by the query already hold both
+        sides, including shared nodes still in the tree through a parent
+        whose relationship did not change.
+
+        :param side: Which side is known (left|right)
         :type side: str
+        :param nodes: Ids of nodes fed from the query
+        :type nodes: set
+        :param rels: (parent id, child id) pairs fed from the query
+        :type rels: set
         """
-        # Build query
-        q = Query(path[-1]) \
-            .filter(
-                registry.identity_property(self.model),
-                '=',
-                self.identity, self.model
-            ).time(time)
-
-        # Start at page 1 and page through all results.
-        page = 1
-        records = q.page(page, self.pagesize)
-        while (records):
-            for record in records:
-                parent = None
-                for label in path:
-                    # Update diff with results
-                    node = self.getnode(label, record[label])
-                    node.update(record[label], side)
-
-                    # Make parent -> child relationship
-                    if parent is not None:
-                        parent.add_child(label, node, side)
-                        node.parents.add(parent)
-
-                    # Advance parent for next part of path.
-                    parent = node
-
-            page += 1
-            records = q.page(page, self.pagesize)
-
-    def feed(self, time, side):
-        """Feed all paths from a side to the diff.
-
-        :param time: Integer milliseconds since epoch
-        :type side: Which side to feed from
-        """
-        # Iterarate over every path.
-        paths = registry.forest.paths_from(self.model)
-        for p in paths:
-            self.feedpath(p, time, side)
-
-    def feedleft(self):
-        """Feed data from the left side."""
-        self.feed(self.left_time, LEFT)
-
-    def feedright(self):
-        """Feed data from the right side."""
-        self.feed(self.right_time, RIGHT)
+        other = RIGHT if side == LEFT else LEFT
+        bit = _SIDE_BITS[side]
+        other_bit = _SIDE_BITS[other]
+        for node in self.table:
+            if node.id not in nodes:
+                setattr(node, other, getattr(node, side))
+            for i, node_id in enumerate(node.child_ids):
+                bits = node.child_sides[i]
+                if bits & bit and (node.id, node_id) not in rels:
+                    node.child_sides[i] = bits | other_bit
 
     def clean(self):
         """Mark nodes that have changed as changed.
 
         Mark all ancestors of changed nodes as changed.
         """
-        # Iterate over the model -> nodes dictionary
-        for model, nodedict in self.nodes.items():
-            # Iterate over the identity -> node dictionary
-            for identity, node in nodedict.items():
-                # If node is dirty, mark entire path as changed
-                if node.dirty:
-                    stack = [node]
-                    while stack:
-                        current = stack.pop()
-                        # If already changed, no need to continue.
-                        if current.changed:
-                            continue
-                        current.changed = True
-                        for parent in current.parents:
-                            stack.append(parent)
+        for node in self.table:
+            # If node is dirty, mark entire path as changed
+            if node.dirty:
+                stack = [node]
+                while stack:
+                    current = stack.pop()
+                    # If already changed, no need to continue.
+                    if current.changed:
+                        continue
+                    current.changed = True
+                    for parent_id in current.parents:
+                        stack.append(self.table[parent_id])
 
     def prune(self):
         """Remove unchanged nodes that also have unchanged children."""
+        unchanged = set(n.id for n in self.table if not n.changed)
+
+        # Remove unchanged children on both sides from their parents.
+        # Unchanged nodes still linked to a parent from one side are kept.
+        linked = set()
+        for node in self.table:
+            if not node.child_ids:
+                continue
+            child_ids = array('l')
+            child_sides = bytearray()
+            for node_id, bits in zip(node.child_ids, node.child_sides):
+                if node_id in unchanged:
+                    if bits == _BOTH_BITS:
+                        continue
+                    linked.add(node_id)
+                child_ids.append(node_id)
+                child_sides.append(bits)
+            node.child_ids = child_ids
+            node.child_sides = child_sides
+
+        # Remove unchanged nodes from datastructure
         for model, nodedict in self.nodes.items():
-            toremove = []
-            # Remove unchanged children from parents
-            for identity, node in nodedict.items():
-                if not node.changed:
-                    # Add to remove list if removed from every parent
-                    removed = [
-                        p.remove_child(model, identity)
-                        for p in node.parents
-                    ]
-                    if all(removed):
-                        toremove.append(identity)
-            # Remove unchanged nodes from datasructure
+            toremove = [
+                identity for identity, node_id in nodedict.items()
+                if node_id in unchanged and node_id not in linked
+            ]
             for key in toremove:
-                del nodedict[key]
+                self.table[nodedict.pop(key)] = None
+
+        # Shared values only help while nodes are being cleaned.
+        for schema in self.schemas.values():
+            schema.release()
+
+    def kept(self):
+        """Find ids of nodes that belong in the result.
+
+        Does not modify nodes so it may be called on a partially fed
+        diff. Kept nodes are changed nodes, their ancestors and nodes
+        linked to a parent from one side only, matching prune().
+
+        :returns: Set of node ids
+        :rtype: set
+        """
+        kept = set()
+        stack = []
+        for node in self.table:
+            if node is None:
+                continue
+            if node.differs():
+                stack.append(node.id)
+            for node_id, bits in zip(node.child_ids, node.child_sides):
+                if bits != _BOTH_BITS:
+                    kept.add(node_id)
+
+        changed = set()
+        while stack:
+            node_id = stack.pop()
+            if node_id in changed:
+                continue
+            changed.add(node_id)
+            stack.extend(self.table[node_id].parents)
+        return kept | changed
 
     def result(self):
         """Create diff result that can be cached/chunked.
 
+        May be called while the diff is being fed to get the result so
+        far. Progress is included so readers can tell partial results
+        from complete ones.
+
         :returns: Result of the diff
         :rtype: DiffResult
         """
@@ -370,16 +1081,29 @@ class Diff:
             'frame': None,
             'nodes': [],
             'nodemap': {},
-            'nodecount': 0
+            'nodecount': 0,
+            'progress': {
+                'done': self.parts_done,
+                'total': self.parts_total,
+                'complete': self.complete
+            }
         }
-        rootnodes = self.nodes[self.model]
-        if rootnodes:
-            diffdict['frame'] = next(iter(rootnodes.values())).toframe()
+        keep = self.kept()
+        root_id = self.nodes.get(self.model, {}).get(self.identity)
+        if root_id is not None and root_id in keep:
+            root = self.table[root_id]
+            diffdict['frame'] = root.toframe(self.table, keep=keep)
+            # Parts of the tree are fed in any order so sort for a
+            # stable result.
             index = 0
-            for model, nodedict in self.nodes.items():
+            for model in sorted(self.nodes):
+                nodedict = self.nodes[model]
                 modelmap = {}
-                for identity, node in nodedict.items():
-                    n = node.todict()
+                for identity in sorted(nodedict):
+                    node_id = nodedict[identity]
+                    if node_id not in keep:
+                        continue
+                    n = self.table[node_id].todict()
                     diffdict['nodes'].append(n)
                     modelmap[identity] = index
                     index += 1
@@ -388,3 +1112,354 @@ class Diff:
 
         diffdict['nodecount'] = len(diffdict['nodes'])
         return DiffResult(diffdict)
+
+
+def natural_key_property(model):
+    """Get the property aligning objects of a model across identities.
+
+    Identities are concatenations such as path and host. The first part
+    names the object without where it lives so it is the default.
+
+    :param model: Name of the model
+    :type model: str
+    :returns: Name of the property
+    :rtype: str
+    """
+    klass = registry.models[model]
+    parts = klass.concat_properties.get(klass.identity_property)
+    return parts[0] if parts else klass.identity_property
+
+
+def _natural_key(model, props, keys):
+    """Get the natural key of an object.
+
+    :param model: Name of the model
+    :type model: str
+    :param props: Properties of the object
+    :type props: dict
+    :param keys: Model -> property overriding the default natural key
+    :type keys: dict
+    :returns: Natural key falling back to the identity
+    :rtype: str
+    """
+    prop = keys.get(model) or natural_key_property(model)
+    value = props.get(prop)
+    if value is None:
+        value = props.get(registry.identity_property(model))
+    return str(value)
+
+
+def _compared(model, props, ancestors):
+    """Get properties of an object worth comparing across identities.
+
+    The identity and creation time always differ. Other parts of the
+    identity naming an ancestor, such as the host of a config file,
+    differ whenever the ancestors do.
+
+    :param model: Name of the model
+    :type model: str
+    :param props: Properties of the object
+    :type props: dict
+    :param ancestors: Identities and natural keys of ancestors
+    :type ancestors: set|frozenset
+    :returns: Properties to compare
+    :rtype: dict
+    """
+    klass = registry.models[model]
+    skip = {klass.identity_property, 'created_at'}
+    for part in klass.concat_properties.get(klass.identity_property, []):
+        if props.get(part) in ancestors:
+            skip.add(part)
+    return {k: v for k, v in props.items() if k not in skip}
+
+
+class KeyedDiff(Diff):
+    """Diff of two objects aligned by natural keys instead of identity.
+
+    Nodes are identified by the path of natural keys from the root so
+    config files of two hosts line up by path, packages by name and so
+    on. Either identity may be None when only one side has the object.
+    """
+
+    def __init__(self, model, left_identity, right_identity, left_time,
+                 right_time, key, keys=None, ancestors=None):
+        """Init the diff
+
+        :param model: Type|Label of the root node
+        :type model: str
+        :param left_identity: Identity of the root on the left or None
+        :type left_identity: str|None
+        :param right_identity: Identity of the root on the right or None
+        :type right_identity: str|None
+        :param left_time: Left timestamp in milliseconds
+        :type left_time: int
+        :param right_time: Right timestamp in milliseconds
+        :type right_time: int
+        :param key: Path of natural keys to the root
+        :type key: str
+        :param keys: Model -> property overriding default natural keys
+        :type keys: dict
+        :param ancestors: Side -> identities and natural keys of the
+            ancestors of the root on that side
+        :type ancestors: dict
+        """
+        self.identities = {LEFT: left_identity, RIGHT: right_identity}
+        self.keys = keys or {}
+        self.ancestors = ancestors or {}
+        super(KeyedDiff, self).__init__(model, key, left_time, right_time)
+
+    def feed(self):
+        """Feed the tree of each side at its own time."""
+        for side, time in [(LEFT, self.left_time), (RIGHT, self.right_time)]:
+            identity = self.identities[side]
+            if identity is None:
+                continue
+            query = SubtreeQuery(self.model, identity, time, time)
+            self.feedside(side, identity, query.iter_records())
+
+    def feedside(self, side, identity, records):
+        """Feed records of one tree keyed by paths of natural keys.
+
+        Records arrive in any order so the tree is collected before
+        being walked from the root.
+
+        :param side: Which side (left|right)
+        :type side: str
+        :param identity: Identity of the root on this side
+        :type identity: str
+        :param records: Records of a SubtreeQuery at a single time
+        :type records: iterable
+        """
+        props = {}
+        children = {}
+        for record in records:
+            label = record['label']
+            data = dict(record['node'].items())
+            if record['left_state'] is not None:
+                data.update(record['left_state'].items())
+            ref = (label, data[registry.identity_property(label)])
+            props[ref] = data
+            if record['parent'] is not None:
+                parent_label = record['parent_label']
+                parent = (
+                    parent_label,
+                    record['parent'][registry.identity_property(parent_label)]
+                )
+                children.setdefault(parent, []).append(ref)
+
+        root = (self.model, identity)
+        if root not in props:
+            return
+        ancestors = frozenset(self.ancestors.get(side, ()))
+        stack = [(root, self.identity, None, ancestors)]
+        while stack:
+            ref, key, parent, ancestors = stack.pop()
+            label, ref_identity = ref
+            data = props[ref]
+            node = self.node(label, key)
+            node.update(_compared(label, data, ancestors), side)
+            if parent is not None:
+                parent.add_child(node.id, side)
+                node.add_parent(parent.id)
+
+            natural = _natural_key(label, data, self.keys)
+            below = ancestors | {ref_identity, natural}
+            for child in children.get(ref, []):
+                if child not in props:
+                    continue
+                child_key = '{}/{}'.format(
+                    key,
+                    _natural_key(child[0], props[child], self.keys)
+                )
+                stack.append((child, child_key, node, below))
+
+
+class CrossDiff:
+    """Diff of two objects of the same model with different identities.
+
+    Children of the roots are aligned by natural key and each aligned
+    pair is diffed on its own, keeping only changed nodes, so memory is
+    bounded by the changes plus the trees of the pairs in flight.
+
+    Hosts align on hostname by default, so environments naming their
+    hosts differently pair nothing and every host shows on one side.
+    Such hosts are aligned per diff with aliases mapping hostnames on
+    the right to hostnames on the left, or keys choosing another
+    property.
+    """
+
+    # Number of pairs diffed concurrently
+    workers = 4
+
+    # Minimum seconds between partial results
+    interval = 5
+
+    def __init__(self, model, left_identity, right_identity, left_time,
+                 right_time, keys=None, aliases=None, progress=None):
+        """Init the diff
+
+        :param model: Type|Label of the roots
+        :type model: str
+        :param left_identity: Identity of the root on the left
+        :type left_identity: str
+        :param right_identity: Identity of the root on the right
+        :type right_identity: str
+        :param left_time: Left timestamp in milliseconds
+        :type left_time: int
+        :param right_time: Right timestamp in milliseconds
+        :type right_time: int
+        :param keys: Model -> property overriding default natural keys
+        :type keys: dict|None
+        :param aliases: Model -> natural key on the right -> natural key
+            on the left it is aligned with
+        :type aliases: dict|None
+        :param progress: Called with a partial result as pairs finish
+        :type progress: callable|None
+        """
+        self.model = model
+        self.identities = {LEFT: left_identity, RIGHT: right_identity}
+        self.times = {LEFT: left_time, RIGHT: right_time}
+        self.identity = '{} | {}'.format(left_identity, right_identity)
+        self.keys = keys or {}
+        self.aliases = aliases or {}
+        self.progress = progress
+
+        self.root = Node(self.identity, model)
+        self.ancestors = {}
+        self.results = []
+        self.parts_done = 0
+        self.parts_total = 0
+        self.complete = False
+
+        self.run()
+        self.complete = True
+
+    def pairs(self):
+        """Fetch both roots and align their children by natural key.
+
+        :returns: (model, key) -> side -> identity
+        :rtype: dict
+        """
+        forest_node = registry.forest.nodes[self.model]
+        pairs = {}
+        for side in [LEFT, RIGHT]:
+            identity = self.identities[side]
+            time = self.times[side]
+            query = SubtreeQuery(self.model, identity, time, time, walk=False)
+            for record in query.iter_records():
+                data = dict(record['node'].items())
+                if record['left_state'] is not None:
+                    data.update(record['left_state'].items())
+                self.ancestors[side] = {
+                    identity,
+                    _natural_key(self.model, data, self.keys)
+                }
+                self.root.update(
+                    _compared(self.model, data, self.ancestors[side]),
+                    side
+                )
+
+            for relname in sorted(forest_node.children):
+                query = SubtreeQuery(
+                    self.model,
+                    identity,
+                    time,
+                    time,
+                    prefix=[relname],
+                    walk=False
+                )
+                for record in query.iter_records():
+                    label = record['label']
+                    data = dict(record['node'].items())
+                    key = _natural_key(label, data, self.keys)
+                    if side == RIGHT:
+                        key = self.aliases.get(label, {}).get(key, key)
+                    pair = pairs.setdefault((label, key), {})
+                    pair[side] = data[registry.identity_property(label)]
+        return pairs
+
+    def run(self):
+        """Diff aligned pairs concurrently."""
+        pairs = self.pairs()
+        lock = threading.Lock()
+
+        def diffpair(item):
+            (label, key), identities = item
+            d = KeyedDiff(
+                label,
+                identities.get(LEFT),
+                identities.get(RIGHT),
+                self.times[LEFT],
+                self.times[RIGHT],
+                key,
+                keys=self.keys,
+                ancestors=self.ancestors
+            )
+            side = BOTH if len(identities) == 2 else next(iter(identities))
+            return side, d.result()
+
+        self.parts_total = len(pairs)
+        throttle = Throttle(self.progress, self.interval)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [
+                executor.submit(diffpair, item)
+                for item in sorted(pairs.items())
+            ]
+            for future in as_completed(futures):
+                side, result = future.result()
+                with lock:
+                    self.parts_done += 1
+                    if result.frame() is not None:
+                        self.results.append((side, result))
+                    throttle.update(
+                        self.parts_done,
+                        self.parts_total,
+                        self.result
+                    )
+
+    def result(self):
+        """Create diff result that can be cached/chunked.
+
+        :returns: Result of the diff
+        :rtype: DiffResult
+        """
+        diffdict = {
+            'frame': None,
+            'nodes': [],
+            'nodemap': {},
+            'nodecount': 0,
+            'progress': {
+                'done': self.parts_done,
+                'total': self.parts_total,
+                'complete': self.complete
+            }
+        }
+
+        children = []
+        entries = []
+        for side, result in self.results:
+            frame = dict(result.frame())
+            frame['side'] = side
+            children.append(frame)
+            for model, modelmap in result.diffdict['nodemap'].items():
+                for identity, index in modelmap.items():
+                    entries.append(
+                        (model, identity, result.diffdict['nodes'][index])
+                    )
+
+        if children or self.root.differs():
+            children.sort(key=lambda c: (c['model'], c['id']))
+            diffdict['frame'] = {
+                'side': None,
+                'model': self.model,
+                'id': self.identity,
+                'children': children
+            }
+            entries.append((self.model, self.identity, self.root.todict()))
+
+        entries.sort(key=lambda e: (e[0], e[1]))
+        for index, (model, identity, node) in enumerate(entries):
+            diffdict['nodes'].append(node)
+            diffdict['nodemap'].setdefault(model, {})[identity] = index
+        diffdict['nodecount'] = len(diffdict['nodes'])
+        return DiffResult(diffdict)
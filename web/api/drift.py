@@ -0,0 +1,324 @@
+import logging
+
+from .diff import DiffResult
+from .diff import Throttle
+from .query import Query
+
+logger = logging.getLogger(__name__)
+
+# Label -> ((label, prop) naming a feature, (label, prop) of its value)
+# Python packages are keyed by virtualenv path since hosts often carry
+# several virtualenvs with different versions of the same package.
+FEATURES = {
+    'AptPackage': (
+        [('AptPackage', 'name')],
+        ('AptPackage', 'version')
+    ),
+    'Configfile': (
+        [('Configfile', 'path')],
+        ('Configfile', 'md5')
+    ),
+    'PythonPackage': (
+        [('Virtualenv', 'path'), ('PythonPackage', 'name')],
+        ('PythonPackage', 'version')
+    ),
+}
+
+
+def _popcount(mask):
+    """Count hosts in a mask.
+
+    :param mask: Bit mask of host indexes
+    :type mask: int
+    :returns: Number of set bits
+    :rtype: int
+    """
+    return bin(mask).count('1')
+
+
+def _indexes(mask):
+    """Iterate over host indexes in a mask.
+
+    :param mask: Bit mask of host indexes
+    :type mask: int
+    :yields: Index of each set bit from lowest to highest
+    :ytype: int
+    """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class FeatureMatrix:
+    """Sparse host x feature matrix of one environment.
+
+    Each column is a (label, key, value) feature such as an apt package
+    name and version. Columns are stored as bit masks of the hosts that
+    have them so majority counts and outliers are computed with integer
+    operations over all hosts at once.
+    """
+
+    def __init__(self, hosts):
+        """Init the matrix
+
+        :param hosts: Identities of hosts, one row each
+        :type hosts: list
+        """
+        self.hosts = list(hosts)
+        self.index = {h: i for i, h in enumerate(self.hosts)}
+        self.all = (1 << len(self.hosts)) - 1
+
+        # (label, key) -> value -> mask
+        self.columns = {}
+
+    def add(self, host, label, key, value):
+        """Mark a host as having a value for a feature.
+
+        Rows of unknown hosts are ignored.
+
+        :param host: Identity of the host
+        :type host: str
+        :param label: Label the feature comes from
+        :type label: str
+        :param key: Name of the feature such as a package name
+        :type key: str
+        :param value: Value of the feature such as a version
+        :type value: str
+        """
+        i = self.index.get(host)
+        if i is None:
+            return
+        values = self.columns.setdefault((label, key), {})
+        values[value] = values.get(value, 0) | (1 << i)
+
+    def baselines(self):
+        """Find the majority value of each feature and the outliers.
+
+        Hosts without a feature count as a value of None so a package
+        missing from most hosts makes the hosts that have it outliers.
+        Ties go to the value sorting last so reports are stable. A host
+        with several values for a feature matches the baseline if any of
+        them does.
+
+        :yields: (label, key, baseline, count, outliers mask) for each
+            feature some host deviates on
+        :ytype: tuple
+        """
+        for (label, key), values in sorted(self.columns.items()):
+            counts = {v: _popcount(m) for v, m in values.items()}
+            union = 0
+            for mask in values.values():
+                union |= mask
+            absent = self.all & ~union
+            if absent:
+                counts[None] = _popcount(absent)
+
+            baseline = max(counts, key=lambda v: (counts[v], str(v)))
+            if baseline is None:
+                outliers = union
+            else:
+                outliers = self.all & ~values[baseline]
+            if outliers:
+                yield label, key, baseline, counts[baseline], outliers
+
+    def values(self, label, key, host):
+        """Get the values a host has for a feature.
+
+        :param label: Label the feature comes from
+        :type label: str
+        :param key: Name of the feature
+        :type key: str
+        :param host: Index of the host
+        :type host: int
+        :returns: Sorted list of values, empty if the host lacks it
+        :rtype: list
+        """
+        bit = 1 << host
+        return sorted(
+            v for v, m in self.columns.get((label, key), {}).items()
+            if m & bit
+        )
+
+
+class Drift:
+    """Drift of each host of an environment from the majority of hosts.
+
+    Features of every host are loaded once per label and compared to
+    the most common value across hosts. Hosts are ranked by how many
+    features deviate from the baseline.
+    """
+
+    # Minimum seconds between partial results
+    interval = 5
+
+    def __init__(self, identity, time, labels=None, hostnames=None,
+                 progress=None):
+        """Init the drift analysis
+
+        :param identity: Identity of the environment
+        :type identity: str
+        :param time: Time in milliseconds
+        :type time: int
+        :param labels: Labels of features to compare, default all
+        :type labels: list|None
+        :param hostnames: Only compare hosts with these hostnames
+        :type hostnames: list|None
+        :param progress: Called with partial results as labels finish
+        :type progress: callable|None
+        """
+        self.identity = identity
+        self.time = time
+        self.labels = sorted(labels or FEATURES)
+        self.hostnames = set(hostnames) if hostnames else None
+        self.progress = progress
+
+        self.matrix = None
+        self.parts_done = 0
+        self.parts_total = len(self.labels)
+        self.complete = False
+
+        self.run()
+        self.complete = True
+
+    def _query(self, label):
+        """Create a query for rows of a label in the environment.
+
+        :param label: Model label
+        :type label: str
+        :returns: Query at the time of the drift
+        :rtype: query.Query
+        """
+        return Query(label) \
+            .time(self.time) \
+            .filter(
+                'account_number_name',
+                '=',
+                self.identity,
+                label='Environment'
+            )
+
+    def loadhosts(self):
+        """Load identities of hosts compared by the drift.
+
+        :returns: Sorted list of host identities
+        :rtype: list
+        """
+        hosts = []
+        for row in self._query('Host').iter_rows():
+            host = row['Host']
+            if self.hostnames is not None and \
+                    host.get('hostname') not in self.hostnames:
+                continue
+            hosts.append(host['hostname_environment'])
+        return sorted(hosts)
+
+    def loadfeatures(self, label):
+        """Add features of a label for all hosts to the matrix.
+
+        :param label: Label of features
+        :type label: str
+        """
+        keyprops, (value_label, value_prop) = FEATURES[label]
+        for row in self._query(label).iter_rows():
+            key = ':'.join(
+                str(row[key_label].get(prop)) for key_label, prop in keyprops
+            )
+            self.matrix.add(
+                row['Host']['hostname_environment'],
+                label,
+                key,
+                row[value_label].get(value_prop)
+            )
+
+    def run(self):
+        """Load the matrix one label at a time."""
+        self.matrix = FeatureMatrix(self.loadhosts())
+        logger.debug("Comparing {} hosts of {}".format(
+            len(self.matrix.hosts), self.identity
+        ))
+        throttle = Throttle(self.progress, self.interval)
+        for label in self.labels:
+            self.loadfeatures(label)
+            self.parts_done += 1
+            throttle.update(self.parts_done, self.parts_total, self.result)
+
+    def result(self):
+        """Create a ranked drift report that can be cached/chunked.
+
+        The frame lists drifting hosts from most to least drift. Nodes
+        are the environment with the baselines followed by each drifting
+        host with the features it deviates on, in rank order.
+
+        :returns: Result of the drift
+        :rtype: DiffResult
+        """
+        total = len(self.matrix.hosts)
+        baselines = []
+        drift = {}
+        for label, key, baseline, count, outliers in \
+                self.matrix.baselines():
+            baselines.append({
+                'label': label,
+                'key': key,
+                'value': baseline,
+                'share': count / total,
+                'outliers': _popcount(outliers)
+            })
+            for i in _indexes(outliers):
+                drift.setdefault(i, []).append({
+                    'label': label,
+                    'key': key,
+                    'value': self.matrix.values(label, key, i) or None,
+                    'baseline': baseline
+                })
+        baselines.sort(key=lambda b: (-b['outliers'], b['label'], b['key']))
+
+        ranked = sorted(
+            drift,
+            key=lambda i: (-len(drift[i]), self.matrix.hosts[i])
+        )
+        nodes = [{
+            'model': 'Environment',
+            'id': self.identity,
+            'hosts': total,
+            'baselines': baselines
+        }]
+        children = []
+        for rank, i in enumerate(ranked, 1):
+            host = self.matrix.hosts[i]
+            children.append({
+                'side': None,
+                'model': 'Host',
+                'id': host,
+                'score': len(drift[i]),
+                'children': []
+            })
+            nodes.append({
+                'model': 'Host',
+                'id': host,
+                'rank': rank,
+                'score': len(drift[i]),
+                'drift': drift[i]
+            })
+
+        diffdict = {
+            'frame': {
+                'side': None,
+                'model': 'Environment',
+                'id': self.identity,
+                'children': children
+            },
+            'nodes': nodes,
+            'nodemap': {
+                'Environment': {self.identity: 0},
+                'Host': {n['id']: i for i, n in enumerate(nodes) if i}
+            },
+            'nodecount': len(nodes),
+            'progress': {
+                'done': self.parts_done,
+                'total': self.parts_total,
+                'complete': self.complete
+            }
+        }
+        return DiffResult(diffdict)
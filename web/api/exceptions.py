@@ -22,6 +22,17 @@ class InvalidPropertyError(Exception):
         super(InvalidPropertyError, self).__init__(msg)
 
 
+class InvalidCursorError(Exception):
+    def __init__(self, cursor):
+        """Init the error.
+
+        :param cursor: Cursor that could not be decoded
+        :type cursor: str
+        """
+        msg = 'Invalid cursor \'{}\'.'.format(cursor)
+        super(InvalidCursorError, self).__init__(msg)
+
+
 class JobRunningError(Exception):
     """Error for asynchronous task still running."""
     def __init__(self):
@@ -0,0 +1,88 @@
+"""Encoders for streaming search exports."""
+import csv
+import json
+
+from cloud_snitch.models import registry
+
+
+class _Echo:
+    """File like object returning what is written to it."""
+
+    def write(self, value):
+        return value
+
+
+def _chunked(lines, chunksize):
+    """Join lines into chunks.
+
+    :param lines: Iterable of strings
+    :type lines: iterable
+    :param chunksize: Number of lines per chunk
+    :type chunksize: int
+    :yields: Chunk of joined lines
+    :ytype: str
+    """
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunksize:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def ndjson_chunks(rows, chunksize=100):
+    """Encode rows as newline delimited json.
+
+    :param rows: Iterable of rows keyed by label
+    :type rows: iterable
+    :param chunksize: Number of rows per chunk
+    :type chunksize: int
+    :yields: Chunk of json lines
+    :ytype: str
+    """
+    lines = (json.dumps(row, default=str) + '\n' for row in rows)
+    return _chunked(lines, chunksize)
+
+
+def csv_columns(labels):
+    """Get (label, property) columns for the returned labels.
+
+    :param labels: Returned labels in order
+    :type labels: list
+    :returns: List of (label, property) tuples
+    :rtype: list
+    """
+    columns = []
+    for label in labels:
+        for prop in registry.properties(label):
+            columns.append((label, prop))
+    return columns
+
+
+def csv_chunks(labels, rows, chunksize=100):
+    """Encode rows as csv with a header of label.property names.
+
+    :param labels: Returned labels in order
+    :type labels: list
+    :param rows: Iterable of rows keyed by label
+    :type rows: iterable
+    :param chunksize: Number of rows per chunk
+    :type chunksize: int
+    :yields: Chunk of csv lines
+    :ytype: str
+    """
+    columns = csv_columns(labels)
+    writer = csv.writer(_Echo())
+
+    def lines():
+        yield writer.writerow(
+            ['{}.{}'.format(label, prop) for label, prop in columns]
+        )
+        for row in rows:
+            yield writer.writerow([
+                row.get(label, {}).get(prop) for label, prop in columns
+            ])
+
+    return _chunked(lines(), chunksize)
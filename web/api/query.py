@@ -1,8 +1,15 @@
+import base64
+import json
 import logging
+import threading
+
+from collections import OrderedDict
+from functools import lru_cache
 
 from cloud_snitch.models import registry
 from cloud_snitch import utils
 
+from .exceptions import InvalidCursorError
 from .exceptions import InvalidLabelError
 from .exceptions import InvalidPropertyError
 
@@ -10,6 +17,87 @@ from neo4jdriver.connection import get_connection
 
 logger = logging.getLogger(__name__)
 
+# Whether every environment has a snapshot valid at $time
+SNAPSHOT_USABLE_QUERY = """
+    MATCH (e:Environment)
+    OPTIONAL MATCH (s:Snapshot {environment: e.account_number_name})
+    WHERE s.time <= $time < s.until
+    RETURN count(e) AS environments, count(s) AS snapshots
+"""
+
+
+class CypherCache:
+    """Bounded least recently used cache of compiled cypher."""
+
+    def __init__(self, maxsize=512):
+        """Init the cache.
+
+        :param maxsize: Maximum number of query strings to keep
+        :type maxsize: int
+        """
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """Get the cypher for a key, building it on a miss.
+
+        :param key: Query signature
+        :type key: tuple
+        :param build: Callable returning the cypher string
+        :type build: callable
+        :returns: Cypher query string
+        :rtype: str
+        """
+        with self._lock:
+            cypher = self._entries.get(key)
+            if cypher is not None:
+                self._entries.move_to_end(key)
+                return cypher
+
+        cypher = build()
+        with self._lock:
+            self._entries[key] = cypher
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return cypher
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+cypher_cache = CypherCache()
+
+
+@lru_cache(maxsize=None)
+def _property_var(label, prop):
+    """Validate a property of a label and find the variable holding it.
+
+    Only successful lookups are cached. Invalid lookups raise each time.
+
+    :param label: Label with the property
+    :type label: str
+    :param prop: Name of the property
+    :type prop: str
+    :returns: Variable name of the node or state with the property
+    :rtype: str
+    """
+    valid_properties = registry.properties(label)
+    if not valid_properties:
+        raise InvalidLabelError(label)
+
+    if prop not in valid_properties:
+        raise InvalidPropertyError(label, prop)
+
+    if prop in registry.state_properties(label):
+        return '{}_state'.format(label.lower())
+    return label.lower()
+
 
 class Query:
 
@@ -25,13 +113,15 @@ class Query:
         self.params = {}
 
         self._count = None
+        self.count_exact = True
 
         # List of relationship time conditions
         self.time_wheres = []
 
-        # List of filter conditions
+        # List of filter conditions and (label, prop, operator) tuples
         self.filter_count = 0
         self.filter_wheres = []
+        self._filters = []
 
         self.matches = []
         self.rels = []
@@ -48,6 +138,13 @@ class Query:
         self._skip = None
         self._limit = None
 
+        # Order values of the last seen record for keyset pagination
+        self._seek = None
+
+        # Whether to read materialised snapshot rows when possible
+        self._snapshots = False
+        self._snapshot_usable = None
+
     def time(self, timestamp):
         """Update the time parameter
 
@@ -124,23 +221,14 @@ class Query:
         if label is None:
             label = self.label
 
-        valid_properties = registry.properties(label)
-        if not valid_properties:
-            raise InvalidLabelError(label)
-
-        if prop not in registry.properties(label):
-            raise InvalidPropertyError(prop, label)
-
-        if prop in registry.state_properties(label):
-            label = '{}_state'.format(label)
-
         condition = '{}.{} {} {}'.format(
-            label.lower(),
+            _property_var(label, prop),
             prop,
             operator,
             '$filterval{}'.format(self.filter_count)
         )
         self.filter_wheres.append(condition)
+        self._filters.append((label, prop, operator))
 
         self.params['filterval{}'.format(self.filter_count)] = value
         self.filter_count += 1
@@ -186,22 +274,121 @@ class Query:
         if label is None:
             label = self.label
 
-        # Make sure label is valid
-        model = registry.models.get(label)
-        if model is None:
-            raise InvalidLabelError(label)
+        # Validates the property and checks if it is part of the state
+        varname = _property_var(label, prop)
+
+        self._orderby.append((varname, prop, direction, label))
 
-        # Make sure property is valid
-        if prop not in registry.properties(label):
-            raise InvalidPropertyError(label, prop)
+    def _orders(self):
+        """Get order by tuples ending with the target identity.
 
-        # Check if property is part of the state of the model
-        if prop in registry.state_properties(label):
-            varname = '{}_state'.format(label.lower())
+        The identity property of the target label is appended as a tie
+        breaker so that the ordering is total and can be seeked.
+
+        :returns: List of (varname, prop, direction, label) tuples
+        :rtype: list
+        """
+        identity_prop = registry.identity_property(self.label)
+        varname = self.label.lower()
+        orders = list(self._orderby)
+        for ob_varname, ob_prop, _, _ in orders:
+            if ob_varname == varname and ob_prop == identity_prop:
+                break
         else:
-            varname = label.lower()
+            orders.append((varname, identity_prop, 'ASC', self.label))
+        return orders
+
+    def cursor(self, record):
+        """Create an opaque cursor pointing after a fetched record.
+
+        :param record: Record returned from fetch or page
+        :type record: dict
+        :returns: Cursor string
+        :rtype: str
+        """
+        values = [
+            record[label].get(prop)
+            for _, prop, _, label in self._orders()
+        ]
+        raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+
+    def seek(self, cursor):
+        """Only match records ordered after the cursor.
+
+        Must be called after all orderby calls since the cursor holds
+        one value per order.
+
+        :param cursor: Cursor created by cursor()
+        :type cursor: str
+        :returns: Modified self
+        :rtype: Query
+        """
+        if cursor is None:
+            self._seek = None
+            return self
 
-        self._orderby.append((varname, prop, direction))
+        try:
+            raw = base64.urlsafe_b64decode(cursor.encode('ascii'))
+            values = json.loads(raw.decode('utf-8'))
+        except (ValueError, TypeError, UnicodeError):
+            raise InvalidCursorError(cursor)
+
+        if not isinstance(values, list) or \
+                len(values) != len(self._orders()):
+            raise InvalidCursorError(cursor)
+
+        for i, value in enumerate(values):
+            if value is not None:
+                self.params['cursor{}'.format(i)] = value
+        self._seek = values
+        return self
+
+    def _seek_condition(self, prefix='', ref_func=None):
+        """Create condition matching records after the seek values.
+
+        Neo4j sorts nulls last when ascending and first when descending
+        so null values get explicit conditions.
+
+        :param prefix: Prefix for variable references, e.g. 'row.'
+        :type prefix: str
+        :param ref_func: Optional function of an order tuple returning
+            the reference to compare. Overrides prefix.
+        :type ref_func: callable
+        :returns: Condition or None if not seeking
+        :rtype: str|None
+        """
+        if self._seek is None:
+            return None
+
+        disjuncts = []
+        equals = []
+        for i, order in enumerate(self._orders()):
+            ob_varname, ob_prop, ob_dir, _ = order
+            if ref_func is not None:
+                ref = ref_func(order)
+            else:
+                ref = '{}{}.{}'.format(prefix, ob_varname, ob_prop)
+            param = '$cursor{}'.format(i)
+            desc = ob_dir.upper() == 'DESC'
+            if self._seek[i] is None:
+                after = '{} IS NOT NULL'.format(ref) if desc else None
+                equal = '{} IS NULL'.format(ref)
+            else:
+                if desc:
+                    after = '{} < {}'.format(ref, param)
+                else:
+                    after = '({} > {} OR {} IS NULL)'.format(ref, param, ref)
+                equal = '{} = {}'.format(ref, param)
+            if after is not None:
+                disjuncts.append(' AND '.join(equals + [after]))
+            equals.append(equal)
+
+        if not disjuncts:
+            return 'false'
+        return '({})'.format(' OR '.join(
+            '({})'.format(d) for d in disjuncts
+        ))
 
     def skip(self, n):
         """Set number of records to skip.
@@ -210,6 +397,7 @@ class Query:
         :type n: int
         """
         self._skip = n
+        self.params['skip'] = n
 
     def limit(self, n):
         """Set number of records to limit result set to
@@ -218,6 +406,121 @@ class Query:
         :type n: int
         """
         self._limit = n
+        self.params['limit'] = n
+
+    def snapshots(self, enabled=True):
+        """Read materialised snapshot rows when they cover the time.
+
+        :param enabled: Whether snapshots may be used
+        :type enabled: bool
+        :returns: Modified self
+        :rtype: Query
+        """
+        self._snapshots = enabled
+        self._snapshot_usable = None
+        return self
+
+    def _use_snapshot(self):
+        """Check if the query can be answered from snapshots.
+
+        Snapshots are usable when every environment has a snapshot valid
+        at the query time. The check runs once per query.
+
+        :returns: True if snapshot rows should be read
+        :rtype: bool
+        """
+        if not self._snapshots:
+            return False
+        if self._snapshot_usable is None:
+            record = self._fetch(SNAPSHOT_USABLE_QUERY).single()
+            self._snapshot_usable = (
+                record['environments'] > 0 and
+                record['environments'] == record['snapshots']
+            )
+        return self._snapshot_usable
+
+    def _snapshot_ref(self, label, prop):
+        """Reference a flattened property of a snapshot row.
+
+        :param label: Label with the property
+        :type label: str
+        :param prop: Name of the property
+        :type prop: str
+        :returns: Property reference
+        :rtype: str
+        """
+        return 'row.`{}.{}`'.format(label, prop)
+
+    def _snapshot_where_clause(self, seek=True):
+        """Create the match and where clauses of a snapshot query.
+
+        :param seek: Whether to include the keyset pagination condition
+        :type seek: bool
+        :returns: MATCH and WHERE clauses
+        :rtype: str
+        """
+        conditions = [
+            's.time <= $time < s.until',
+            "row.label = '{}'".format(self.label)
+        ]
+        for i, (label, prop, operator) in enumerate(self._filters):
+            conditions.append('{} {} $filterval{}'.format(
+                self._snapshot_ref(label, prop),
+                operator,
+                i
+            ))
+        if seek:
+            seek_condition = self._seek_condition(
+                ref_func=lambda o: self._snapshot_ref(o[3], o[1])
+            )
+            if seek_condition is not None:
+                conditions.append(seek_condition)
+
+        return \
+            'MATCH (s:Snapshot)-[:HAS_ROW]->(row:SnapshotRow)' + \
+            ' \nWHERE ' + ' AND '.join(conditions)
+
+    def _snapshot_str(self):
+        """Create the cypher query reading snapshot rows.
+
+        :returns: Cypher query string
+        :rtype: str
+        """
+        ob = [
+            '{} {}'.format(self._snapshot_ref(label, prop), direction)
+            for _, prop, direction, label in self._orders()
+        ]
+        return \
+            self._snapshot_where_clause() + \
+            ' \nRETURN row' + \
+            ' \nORDER BY ' + ', '.join(ob) + \
+            self._skip_clause() + \
+            self._limit_clause()
+
+    def _snapshot_count_str(self):
+        """Create the cypher query counting snapshot rows.
+
+        :returns: Cypher query string
+        :rtype: str
+        """
+        return \
+            self._snapshot_where_clause(seek=False) + \
+            ' \nRETURN count(*) as total'
+
+    def _snapshot_row(self, node):
+        """Split a flattened snapshot row into a row keyed by label.
+
+        :param node: Snapshot row node or map
+        :type node: neo4j.Node|dict
+        :returns: Row of label -> properties
+        :rtype: dict
+        """
+        row = {label: {} for label in self.return_labels}
+        for key, value in node.items():
+            label, _, prop = key.partition('.')
+            if prop and label in row:
+                row[label][prop] = value
+        return row
 
     def _match_clause(self):
         """Create match clause(s)
@@ -242,9 +545,11 @@ class Query:
             )
         return cypher
 
-    def _where_clause(self):
+    def _where_clause(self, seek=True):
         """Create where clause.
 
+        :param seek: Whether to include the keyset pagination condition
+        :type seek: bool
         :returns: WHERE clause
         :rtype: str
         """
@@ -253,6 +558,10 @@ class Query:
         # Add conditions for wheres
         conditions = [] + self.filter_wheres
 
+        seek_condition = self._seek_condition() if seek else None
+        if seek_condition is not None:
+            conditions.append(seek_condition)
+
         # Add time conditions for path
         for relvar, relname, relstr in self.rels:
             conditions.append(
@@ -275,21 +584,29 @@ class Query:
         cypher += ' AND '.join(conditions)
         return cypher
 
-    def _return_clause(self):
-        """Create return clause of query.
+    def _return_vars(self):
+        """Get variable names of returned nodes and states.
 
-        :returns: Return clause of query
-        :rtype: str
+        :returns: List of variable names
+        :rtype: list
         """
-        # Return clause
-        cypher = ' \nRETURN '
         returns = []
         for label in self.return_labels:
             returns.append(label.lower())
             model = registry.models[label]
             if model.state_properties:
                 returns.append('{}_state'.format(label.lower()))
-        cypher += ', '.join(r for r in returns)
+        return returns
+
+    def _return_clause(self):
+        """Create return clause of query.
+
+        :returns: Return clause of query
+        :rtype: str
+        """
+        # Return clause
+        cypher = ' \nRETURN '
+        cypher += ', '.join(r for r in self._return_vars())
         return cypher
 
     def _orderby_clause(self):
@@ -300,15 +617,9 @@ class Query:
         """
         cypher = ' \nORDER BY '
 
-        # Default to ordering by identity property
+        # Defaults to ordering by identity property
         ob = []
-        if not self._orderby:
-            self.orderby(
-                registry.identity_property(self.label),
-                'ASC',
-                label=self.label
-            )
-        for ob_varname, ob_prop, ob_dir in self._orderby:
+        for ob_varname, ob_prop, ob_dir, _ in self._orders():
             ob.append('{}.{} {}'.format(ob_varname, ob_prop, ob_dir))
         cypher += ', '.join(ob)
         return cypher
@@ -322,7 +633,7 @@ class Query:
         if self._skip is None:
             return ""
         else:
-            return " \nSKIP {}".format(self._skip)
+            return " \nSKIP $skip"
 
     def _limit_clause(self):
         """Create the limit clause
@@ -333,31 +644,137 @@ class Query:
         if self._limit is None:
             return ""
         else:
-            return " \nLIMIT {}".format(self._limit)
+            return " \nLIMIT $limit"
+
+    def approximate_count(self, stats):
+        """Estimate the number of records from cardinality statistics.
+
+        Only queries without filters, or filtered only by equality on
+        the identity of the path root, can be estimated.
 
-    def count(self):
+        :param stats: Statistics from api.tasks.cardinality()
+        :type stats: dict|None
+        :returns: Estimated number of records or None
+        :rtype: int|None
+        """
+        if not stats:
+            return None
+
+        label_stats = stats.get('labels', {}).get(self.label)
+        if label_stats is None:
+            return None
+
+        if not self._filters:
+            return label_stats['total']
+
+        if len(self._filters) == 1:
+            label, prop, operator = self._filters[0]
+            root = self.matches[0][1]
+            if label == root and operator == '=' and \
+                    prop == registry.identity_property(root):
+                return label_stats['environments'].get(
+                    self.params['filterval0'],
+                    0
+                )
+        return None
+
+    def count(self, stats=None):
         """Counts total number of records without skip and orderby.
 
-        Useful for pagination.
+        Useful for pagination. When stats can estimate the count it is
+        used instead of querying and count_exact is set to False.
 
+        :param stats: Optional statistics from api.tasks.cardinality()
+        :type stats: dict|None
         :returns: Total number of records in the query
         :rtype: int
         """
         if self._count is not None:
             return self._count
 
-        query_str = \
-            self._match_clause() + \
-            self._where_clause() + \
-            ' \nRETURN DISTINCT count(*) as total'
+        approximate = self.approximate_count(stats)
+        if approximate is not None:
+            self.count_exact = False
+            self._count = approximate
+            return self._count
+
+        if self._use_snapshot():
+            query_str = cypher_cache.get(
+                ('snapshot_count',) + self.signature(),
+                self._snapshot_count_str
+            )
+            self._count = self._fetch(query_str).single()['total']
+            return self._count
+
+        query_str = cypher_cache.get(
+            ('count',) + self.signature(),
+            lambda: (
+                self._match_clause() +
+                self._where_clause(seek=False) +
+                ' \nRETURN DISTINCT count(*) as total'
+            )
+        )
         resp = self._fetch(query_str)
         record = resp.single()
         self._count = record['total']
         return self._count
 
+    def count_by_root(self):
+        """Count records grouped by the identity of the path root.
+
+        :returns: Dict of root identity -> number of records
+        :rtype: dict
+        """
+        root = self.matches[0][1]
+        query_str = cypher_cache.get(
+            ('count_by_root',) + self.signature(),
+            lambda: (
+                self._match_clause() +
+                self._where_clause(seek=False) +
+                ' \nRETURN {}.{} AS root, count(*) AS total'.format(
+                    root.lower(),
+                    registry.identity_property(root)
+                )
+            )
+        )
+        return {
+            record['root']: record['total']
+            for record in self._fetch(query_str)
+        }
+
+    def signature(self):
+        """Describe the structure of the query independent of params.
+
+        Queries with equal signatures compile to the same cypher and
+        differ only in params, so neo4j can reuse its cached plan.
+
+        :returns: Hashable signature
+        :rtype: tuple
+        """
+        seek = None
+        if self._seek is not None:
+            seek = tuple(value is None for value in self._seek)
+        return (
+            self.label,
+            tuple(self.return_labels),
+            tuple(self.filter_wheres),
+            tuple((v, p, d) for v, p, d, _ in self._orders()),
+            seek,
+            self._skip is not None,
+            self._limit is not None
+        )
+
     def __str__(self):
         """Create the cypher query
 
+        :returns: Cypher query string
+        :rtype: str
+        """
+        return cypher_cache.get(('page',) + self.signature(), self._compile)
+
+    def _compile(self):
+        """Build the cypher query from its clauses.
+
         :returns: Cypher query string
         :rtype: str
         """
@@ -381,32 +798,197 @@ class Query:
                 resp = tx.run(query_str, **self.params)
                 return resp
 
-    def fetch(self):
-        resp = self._fetch(str(self))
-        rows = []
-        for record in resp:
-            row = {}
-            for label in self.return_labels:
-                obj = {}
-                for key, value in record[label.lower()].items():
+    def _row(self, values):
+        """Merge returned nodes and states into a row keyed by label.
+
+        :param values: Record or map keyed by variable name
+        :type values: neo4j.Record|dict
+        :returns: Row of label -> properties
+        :rtype: dict
+        """
+        row = {}
+        for label in self.return_labels:
+            obj = {}
+            for key, value in values[label.lower()].items():
+                obj[key] = value
+            if registry.state_properties(label):
+                state_key = '{}_state'.format(label.lower())
+                for key, value in values[state_key].items():
                     obj[key] = value
-                if registry.state_properties(label):
-                    state_key = '{}_state'.format(label.lower())
-                    for key, value in record[state_key].items():
-                        obj[key] = value
-                row[label] = obj
-            rows.append(row)
-        return rows
+            row[label] = obj
+        return row
 
-    def page(self, page=1, pagesize=100, index=None):
+    def _rows_str(self):
+        """Get the cypher query and row builder for fetching rows.
+
+        :returns: Tuple of query string and function of a record
+        :rtype: tuple
+        """
+        if self._use_snapshot():
+            query_str = cypher_cache.get(
+                ('snapshot',) + self.signature(),
+                self._snapshot_str
+            )
+            return query_str, lambda record: self._snapshot_row(record['row'])
+        return str(self), self._row
+
+    def fetch(self):
+        query_str, build = self._rows_str()
+        resp = self._fetch(query_str)
+        return [build(record) for record in resp]
+
+    def iter_rows(self):
+        """Lazily iterate over rows of the query.
+
+        The query runs in an auto commit transaction on a session that
+        stays open while iterating, so records are pulled from the
+        connection as they are consumed rather than buffered up front.
+
+        :yields: Row of label -> properties
+        :ytype: dict
+        """
+        query_str, build = self._rows_str()
+        logger.debug("Streaming query:")
+        logger.debug(query_str)
+
+        with get_connection().session() as session:
+            for record in session.run(query_str, **self.params):
+                yield build(record)
+
+    def _page_skip(self, page, pagesize, index):
+        """Compute the number of records to skip for a page.
+
+        :param page: Page number starting at 1
+        :type page: int
+        :param pagesize: Number of records per page
+        :type pagesize: int
+        :param index: Optional 1 based record index overriding page
+        :type index: int
+        :returns: Number of records to skip
+        :rtype: int
+        """
         if index is not None:
-            skip = max(index - 1, 0)
-        else:
-            skip = (page - 1) * pagesize
-        self.skip(skip)
+            return max(index - 1, 0)
+        return (page - 1) * pagesize
+
+    def page(self, page=1, pagesize=100, index=None):
+        self.skip(self._page_skip(page, pagesize, index))
         self.limit(pagesize)
         return self.fetch()
 
+    def _page_and_count_str(self):
+        """Create the cypher query for page_and_count.
+
+        Matching records are ordered and collected up to $countcap. The
+        total is the size of the collection and the page is sliced out
+        of it after applying any seek condition.
+
+        :returns: Cypher query string
+        :rtype: str
+        """
+        returns = self._return_vars()
+        cypher = \
+            self._match_clause() + \
+            self._where_clause(seek=False) + \
+            ' \nWITH ' + ', '.join(returns) + \
+            self._orderby_clause() + \
+            ' \nLIMIT $countcap' + \
+            ' \nWITH collect({' + \
+            ', '.join('{0}: {0}'.format(r) for r in returns) + \
+            '}) AS rows'
+
+        rows = 'rows'
+        seek_condition = self._seek_condition(prefix='row.')
+        if seek_condition is not None:
+            rows = '[row IN rows WHERE {}]'.format(seek_condition)
+
+        cypher += \
+            ' \nWITH size(rows) AS total, ' + \
+            '{}[$skip..$skip + $limit] AS page'.format(rows) + \
+            ' \nUNWIND CASE WHEN size(page) = 0 ' + \
+            'THEN [null] ELSE page END AS row' + \
+            ' \nRETURN total, row'
+        return cypher
+
+    def page_and_count(self, page=1, pagesize=100, index=None, cap=10000):
+        """Fetch a page of records and the total count in one query.
+
+        Only cap records are collected to compute the total. When the
+        cap is reached the total is unknown and count() is run instead,
+        along with fetch() if the page extends past the collected records.
+        When snapshots are used the page and count are read separately
+        since counting snapshot rows is cheap.
+
+        :param page: Page number starting at 1
+        :type page: int
+        :param pagesize: Number of records per page
+        :type pagesize: int
+        :param index: Optional 1 based record index overriding page
+        :type index: int
+        :param cap: Maximum number of records to collect for counting
+        :type cap: int
+        :returns: Tuple of records and total count
+        :rtype: tuple
+        """
+        self.skip(self._page_skip(page, pagesize, index))
+        self.limit(pagesize)
+        self.params['countcap'] = cap
+
+        if self._use_snapshot():
+            records = self.fetch()
+            return records, self.count()
+
+        total = 0
+        records = []
+        query_str = cypher_cache.get(
+            ('page_and_count',) + self.signature(),
+            self._page_and_count_str
+        )
+        for record in self._fetch(query_str):
+            total = record['total']
+            if record['row'] is not None:
+                records.append(self._row(record['row']))
+
+        # Pages past the cap may have been cut short by the collection.
+        if total >= cap:
+            total = self.count()
+            if len(records) < pagesize:
+                records = self.fetch()
+        else:
+            self._count = total
+        return records, total
+
+
+# Change times of roots maintained by sync
+TIMELINE_QUERY = """
+    MATCH (t:Timeline {label: $label, identity: $identity})
+    RETURN t.times AS times
+"""
+
+# Data versions of roots incremented by sync whenever data changes
+DATA_VERSION_QUERY = """
+    MATCH (t:Timeline)
+    WHERE $identity IS NULL OR t.identity = $identity
+    RETURN coalesce(sum(t.version), 0) AS version
+"""
+
+
+def data_version(identity=None):
+    """Get the data version of a root or of all roots.
+
+    Versions only increase so a cached result keyed on a version stays
+    valid until the data it was computed from changes.
+
+    :param identity: Optional identity of a root such as an environment
+    :type identity: str
+    :returns: Data version
+    :rtype: int
+    """
+    with get_connection().session() as session:
+        with session.begin_transaction() as tx:
+            record = tx.run(DATA_VERSION_QUERY, identity=identity).single()
+            return record['version']
+
 
 class TimesQuery:
     """Class for querying the times an object tree has changed."""
@@ -427,14 +1009,274 @@ class TimesQuery:
         cypher += "\nORDER BY t DESC"
         return cypher
 
-    def _fetch(self):
-        q = str(self)
+    def _fetch(self, query_str=None):
+        q = query_str or str(self)
         logger.debug("Running query:\n{}".format(str(q)))
         with get_connection().session() as session:
             with session.begin_transaction() as tx:
-                resp = tx.run(q, **self.params)
+                resp = tx.run(q, label=self.label, **self.params)
                 return resp
 
+    def _timeline(self):
+        """Read the timeline maintained during sync for root labels.
+
+        :returns: Timestamps newest first or None if there is no timeline
+        :rtype: list|None
+        """
+        if self.label not in [n.label for n in registry.forest.roots]:
+            return None
+        for record in self._fetch(TIMELINE_QUERY):
+            if record['times'] is not None:
+                return list(record['times'])
+        return None
+
     def fetch(self):
-        times = [record['t'] for record in self._fetch()]
+        times = self._timeline()
+        if times is None:
+            times = [record['t'] for record in self._fetch()]
         return times
+
+
+class SubtreeQuery:
+    """Class for querying an object tree at two times in one traversal.
+
+    Each record holds a node reachable from the root at either time,
+    its parent on the path, which times the path is valid at, which
+    times the node is in the tree at through any path and the state of
+    the node at each of those times.
+
+    Relationships valid at neither time are cut while walking. Other
+    relationships are walked even when they span both times since the
+    graph keeps no marker of changes below a node, so the database reads
+    the tree valid at either time. Returning only changes saves records
+    sent back and the work of diffing them, not database reads.
+    """
+
+    def __init__(self, label, identity, left_time, right_time,
+                 prefix=None, walk=True, changed_only=False):
+        """Init the query
+
+        :param label: Label of the root of the tree
+        :type label: str
+        :param identity: Identity of the root
+        :type identity: str
+        :param left_time: First timestamp in milliseconds
+        :type left_time: int
+        :param right_time: Second timestamp in milliseconds
+        :type right_time: int
+        :param prefix: Optional relationship names leading from the root
+            to the only nodes to match or walk from
+        :type prefix: list
+        :param walk: Whether to walk the tree below the prefix or only
+            match the node at its end
+        :type walk: bool
+        :param changed_only: Whether to return only nodes that differ
+            between the times and their ancestors
+        :type changed_only: bool
+        """
+        self.label = label
+        self.identity = identity
+        self.prefix = prefix or []
+        self.walk = walk
+        self.changed_only = changed_only
+        self.params = {
+            'identity': identity,
+            'left': left_time,
+            'right': right_time,
+            'earliest': min(left_time, right_time),
+            'latest': max(left_time, right_time)
+        }
+
+    def _rel_types(self, nodes):
+        """Get names of relationships below forest nodes.
+
+        :param nodes: List of forest nodes to start from
+        :type nodes: list
+        :returns: Sorted list of relationship names
+        :rtype: list
+        """
+        relnames = set()
+        stack = list(nodes)
+        while stack:
+            node = stack.pop()
+            for relname, child in node.children.items():
+                if relname not in relnames:
+                    relnames.add(relname)
+                    stack.append(child)
+        return sorted(relnames)
+
+    def _var_rels(self, nodes):
+        """Create a variable length relationship below forest nodes.
+
+        :param nodes: List of forest nodes to start from
+        :type nodes: list
+        :returns: Relationship pattern
+        :rtype: str
+        """
+        rel_types = self._rel_types(nodes)
+        if rel_types:
+            return '-[:{}*0..]->'.format('|'.join(rel_types))
+        return '-[*0..0]->'
+
+    def _path(self):
+        """Create the path pattern from the root to each node.
+
+        :returns: Path pattern
+        :rtype: str
+        """
+        node = registry.forest.nodes[self.label]
+        path = "(root:{} {{{}: $identity}})".format(
+            self.label,
+            registry.identity_property(self.label)
+        )
+        for relname in self.prefix:
+            path += "-[:{}]->()".format(relname)
+            node = node.children[relname]
+        if self.walk:
+            return path + self._var_rels([node]) + "(n)"
+        return path + "-[*0..0]->(n)"
+
+    def partitions(self, depth=2):
+        """Split the query into independent queries of the same tree.
+
+        Nodes less than depth relationships below the root are matched
+        by their own queries and each subtree at depth is walked by
+        another. Walking the whole tree returns each node and parent pair
+        from one part. Querying only changes also returns the ancestors
+        of the changes in each part, so callers must merge repeats.
+
+        :param depth: Number of relationships below the root to split at
+        :type depth: int
+        :returns: List of queries
+        :rtype: list
+        """
+        parts = []
+        stack = [([], registry.forest.nodes[self.label])]
+        while stack:
+            prefix, node = stack.pop()
+            if len(prefix) == depth or not node.children:
+                parts.append((prefix, True))
+                continue
+            parts.append((prefix, False))
+            for relname in sorted(node.children, reverse=True):
+                stack.append((prefix + [relname], node.children[relname]))
+
+        return [
+            SubtreeQuery(
+                self.label,
+                self.identity,
+                self.params['left'],
+                self.params['right'],
+                prefix=prefix,
+                walk=walk,
+                changed_only=self.changed_only
+            )
+            for prefix, walk in parts
+        ]
+
+    def _changed_str(self):
+        """Create the part of the query keeping only changed paths.
+
+        A node differs when its path is not valid at both times or one
+        of its states starts or ends between the times. Every node on
+        the path of a differing node is then returned once per parent.
+
+        A node returned through a changed path may still be in the tree
+        through another parent, like a package removed from one host but
+        kept by another. Whether the node is in the tree at each time is
+        therefore checked over every path from the root, upwards from
+        the node so only its ancestors are expanded.
+
+        :returns: Partial cypher query
+        :rtype: str
+        """
+        cypher = "\nWITH p, n, on_left, on_right"
+        cypher += "\nWHERE NOT (on_left AND on_right)"
+        cypher += "\n    OR any(hs IN [(n)-[s:HAS_STATE]->() | s]"
+        cypher += " WHERE $earliest < hs.from <= $latest"
+        cypher += " OR $earliest < hs.to <= $latest)"
+        cypher += "\nUNWIND range(0, length(p)) AS i"
+        cypher += "\nWITH DISTINCT nodes(p)[0] AS root, nodes(p)[i] AS n,"
+        cypher += "\n    CASE WHEN i = 0 THEN null"
+        cypher += " ELSE nodes(p)[i - 1] END AS parent,"
+        cypher += "\n    relationships(p)[0..i] AS rels"
+        cypher += "\nWITH root, n, parent,"
+        cypher += "\n    all(r IN rels"
+        cypher += " WHERE r.from <= $left < r.to) AS on_left,"
+        cypher += "\n    all(r IN rels"
+        cypher += " WHERE r.from <= $right < r.to) AS on_right"
+        cypher += "\nWITH n, parent, on_left, on_right,"
+        cypher += "\n    {} AS in_left,".format(self._in_tree_str('left'))
+        cypher += "\n    {} AS in_right".format(self._in_tree_str('right'))
+        return cypher
+
+    def _in_tree_str(self, side):
+        """Create an expression checking a node is in the tree at a time.
+
+        :param side: Parameter holding the time (left|right)
+        :type side: str
+        :returns: Partial cypher expression
+        :rtype: str
+        """
+        rel_types = self._rel_types([registry.forest.nodes[self.label]])
+        if rel_types:
+            rels = '<-[:{}*0..]-'.format('|'.join(rel_types))
+        else:
+            rels = '<-[*0..0]-'
+        cypher = "CASE WHEN on_{0} THEN true"
+        cypher += " ELSE size([q = (n){1}(root)"
+        cypher += " WHERE all(r IN relationships(q)"
+        cypher += " WHERE r.from <= ${0} < r.to) | 1]) > 0 END"
+        return cypher.format(side, rels)
+
+    def _states_str(self):
+        """Create the part of the query matching states at both times.
+
+        :returns: Partial cypher query
+        :rtype: str
+        """
+        cypher = "\nOPTIONAL MATCH (n)-[ls:HAS_STATE]->(left_state)"
+        cypher += "\nWHERE in_left AND ls.from <= $left < ls.to"
+        cypher += "\nOPTIONAL MATCH (n)-[rs:HAS_STATE]->(right_state)"
+        cypher += "\nWHERE in_right AND rs.from <= $right < rs.to"
+        return cypher
+
+    def __str__(self):
+        cypher = "MATCH p = {}".format(self._path())
+        # Relationships valid at neither time lead to no path valid at
+        # either, so they are cut while walking.
+        cypher += "\nWHERE all(r IN relationships(p)"
+        cypher += " WHERE r.from <= $left < r.to"
+        cypher += " OR r.from <= $right < r.to)"
+        cypher += "\nWITH p, n,"
+        cypher += "\n    all(r IN relationships(p)"
+        cypher += " WHERE r.from <= $left < r.to) AS on_left,"
+        cypher += "\n    all(r IN relationships(p)"
+        cypher += " WHERE r.from <= $right < r.to) AS on_right"
+        cypher += "\nWHERE on_left OR on_right"
+        if self.changed_only:
+            cypher += self._changed_str()
+        else:
+            cypher += "\nWITH n, on_left, on_right,"
+            cypher += " on_left AS in_left, on_right AS in_right,"
+            cypher += "\n    CASE WHEN length(p) = 0 THEN null"
+            cypher += " ELSE nodes(p)[-2] END AS parent"
+        cypher += self._states_str()
+        cypher += "\nRETURN head(labels(n)) AS label, n AS node,"
+        cypher += "\n    head(labels(parent)) AS parent_label, parent,"
+        cypher += "\n    on_left, on_right, in_left, in_right,"
+        cypher += "\n    left_state, right_state"
+        return cypher
+
+    def iter_records(self):
+        """Lazily iterate over records of the tree.
+
+        :yields: Record with label, node, parent_label, parent, on_left,
+            on_right, in_left, in_right, left_state and right_state
+        :ytype: neo4j.Record
+        """
+        q = str(self)
+        logger.debug("Streaming query:\n{}".format(q))
+        with get_connection().session() as session:
+            for record in session.run(q, **self.params):
+                yield record
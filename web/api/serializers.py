@@ -5,12 +5,15 @@ from rest_framework.serializers import BaseSerializer
 from rest_framework.serializers import Serializer
 from rest_framework.serializers import ChoiceField
 from rest_framework.serializers import CharField
+from rest_framework.serializers import DictField
 from rest_framework.serializers import IntegerField
 from rest_framework.serializers import ListField
 from rest_framework.serializers import SlugField
 
 from rest_framework.serializers import ValidationError
 
+from .drift import FEATURES
+
 
 logger = logging.getLogger(__name__)
 
@@ -79,6 +82,7 @@ class SearchSerializer(Serializer):
     page = IntegerField(min_value=0, required=False, default=1)
     pagesize = IntegerField(min_value=1, required=False, default=500)
     index = IntegerField(min_value=0, required=False)
+    cursor = CharField(max_length=4096, required=False)
 
     def validate(self, data):
         model_set = set([t[0] for t in registry.path(data['model'])])
@@ -121,6 +125,32 @@ class SearchSerializer(Serializer):
         return data
 
 
+class ExportSerializer(SearchSerializer):
+    """Serializer for exporting all results of a search."""
+    format = ChoiceField(['ndjson', 'csv'], required=False, default='ndjson')
+
+
+class BatchSearchSerializer(Serializer):
+    """Serializer for a list of search queries.
+
+    Each search is validated separately with a SearchSerializer so that
+    one invalid search does not fail the batch.
+    """
+    max_searches = 20
+
+    searches = ListField(child=DictField(), required=True)
+
+    def validate_searches(self, value):
+        if not value:
+            raise ValidationError('At least one search is required.')
+        if len(value) > self.max_searches:
+            raise ValidationError(
+                'No more than {} searches are allowed.'
+                .format(self.max_searches)
+            )
+        return value
+
+
 class TimesChangedSerializer(Serializer):
     """Serializer for detailed query of one object."""
     model = ChoiceField([m.label for m in registry.models.values()])
@@ -154,3 +184,65 @@ class DiffNodeSerializer(Serializer):
     right_time = IntegerField(min_value=0, required=True)
     node_model = ChoiceField([m.label for m in registry.models.values()])
     node_identity = CharField(max_length=256, required=True)
+
+
+class CrossDiffSerializer(Serializer):
+    """Serializer for requesting structure of a diff of two objects."""
+    model = ChoiceField([m.label for m in registry.models.values()])
+    left_identity = CharField(max_length=256, required=True)
+    right_identity = CharField(max_length=256, required=True)
+    left_time = IntegerField(min_value=0, required=True)
+    right_time = IntegerField(min_value=0, required=True)
+    keys = DictField(child=CharField(max_length=256), required=False)
+    aliases = DictField(
+        child=DictField(child=CharField(max_length=256)),
+        required=False
+    )
+
+    def validate_keys(self, value):
+        for model, prop in value.items():
+            if model not in registry.models:
+                raise ValidationError('Unknown model {}'.format(model))
+            if prop not in registry.properties(model):
+                raise ValidationError(
+                    'Model {} does not have property {}'.format(model, prop)
+                )
+        return value
+
+    def validate_aliases(self, value):
+        for model in value:
+            if model not in registry.models:
+                raise ValidationError('Unknown model {}'.format(model))
+        return value
+
+
+class CrossDiffNodesSerializer(CrossDiffSerializer):
+    """Serializer for requesting a range of nodes of a diff of two objects."""
+    offset = IntegerField(min_value=0, required=True)
+    limit = IntegerField(min_value=1, required=True)
+
+
+class CrossDiffNodeSerializer(CrossDiffSerializer):
+    """Serializer for requesting a node of a diff of two objects."""
+    node_model = ChoiceField([m.label for m in registry.models.values()])
+    node_identity = CharField(max_length=1024, required=True)
+
+
+class DriftSerializer(Serializer):
+    """Serializer for requesting structure of a drift report."""
+    identity = CharField(max_length=256, required=True)
+    time = IntegerField(min_value=0, required=True)
+    labels = ListField(child=ChoiceField(sorted(FEATURES)), required=False)
+    hostnames = ListField(child=CharField(max_length=256), required=False)
+
+
+class DriftNodesSerializer(DriftSerializer):
+    """Serializer for requesting a range of nodes of a drift report."""
+    offset = IntegerField(min_value=0, required=True)
+    limit = IntegerField(min_value=1, required=True)
+
+
+class DriftNodeSerializer(DriftSerializer):
+    """Serializer for requesting a node of a drift report."""
+    node_model = ChoiceField(['Environment', 'Host'])
+    node_identity = CharField(max_length=256, required=True)
@@ -1,25 +1,50 @@
 from __future__ import absolute_import, unicode_literals
 
 import logging
+import threading
 
 from celery import shared_task
+from celery import states
 from celery.exceptions import TimeoutError as CeleryTimeoutError
+from celery.utils import uuid
 
+from cloud_snitch import utils
+from cloud_snitch.models import registry
+from django.conf import settings
 from django.core.cache import cache
 
 from .cache import cache_key
+from .cache import compress
+from .cache import decompress
+from .diff import CrossDiff
 from .diff import Diff
 from .diff import DiffResult
+from .diff import LEFT
+from .diff import PagedDiffResult
+from .diff import RIGHT
+from .diff import Side
+from .drift import Drift
 
 from .exceptions import JobError
 from .exceptions import JobRunningError
 
+from .query import Query
+
 
 logger = logging.getLogger(__name__)
 STATUS_RUNNING = 1
 STATUS_ERROR = 2
 TIMEOUT = 60 * 60 * 24
 ERROR_TIMEOUT = 60 * 5
+PARTIAL_TIMEOUT = 60 * 30
+
+# A claim on a job lasts QUEUE_TIMEOUT until a worker picks it up. The
+# worker then holds it for LEASE_TIMEOUT and renews it every LEASE_RENEW
+# seconds, so a crashed worker only blocks the job for LEASE_TIMEOUT.
+QUEUE_TIMEOUT = 60 * 10
+LEASE_TIMEOUT = 60
+LEASE_RENEW = 20
+CARDINALITY_TIMEOUT = 60 * 30
 
 
 def _diff_cache_key(model, identity, left_time, right_time):
@@ -44,8 +69,327 @@ def _diff_cache_key(model, identity, left_time, right_time):
     return key
 
 
-@shared_task
-def _diffdict(model, identity, left_time, right_time):
+def _crossdiff_cache_key(model, left_identity, right_identity,
+                         left_time, right_time, keys, aliases=None):
+    """Compute the cache key for a diff of two identities.
+
+    :param model: Name of the model
+    :type model: str
+    :param left_identity: Id of the object on the left side
+    :type left_identity: str
+    :param right_identity: Id of the object on the right side
+    :type right_identity: str
+    :param left_time: Milliseconds since epoch on left side
+    :type left_time: int
+    :param right_time: Milliseconds since epoch on right side
+    :type right_time: int
+    :param keys: Model -> property overriding default natural keys
+    :type keys: dict
+    :param aliases: Model -> natural key on the right -> natural key on
+        the left
+    :type aliases: dict|None
+    :returns: Cache key for the diff
+    :rtype: str
+    """
+    args = (model, left_identity, right_identity, left_time, right_time)
+    if aliases:
+        args += (sorted(
+            (label, sorted(names.items()))
+            for label, names in aliases.items()
+        ),)
+    return cache_key(args, keys, prefix='crossdiffdict')
+
+
+def _diff_page_key(key, generation, index):
+    """Compute the cache key for a page of nodes of a diff.
+
+    :param key: Cache key of the diff header
+    :type key: str
+    :param generation: Generation of the header the page belongs to
+    :type generation: tuple
+    :param index: Index of the page
+    :type index: int
+    :returns: Cache key for the page
+    :rtype: str
+    """
+    return cache_key((key, generation, index), {}, prefix='diffpage')
+
+
+def _store_diff(key, result):
+    """Store a diff result as a compressed header and pages of nodes.
+
+    Pages are keyed by the progress of the result so a reader holding
+    an older partial header never mixes in pages of a newer one. Pages
+    are written before the header that refers to them.
+
+    :param key: Cache key of the diff header
+    :type key: str
+    :param result: Complete or partial result of the diff
+    :type result: DiffResult
+    """
+    progress = result.progress()
+    generation = (progress['done'], progress['complete'])
+    timeout = TIMEOUT if progress['complete'] else PARTIAL_TIMEOUT
+    header = result.header()
+    header['generation'] = generation
+
+    pages = {}
+    for index, page in enumerate(result.pages(header['pagesize'])):
+        pages[_diff_page_key(key, generation, index)] = compress(page)
+    if pages:
+        cache.set_many(pages, timeout)
+    cache.set(key, compress(header), timeout)
+
+
+def _load_diff(key, data):
+    """Create a result that reads pages of a stored diff on demand.
+
+    A missing page means it expired or was evicted. The header of a
+    complete diff is then removed so the diff is computed again.
+
+    :param key: Cache key of the diff header
+    :type key: str
+    :param data: Compressed header stored by _store_diff
+    :type data: bytes
+    :returns: Result of the diff
+    :rtype: diff.PagedDiffResult
+    """
+    header = decompress(data)
+
+    def loadpages(indexes):
+        keys = [
+            _diff_page_key(key, header['generation'], index)
+            for index in indexes
+        ]
+        found = cache.get_many(keys)
+        if len(found) < len(keys):
+            logger.debug("Diff pages missing.")
+            if header['progress']['complete']:
+                cache.delete(key)
+            raise JobRunningError()
+        return [decompress(found[k]) for k in keys]
+
+    return PagedDiffResult(header, loadpages)
+
+
+def _lease_key(key):
+    """Compute the cache key holding the claim on the job of a diff.
+
+    :param key: Cache key of the diff header
+    :type key: str
+    :returns: Cache key of the claim
+    :rtype: str
+    """
+    return cache_key((key,), {}, prefix='difflease')
+
+
+def _claim(key):
+    """Atomically claim the job computing a diff.
+
+    The claim is added only if absent so concurrent requests schedule
+    the job once.
+
+    :param key: Cache key of the diff header
+    :type key: str
+    :returns: Id for the task to schedule or None if already claimed
+    :rtype: str|None
+    """
+    task_id = uuid()
+    if cache.add(_lease_key(key), task_id, QUEUE_TIMEOUT):
+        return task_id
+    return None
+
+
+def _job_failed(key, task):
+    """Determine if the task holding the claim on a diff has failed.
+
+    The claim of a failed or revoked task is released so that the next
+    request schedules the job again.
+
+    :param key: Cache key of the diff header
+    :type key: str
+    :param task: Celery task computing the diff
+    :type task: celery.Task
+    :returns: True if the task failed
+    :rtype: bool
+    """
+    task_id = cache.get(_lease_key(key))
+    if task_id is None:
+        return False
+    if task.AsyncResult(task_id).state in states.PROPAGATE_STATES:
+        logger.debug("Task {} failed.".format(task_id))
+        cache.delete(_lease_key(key))
+        return True
+    return False
+
+
+class _Lease:
+    """Hold the claim on the job of a diff while a worker computes it.
+
+    The claim is renewed from a background thread and released when
+    the job finishes. Renewal stops if another task has taken over an
+    expired claim.
+    """
+
+    def __init__(self, key, task_id):
+        """Init the lease
+
+        :param key: Cache key of the diff header
+        :type key: str
+        :param task_id: Id of the running task or None if run directly
+        :type task_id: str|None
+        """
+        self.key = _lease_key(key)
+        self.task_id = task_id
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def renew(self):
+        """Extend the claim if it is still held by this task.
+
+        :returns: True if renewed
+        :rtype: bool
+        """
+        if cache.get(self.key) not in (None, self.task_id):
+            logger.debug("Lost claim {}.".format(self.key))
+            return False
+        cache.set(self.key, self.task_id, LEASE_TIMEOUT)
+        return True
+
+    def _run(self):
+        while not self.stopped.wait(LEASE_RENEW):
+            if not self.renew():
+                return
+
+    def __enter__(self):
+        if self.task_id is not None and self.renew():
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            if cache.get(self.key) == self.task_id:
+                cache.delete(self.key)
+
+
+def _read_diff(key):
+    """Read a stored diff from cache.
+
+    :param key: Cache key of the diff header
+    :type key: str
+    :returns: Complete or partial result or None if nothing is stored
+    :rtype: diff.DiffResult|None
+    """
+    cached = cache.get(key)
+
+    # Nothing computed yet. Older releases marked running jobs here.
+    if cached is None or cached == STATUS_RUNNING:
+        return None
+
+    # Raise error if job is in error state
+    elif cached == STATUS_ERROR:
+        logger.debug('CACHE HIT -- ERROR')
+        raise JobError()
+
+    # Diffs cached whole before results were stored in pages.
+    elif isinstance(cached, dict):
+        return DiffResult(cached)
+
+    # The result may be partial while the job is running.
+    return _load_diff(key, cached)
+
+
+def _cached_diff(key, task, *args):
+    """Get a diff from cache, scheduling the task computing it if needed.
+
+    While the job runs the partial result published so far is returned
+    once any part has been computed. The job is claimed atomically so it
+    is scheduled once, and scheduled again if its worker stops renewing
+    the claim before finishing.
+
+    :param key: Cache key of the diff header
+    :type key: str
+    :param task: Celery task computing and storing the diff
+    :type task: celery.Task
+    :param args: Arguments of the task
+    :type args: tuple
+    :returns: Result of cached diff operation
+    :rtype: diff.DiffResult
+    """
+    logger.debug("Looking up cache with key: {}".format(key))
+    result = _read_diff(key)
+    if result is not None and result.complete():
+        logger.debug("CACHE HIT")
+        return result
+
+    task_id = _claim(key)
+    if task_id is not None:
+        # The job may have finished after the first read.
+        result = _read_diff(key)
+        if result is not None and result.complete():
+            cache.delete(_lease_key(key))
+            return result
+
+        logger.debug("CACHE MISS -- scheduling {}".format(task_id))
+        async_result = task.apply_async(args, task_id=task_id)
+
+        # Wait an initial amount of time then serve whatever has been
+        # published so far. A failed task has stored its error status.
+        try:
+            async_result.get(timeout=2, propagate=False)
+        except CeleryTimeoutError:
+            logger.debug("Still running after initial wait.")
+        result = _read_diff(key)
+
+    elif _job_failed(key, task):
+        raise JobError()
+
+    # Raise error if job is still running and nothing is published.
+    if result is None:
+        logger.debug("CACHE HIT -- STILL RUNNING")
+        raise JobRunningError()
+    return result
+
+
+def _side_cache_key(model, identity, time):
+    """Compute the cache key for the tree of an object at a time.
+
+    :param model: Name of the model
+    :type model: str
+    :param identity: Id of an object
+    :type identity: str
+    :param time: Milliseconds since epoch
+    :type time: int
+    :returns: Cache key for the side
+    :rtype: str
+    """
+    return cache_key((model, identity, time), {}, prefix='diffside')
+
+
+def _load_side(model, identity, time):
+    """Get the cached tree of an object at a time.
+
+    :param model: Name of the model
+    :type model: str
+    :param identity: Id of an object
+    :type identity: str
+    :param time: Milliseconds since epoch
+    :type time: int
+    :returns: The side or None if not cached
+    :rtype: diff.Side|None
+    """
+    data = cache.get(_side_cache_key(model, identity, time))
+    if data is None:
+        return None
+    logger.debug("Reusing side of {} at {}".format(identity, time))
+    return Side.load(data)
+
+
+@shared_task(bind=True)
+def _diffdict(self, model, identity, left_time, right_time):
     """Asynchronous task for diffing an object.
 
     :param model: Name of the model
@@ -56,22 +400,47 @@ def _diffdict(model, identity, left_time, right_time):
     :type left_time: int
     :param right_time: Milliseconds since epoch on right side
     :type right_time: int
-    :returns: Result of diff operation
-    :rtype: DiffResult
+    :returns: Number of nodes in the diff
+    :rtype: int
     """
-    # Mark the diff as running to prevent multiple requests from sechduling
-    # the same job.
     key = _diff_cache_key(model, identity, left_time, right_time)
 
-    # Compute the diff.
-    try:
-        d = Diff(model, identity, left_time, right_time)
-        r = d.result()
-        cache.set(key, r.diffdict, TIMEOUT)
-        return r.diffdict
-    except Exception as e:
-        logger.exception('Unable to complete diff.')
-        cache.set(key, STATUS_ERROR, ERROR_TIMEOUT)
+    # Publish partial results so readers can show them early.
+    def publish(partial):
+        _store_diff(key, partial)
+
+    # Compute the diff reusing trees cached by diffs sharing a time.
+    # Diffs of two cached times, such as diff(t1, t3) after diff(t1, t2)
+    # and diff(t2, t3), are computed without the database. Caching the
+    # trees of a diff of two uncached times means fetching whole trees
+    # instead of the changes, so it can be disabled.
+    with _Lease(key, self.request.id):
+        try:
+            times = {LEFT: left_time, RIGHT: right_time}
+            d = Diff(
+                model,
+                identity,
+                left_time,
+                right_time,
+                progress=publish,
+                left_side=_load_side(model, identity, left_time),
+                right_side=_load_side(model, identity, right_time),
+                keep_sides=getattr(settings, 'DIFF_CACHE_SIDES', True)
+            )
+            for side, tree in d.sides.items():
+                cache.set(
+                    _side_cache_key(model, identity, times[side]),
+                    tree.dump(),
+                    TIMEOUT
+                )
+            d.sides = {}
+            r = d.result()
+            _store_diff(key, r)
+            return r.diffdict['nodecount']
+        except Exception:
+            logger.exception('Unable to complete diff.')
+            cache.set(key, STATUS_ERROR, ERROR_TIMEOUT)
+            raise
 
 
 def objectdiff(model, identity, left_time, right_time):
@@ -88,39 +457,256 @@ def objectdiff(model, identity, left_time, right_time):
     :returns: Result of cached diff operation
     :rtype: diff.DiffResult
     """
-    # Try to get from cache first
     key = _diff_cache_key(model, identity, left_time, right_time)
-    logger.debug("Looking up cache with key: {}".format(key))
-    cached = cache.get(key)
+    return _cached_diff(
+        key,
+        _diffdict,
+        model,
+        identity,
+        left_time,
+        right_time
+    )
+
 
-    # If cached is none - Schedule the task
-    if cached is None:
-        logger.debug("CACHE MISS")
+@shared_task(bind=True)
+def _crossdiffdict(self, model, left_identity, right_identity, left_time,
+                   right_time, keys, aliases=None):
+    """Asynchronous task for diffing two objects of a model.
+
+    :param model: Name of the model
+    :type model: str
+    :param left_identity: Id of the object on the left side
+    :type left_identity: str
+    :param right_identity: Id of the object on the right side
+    :type right_identity: str
+    :param left_time: Milliseconds since epoch on left side
+    :type left_time: int
+    :param right_time: Milliseconds since epoch on right side
+    :type right_time: int
+    :param keys: Model -> property overriding default natural keys
+    :type keys: dict
+    :param aliases: Model -> natural key on the right -> natural key on
+        the left
+    :type aliases: dict|None
+    :returns: Number of nodes in the diff
+    :rtype: int
+    """
+    key = _crossdiff_cache_key(
+        model,
+        left_identity,
+        right_identity,
+        left_time,
+        right_time,
+        keys,
+        aliases
+    )
+
+    # Publish partial results so readers can show them early.
+    def publish(partial):
+        _store_diff(key, partial)
+
+    with _Lease(key, self.request.id):
         try:
-            # Set the key to prevent multiple same jobs.
-            cache.set(key, STATUS_RUNNING, TIMEOUT)
+            d = CrossDiff(
+                model,
+                left_identity,
+                right_identity,
+                left_time,
+                right_time,
+                keys=keys,
+                aliases=aliases,
+                progress=publish
+            )
+            r = d.result()
+            _store_diff(key, r)
+            return r.diffdict['nodecount']
+        except Exception:
+            logger.exception('Unable to complete diff.')
+            cache.set(key, STATUS_ERROR, ERROR_TIMEOUT)
+            raise
 
-            # Schedule the task
-            task = _diffdict.delay(model, identity, left_time, right_time)
 
-            # Wait an initial amount of time
-            data = task.get(timeout=2)
-            return DiffResult(data)
-        except CeleryTimeoutError:
-            logger.debug("Try looking later.")
-            raise JobRunningError()
+def crossdiff(model, left_identity, right_identity, left_time, right_time,
+              keys=None, aliases=None):
+    """Gets the diff of two objects from cache or raises an error.
 
-    # Raise error if job is still running.
-    elif cached == STATUS_RUNNING:
-        logger.debug("CACHE HIT -- STILL RUNNING")
-        raise JobRunningError()
+    :param model: Name of the model
+    :type model: str
+    :param left_identity: Id of the object on the left side
+    :type left_identity: str
+    :param right_identity: Id of the object on the right side
+    :type right_identity: str
+    :param left_time: Milliseconds since epoch on left side
+    :type left_time: int
+    :param right_time: Milliseconds since epoch on right side
+    :type right_time: int
+    :param keys: Model -> property overriding default natural keys
+    :type keys: dict|None
+    :param aliases: Model -> natural key on the right -> natural key on
+        the left it is aligned with
+    :type aliases: dict|None
+    :returns: Result of cached diff operation
+    :rtype: diff.DiffResult
+    """
+    keys = keys or {}
+    aliases = aliases or {}
+    key = _crossdiff_cache_key(
+        model,
+        left_identity,
+        right_identity,
+        left_time,
+        right_time,
+        keys,
+        aliases
+    )
+    return _cached_diff(
+        key,
+        _crossdiffdict,
+        model,
+        left_identity,
+        right_identity,
+        left_time,
+        right_time,
+        keys,
+        aliases
+    )
 
-    # Raise error if job is in error state
-    elif cached == STATUS_ERROR:
-        logger.debug('CACHE HIT -- ERROR')
-        raise JobError()
 
-    # Return diff result
-    else:
-        logger.debug("CACHE HIT")
-        return DiffResult(cached)
+def _drift_cache_key(identity, time, labels, hostnames):
+    """Compute the cache key for a drift report of an environment.
+
+    :param identity: Identity of the environment
+    :type identity: str
+    :param time: Milliseconds since epoch
+    :type time: int
+    :param labels: Labels of features compared
+    :type labels: list
+    :param hostnames: Hostnames of hosts compared
+    :type hostnames: list
+    :returns: Cache key for the report
+    :rtype: str
+    """
+    return cache_key(
+        (identity, time, sorted(labels), sorted(hostnames)),
+        {},
+        prefix='driftdict'
+    )
+
+
+@shared_task(bind=True)
+def _driftdict(self, identity, time, labels, hostnames):
+    """Asynchronous task for finding hosts drifting from the majority.
+
+    :param identity: Identity of the environment
+    :type identity: str
+    :param time: Milliseconds since epoch
+    :type time: int
+    :param labels: Labels of features to compare or empty for all
+    :type labels: list
+    :param hostnames: Hostnames of hosts to compare or empty for all
+    :type hostnames: list
+    :returns: Number of nodes in the report
+    :rtype: int
+    """
+    key = _drift_cache_key(identity, time, labels, hostnames)
+
+    # Publish partial results so readers can show them early.
+    def publish(partial):
+        _store_diff(key, partial)
+
+    with _Lease(key, self.request.id):
+        try:
+            d = Drift(
+                identity,
+                time,
+                labels=labels,
+                hostnames=hostnames,
+                progress=publish
+            )
+            r = d.result()
+            _store_diff(key, r)
+            return r.diffdict['nodecount']
+        except Exception:
+            logger.exception('Unable to complete drift.')
+            cache.set(key, STATUS_ERROR, ERROR_TIMEOUT)
+            raise
+
+
+def drift(identity, time, labels=None, hostnames=None):
+    """Gets the drift report of an environment from cache or raises an error.
+
+    :param identity: Identity of the environment
+    :type identity: str
+    :param time: Milliseconds since epoch
+    :type time: int
+    :param labels: Labels of features to compare, default all
+    :type labels: list|None
+    :param hostnames: Hostnames of hosts to compare, default all
+    :type hostnames: list|None
+    :returns: Result of cached drift operation
+    :rtype: diff.DiffResult
+    """
+    labels = sorted(labels or [])
+    hostnames = sorted(hostnames or [])
+    key = _drift_cache_key(identity, time, labels, hostnames)
+    return _cached_diff(key, _driftdict, identity, time, labels, hostnames)
+
+
+def _cardinality_cache_key():
+    """Convenience method for computing cache key for statistics.
+
+    :returns: Cache key for cardinality statistics
+    :rtype: str
+    """
+    return cache_key((), {}, prefix='cardinality')
+
+
+@shared_task
+def refresh_cardinality():
+    """Periodic task counting current records of each label.
+
+    Counts are kept per environment along with a total per label.
+
+    :returns: Statistics with time and per label counts
+    :rtype: dict
+    """
+    now = utils.milliseconds_now()
+    stats = {'time': now, 'labels': {}}
+    for label in registry.models.keys():
+        try:
+            counts = Query(label).time(now).count_by_root()
+        except Exception:
+            logger.exception('Unable to count {}.'.format(label))
+            continue
+        stats['labels'][label] = {
+            'total': sum(counts.values()),
+            'environments': counts
+        }
+    cache.set(_cardinality_cache_key(), stats, CARDINALITY_TIMEOUT)
+    return stats
+
+
+def cardinality():
+    """Get the latest cardinality statistics.
+
+    :returns: Statistics or None if not yet computed
+    :rtype: dict|None
+    """
+    return cache.get(_cardinality_cache_key())
+
+
+def schedule_cardinality():
+    """Schedule computing cardinality statistics unless already scheduled.
+
+    A flag is added only if absent so requests arriving while the
+    statistics are computed schedule the task once. The flag expires so
+    a lost task is scheduled again.
+
+    :returns: True if the task was scheduled
+    :rtype: bool
+    """
+    flag = cache_key((), {}, prefix='cardinalitylease')
+    if not cache.add(flag, True, QUEUE_TIMEOUT):
+        return False
+    refresh_cardinality.delay()
+    return True
@@ -6,6 +6,8 @@ from django.core.cache.backends.locmem import LocMemCache
 from django.test import TestCase
 
 from api.cache import cache_key
+from api.cache import compress
+from api.cache import decompress
 from api import decorators
 from api.decorators import cached_result
 from api.decorators import cls_cached_result
@@ -37,6 +39,15 @@ class TestCacheKey(TestCase):
         self.assertEquals(key, expected)
 
 
+class TestCompress(TestCase):
+    def test_round_trip(self):
+        value = {'nodes': [{'model': 'Host', 'left': {'a': 1}}] * 100}
+        data = compress(value)
+        self.assertTrue(isinstance(data, bytes))
+        self.assertLess(len(data), len(repr(value)))
+        self.assertEquals(decompress(data), value)
+
+
 class BaseCacheCase(TestCase):
     def setUp(self):
         self.locmem_cache = LocMemCache('default', {})
@@ -1,6 +1,17 @@
+import mock
+
 from django.test import TestCase
 
+from api.diff import CrossDiff
+from api.diff import Diff
+from api.diff import DiffResult
 from api.diff import Node
+from api.diff import PagedDiffResult
+from api.diff import Schema
+from api.diff import Side
+from api.diff import Throttle
+from api.diff import _compared
+from api.diff import natural_key_property
 
 
 class TestNode(TestCase):
@@ -10,16 +21,19 @@ class TestNode(TestCase):
         n = Node('someid', 'somelabel')
         self.assertFalse(n.dirty)
 
-        n.cleaned = True
-
-        n.left_props = True
+        n = Node('someid', 'somelabel')
+        n.add_property('prop', 'val', 'left')
         self.assertTrue(n.dirty)
 
-        n.left_props = False
-        n.right_props = True
+        n = Node('someid', 'somelabel')
+        n.add_property('prop', 'val', 'right')
         self.assertTrue(n.dirty)
 
-        n.right_props = False
+        n = Node('someid', 'somelabel')
+        n.add_property('prop', 'val', 'left')
+        n.add_property('prop', 'val', 'right')
+        self.assertFalse(n.dirty)
+
         n.rel_changed = True
         self.assertTrue(n.dirty)
 
@@ -28,17 +42,17 @@ class TestNode(TestCase):
         n = Node('someid', 'somelabel')
         self.assertFalse(n.cleaned)
 
-        n.left_props = {
+        n.update({
             'leftprop': 'leftval',
             'bothprop': 'bothval',
             'diffprop': 'diffval1'
-        }
+        }, 'left')
 
-        n.right_props = {
+        n.update({
             'rightprop': 'rightval',
             'bothprop': 'bothval',
             'diffprop': 'diffval2'
-        }
+        }, 'right')
 
         n.clean()
         self.assertTrue(n.cleaned)
@@ -60,24 +74,95 @@ class TestNode(TestCase):
         self.assertFalse(n.rel_changed)
 
         # Test left descendent
-        n.children = {'childmodel': {'theid': {'side': 'left'}}}
+        n.add_child(1, 'left')
         n.clean()
         self.assertTrue(n.rel_changed)
 
         # Test right descendent
-        n.cleaned = False
-        n.rel_changed = False
-        n.children = {'childmodel': {'theid': {'side': 'right'}}}
+        n = Node('someid', 'somelabel')
+        n.add_child(1, 'right')
         n.clean()
         self.assertTrue(n.rel_changed)
 
         # Test descendent on both sides
-        n.cleaned = False
-        n.rel_changed = False
-        n.children = {'childmodel': {'theid': {'side': 'both'}}}
+        n = Node('someid', 'somelabel')
+        n.add_child(1, 'left')
+        n.add_child(1, 'right')
         n.clean()
         self.assertFalse(n.rel_changed)
 
+    def test_shared_schema(self):
+        """Test nodes of a label share property names."""
+        schema = Schema('somelabel')
+        n1 = Node('id1', 'somelabel', 0, schema)
+        n2 = Node('id2', 'somelabel', 1, schema)
+        n1.update({'prop': 'val', 'other': 1}, 'left')
+        n2.update({'other': 2}, 'left')
+        self.assertEquals(n1.left, ('val', 1))
+        self.assertEquals(n2.left, (None, 2))
+        self.assertEquals(schema.names, ['prop', 'other'])
+
+    def test_shared_changes(self):
+        """Test only cleaned values without the identity are shared."""
+        schema = Schema('Host')
+        nodes = []
+        for i, host in enumerate(['h1', 'h2']):
+            n = Node(host, 'Host', i, schema)
+            n.update({'hostname_environment': host, 'kernel': '4.4'}, 'left')
+            n.update({'hostname_environment': host, 'kernel': '5.4'}, 'right')
+            n.clean()
+            nodes.append(n)
+        self.assertIs(nodes[0].left, nodes[1].left)
+        self.assertIs(nodes[0].right, nodes[1].right)
+        self.assertEquals(len(schema._values), 2)
+
+        n = Node('h3', 'Host', 2, schema)
+        n.update({'hostname_environment': 'h3'}, 'left')
+        n.update({'hostname_environment': 'h4'}, 'right')
+        n.clean()
+        self.assertEquals(len(schema._values), 2)
+
+    def test_cleaned_values(self):
+        """Test values moved to both leave empty tuples behind."""
+        n = Node('someid', 'somelabel')
+        n.update({'a': 1, 'b': 2}, 'left')
+        n.update({'a': 1, 'b': 3}, 'right')
+        n.clean()
+        self.assertEquals(n.left, (None, 2))
+        self.assertEquals(n.both, (1,))
+
+        n = Node('someid', 'somelabel')
+        n.update({'a': 1}, 'left')
+        n.update({'a': 1}, 'right')
+        n.clean()
+        self.assertIs(n.left, ())
+        self.assertIs(n.right, ())
+        self.assertEquals(n.both_props, {'a': 1})
+
+    def test_compact(self):
+        """Test relationships added apart are merged."""
+        n = Node('someid', 'somelabel')
+        n.add_child(1, 'left')
+        n.add_child(2, 'left')
+        n.add_child(1, 'right')
+        n.add_parent(3)
+        n.add_parent(4)
+        n.add_parent(3)
+        n.compact()
+        self.assertEquals(list(n.child_ids), [1, 2])
+        self.assertEquals(list(n.child_sides), [3, 1])
+        self.assertEquals(list(n.parents), [3, 4])
+
+    def test_remove_child(self):
+        """Test only children on both sides are removed."""
+        n = Node('someid', 'somelabel')
+        n.add_child(1, 'left')
+        n.add_child(2, 'left')
+        n.add_child(2, 'right')
+        self.assertFalse(n.remove_child(1))
+        self.assertTrue(n.remove_child(2))
+        self.assertEquals(list(n.child_ids), [1])
+
     def test_add_property_left(self):
         """Test adding property from the left."""
         n = Node('someid', 'somelabel')
@@ -103,3 +188,614 @@ class TestNode(TestCase):
         d = {'prop1': 'val1', 'prop2': 'val2'}
         n.update(d, 'right')
         self.assertDictEqual(d, n.right_props)
+
+    def test_split(self):
+        """Test splitting properties without cleaning."""
+        n = Node('someid', 'somelabel')
+        n.update({'same': 1, 'changed': 'a', 'gone': 'x'}, 'left')
+        n.update({'same': 1, 'changed': 'b', 'new': 'y'}, 'right')
+        left, both, right = n.split()
+        self.assertEquals(left, {'changed': 'a', 'gone': 'x'})
+        self.assertEquals(both, {'same': 1})
+        self.assertEquals(right, {'changed': 'b', 'new': 'y'})
+        self.assertFalse(n.cleaned)
+
+        n.clean()
+        self.assertEquals(n.split(), (left, both, right))
+
+    def test_differs(self):
+        """Test detecting differences without cleaning."""
+        n = Node('someid', 'somelabel')
+        n.update({'prop': 'val'}, 'left')
+        n.update({'prop': 'val'}, 'right')
+        self.assertFalse(n.differs())
+        n.add_child(1, 'left')
+        self.assertTrue(n.differs())
+        n.add_child(1, 'right')
+        self.assertFalse(n.differs())
+        n.update({'other': 'val'}, 'right')
+        self.assertTrue(n.differs())
+        self.assertFalse(n.cleaned)
+
+
+@mock.patch('api.diff.monotonic')
+class TestThrottle(TestCase):
+
+    def test_update(self, m_monotonic):
+        """Test partial results are built at most once per interval."""
+        published = []
+        throttle = Throttle(published.append, 5)
+        result = mock.Mock(side_effect=lambda: len(published))
+        for done, now in enumerate([0, 1, 4, 6, 7, 12], 1):
+            m_monotonic.return_value = now
+            throttle.update(done, 6, result)
+        self.assertEquals(published, [0, 1])
+        self.assertEquals(result.call_count, 2)
+
+    def test_no_progress(self, m_monotonic):
+        m_monotonic.return_value = 0
+        result = mock.Mock()
+        self.assertFalse(Throttle(None, 0).update(1, 2, result))
+        result.assert_not_called()
+
+
+class TestPagedDiffResult(TestCase):
+
+    def setUp(self):
+        nodes = [{'model': 'Host', 'n': i} for i in range(7)]
+        self.result = DiffResult({
+            'frame': 'frame',
+            'nodes': nodes,
+            'nodemap': {'Host': {'h{}'.format(i): i for i in range(7)}},
+            'nodecount': 7
+        })
+        self.pages = self.result.pages(3)
+        self.loaded = []
+
+        def loadpages(indexes):
+            self.loaded.append(indexes)
+            return [self.pages[i] for i in indexes]
+
+        self.paged = PagedDiffResult(self.result.header(3), loadpages)
+
+    def test_header(self):
+        """Test the header holds everything but the nodes."""
+        header = self.result.header(3)
+        self.assertNotIn('nodes', header)
+        self.assertEquals(header['pagesize'], 3)
+        self.assertEquals(header['nodecount'], 7)
+        self.assertEquals([len(p) for p in self.pages], [3, 3, 1])
+
+    def test_getnodes(self):
+        """Test only pages holding the range are loaded."""
+        self.assertEquals(
+            self.paged.getnodes(2, 3),
+            self.result.getnodes(2, 3)
+        )
+        self.assertEquals(self.loaded, [[0, 1]])
+        self.assertEquals(
+            self.paged.getnodes(5, 10),
+            self.result.getnodes(5, 10)
+        )
+        self.assertEquals(self.loaded[-1], [1, 2])
+        self.assertEquals(self.paged.getnodes(7, 10), [])
+        self.assertEquals(len(self.loaded), 2)
+
+    def test_getnode(self):
+        """Test one page is loaded to get a node."""
+        self.assertEquals(self.paged.getnode('Host', 'h4'), {
+            'model': 'Host',
+            'n': 4
+        })
+        self.assertEquals(self.loaded, [[1]])
+        self.assertIsNone(self.paged.getnode('Host', 'missing'))
+        self.assertEquals(self.paged.frame(), 'frame')
+
+
+def _record(label, node, parent_label=None, parent=None, on_left=True,
+            on_right=True, left_state=None, right_state=None,
+            in_left=None, in_right=None):
+    return {
+        'label': label,
+        'node': node,
+        'parent_label': parent_label,
+        'parent': parent,
+        'on_left': on_left,
+        'on_right': on_right,
+        'in_left': on_left if in_left is None else in_left,
+        'in_right': on_right if in_right is None else in_right,
+        'left_state': left_state,
+        'right_state': right_state
+    }
+
+
+def _edges(side):
+    """Identities of parent and child of each edge of a side."""
+    ids = [identity for _, identity, _ in side.nodes]
+    return sorted(
+        (ids[side.edges[i]], ids[side.edges[i + 1]])
+        for i in range(0, len(side.edges), 2)
+    )
+
+
+class TestDiff(TestCase):
+
+    env = {'account_number_name': 'e1'}
+
+    def host(self, name):
+        return {'hostname_environment': name}
+
+    def records(self):
+        return [
+            _record('Environment', self.env),
+            _record(
+                'Host', self.host('h1'), 'Environment', self.env,
+                left_state={'kernel': '4.4'},
+                right_state={'kernel': '4.15'}
+            ),
+            _record(
+                'Host', self.host('h2'), 'Environment', self.env,
+                on_right=False,
+                left_state={'kernel': '4.4'}
+            ),
+            _record(
+                'Host', self.host('h3'), 'Environment', self.env,
+                left_state={'kernel': '4.4'},
+                right_state={'kernel': '4.4'}
+            )
+        ]
+
+    @mock.patch('api.diff.SubtreeQuery')
+    def test_partitions(self, m_query):
+        """Test both sides are built from concurrently fetched parts."""
+        records = self.records()
+        parts = [mock.Mock(), mock.Mock()]
+        parts[0].iter_records.return_value = records[2:]
+        parts[1].iter_records.return_value = records[:2]
+        m_query.return_value.partitions.return_value = parts
+        d = Diff('Environment', 'e1', 1, 2)
+        m_query.assert_called_once_with(
+            'Environment', 'e1', 1, 2, changed_only=True
+        )
+
+        self.assertEquals(sorted(d.nodes['Host']), ['h1', 'h2'])
+        h1 = d.table[d.nodes['Host']['h1']]
+        self.assertEquals(h1.left_props, {'kernel': '4.4'})
+        self.assertEquals(h1.right_props, {'kernel': '4.15'})
+
+        frame = d.result().frame()
+        sides = {c['id']: c['side'] for c in frame['children']}
+        self.assertEquals(sides, {'h1': 'both', 'h2': 'left'})
+
+    @mock.patch('api.diff.SubtreeQuery')
+    def test_shared_ancestors(self, m_query):
+        """Test ancestors returned by several parts are fed once."""
+        env, h1 = self.env, self.host('h1')
+        parts = [mock.Mock(), mock.Mock()]
+        parts[0].iter_records.return_value = [
+            _record('Environment', env),
+            _record('Host', h1, 'Environment', env),
+            _record('Host', self.host('h2'), 'Environment', env,
+                    on_right=False),
+            _record('AptPackage', {'name_version': 'a'}, 'Host', h1,
+                    on_right=False)
+        ]
+        parts[1].iter_records.return_value = [
+            _record('Environment', env),
+            _record('Host', h1, 'Environment', env),
+            _record('Configfile', {'path_host': 'b'}, 'Host', h1,
+                    on_left=False)
+        ]
+        m_query.return_value.partitions.return_value = parts
+        Diff.workers = 1
+        self.addCleanup(setattr, Diff, 'workers', 4)
+
+        partials = []
+        d = Diff('Environment', 'e1', 1, 2, progress=partials.append)
+        self.assertEquals(
+            [c['id'] for c in partials[-1].frame()['children']],
+            ['h1', 'h2']
+        )
+
+        root = d.table[d.nodes['Environment']['e1']]
+        host = d.table[d.nodes['Host']['h1']]
+        self.assertEquals(list(host.parents), [root.id])
+        self.assertEquals(len(host.child_ids), 2)
+        self.assertEquals(
+            host.toframe(d.table)['children'],
+            [
+                {'side': 'left', 'model': 'AptPackage', 'id': 'a',
+                 'children': []},
+                {'side': 'right', 'model': 'Configfile', 'id': 'b',
+                 'children': []}
+            ]
+        )
+
+    def shared_records(self, changed_only):
+        """Records of a package removed from h1 but kept by h2."""
+        env, h1, h2 = self.env, self.host('h1'), self.host('h2')
+        package = {'name_version': 'libfoo-1'}
+        if changed_only:
+            return [
+                _record('Environment', env),
+                _record('Host', h1, 'Environment', env),
+                _record('AptPackage', package, 'Host', h1,
+                        on_right=False, in_right=True)
+            ]
+        return [
+            _record('Environment', env),
+            _record('Host', h1, 'Environment', env),
+            _record('Host', h2, 'Environment', env),
+            _record('AptPackage', package, 'Host', h1, on_right=False),
+            _record('AptPackage', package, 'Host', h2)
+        ]
+
+    def shared_diff(self, m_query, changed_only, **kwargs):
+        part = mock.Mock()
+        part.iter_records.return_value = self.shared_records(changed_only)
+        m_query.return_value.partitions.return_value = [part]
+        return Diff('Environment', 'e1', 1, 2, **kwargs)
+
+    @mock.patch('api.diff.SubtreeQuery')
+    def test_shared_node(self, m_query):
+        """Test a shared node kept by another parent is on both sides."""
+        full = self.shared_diff(m_query, False, keep_sides=True).result()
+        changed = self.shared_diff(m_query, True).result()
+        self.assertEquals(changed.diffdict, full.diffdict)
+
+        package = changed.getnode('AptPackage', 'libfoo-1')
+        self.assertEquals(package['left'], {})
+        self.assertEquals(package['both'], {'name_version': 'libfoo-1'})
+        h1 = [
+            c for c in changed.frame()['children'] if c['id'] == 'h1'
+        ][0]
+        self.assertEquals(
+            [(c['id'], c['side']) for c in h1['children']],
+            [('libfoo-1', 'left')]
+        )
+
+    @mock.patch('api.diff.SubtreeQuery')
+    def test_shared_node_fill(self, m_query):
+        """Test a side filled from a known side keeps shared nodes."""
+        full = self.shared_diff(m_query, False, keep_sides=True)
+        known = self.shared_diff(
+            m_query,
+            True,
+            left_side=full.sides['left'],
+            keep_sides=True
+        )
+        self.assertEquals(
+            sorted(n[1] for n in known.sides['right'].nodes),
+            ['e1', 'h1', 'h2', 'libfoo-1']
+        )
+        self.assertEquals(
+            sorted(known.sides['right'].nodes),
+            sorted(full.sides['right'].nodes)
+        )
+        self.assertEquals(
+            _edges(known.sides['right']),
+            _edges(full.sides['right'])
+        )
+        self.assertEquals(
+            known.result().diffdict,
+            full.result().diffdict
+        )
+
+    @mock.patch('api.diff.SubtreeQuery')
+    def test_result_order(self, m_query):
+        """Test results do not depend on the order parts are fed."""
+        results = []
+        for records in [self.records(), list(reversed(self.records()))]:
+            part = mock.Mock()
+            part.iter_records.return_value = records
+            m_query.return_value.partitions.return_value = [part]
+            results.append(Diff('Environment', 'e1', 1, 2).result())
+        self.assertEquals(results[0].diffdict, results[1].diffdict)
+
+    @mock.patch('api.diff.SubtreeQuery')
+    def test_progress(self, m_query):
+        """Test partial results are published as parts finish."""
+        records = self.records()
+        parts = [mock.Mock(), mock.Mock(), mock.Mock()]
+        parts[0].iter_records.return_value = records[:2]
+        parts[1].iter_records.return_value = records[2:3]
+        parts[2].iter_records.return_value = records[3:]
+        m_query.return_value.partitions.return_value = parts
+        Diff.workers = 1
+        self.addCleanup(setattr, Diff, 'workers', 4)
+        Diff.interval = 0
+        self.addCleanup(setattr, Diff, 'interval', 5)
+
+        partials = []
+        d = Diff('Environment', 'e1', 1, 2, progress=partials.append)
+
+        # The last part is followed by the complete result instead.
+        self.assertEquals([p.progress()['done'] for p in partials], [1, 2])
+        first = partials[0]
+        self.assertEquals(
+            first.progress(),
+            {'done': 1, 'total': 3, 'complete': False}
+        )
+        self.assertFalse(first.complete())
+        self.assertEquals(first.diffdict['nodemap']['Host'], {'h1': 1})
+        self.assertEquals(
+            [c['id'] for c in first.frame()['children']],
+            ['h1']
+        )
+        self.assertEquals(
+            [c['id'] for c in partials[1].frame()['children']],
+            ['h1', 'h2']
+        )
+        self.assertTrue(d.result().complete())
+
+    @mock.patch('api.diff.SubtreeQuery')
+    def test_progress_throttled(self, m_query):
+        """Test partial results are not built for every part."""
+        parts = [mock.Mock() for _ in self.records()]
+        for part, record in zip(parts, self.records()):
+            part.iter_records.return_value = [record]
+        m_query.return_value.partitions.return_value = parts
+
+        partials = []
+        with mock.patch.object(Diff, 'result') as m_result:
+            Diff('Environment', 'e1', 1, 2, progress=partials.append)
+        self.assertEquals(len(partials), 1)
+        m_result.assert_called_once_with()
+
+    @mock.patch('api.diff.SubtreeQuery')
+    def test_sides(self, m_query):
+        """Test a diff of known sides matches a queried diff."""
+        part = mock.Mock()
+        part.iter_records.return_value = self.records()
+        m_query.return_value.partitions.return_value = [part]
+        d = Diff('Environment', 'e1', 1, 2, keep_sides=True)
+        self.assertEquals(sorted(d.sides), ['left', 'right'])
+        left = Side.load(d.sides['left'].dump())
+        right = Side.load(d.sides['right'].dump())
+        self.assertEquals(len(left.nodes), 4)
+        self.assertEquals(len(right.nodes), 3)
+
+        m_query.reset_mock()
+        known = Diff(
+            'Environment', 'e1', 1, 2,
+            left_side=left,
+            right_side=right,
+            keep_sides=True
+        )
+        m_query.assert_not_called()
+        self.assertEquals(known.sides, {})
+        result = known.result()
+        self.assertTrue(result.complete())
+        self.assertEquals(result.frame(), d.result().frame())
+        self.assertEquals(
+            result.diffdict['nodes'],
+            d.result().diffdict['nodes']
+        )
+
+    @mock.patch('api.diff.SubtreeQuery')
+    def test_one_side_known(self, m_query):
+        """Test the missing side is copied from the known side."""
+        part = mock.Mock()
+        part.iter_records.return_value = self.records()
+        m_query.return_value.partitions.return_value = [part]
+        d = Diff('Environment', 'e1', 1, 2, keep_sides=True)
+        m_query.assert_called_with(
+            'Environment', 'e1', 1, 2, changed_only=False
+        )
+        left = d.sides['left']
+
+        # Only changed hosts and their ancestors are queried.
+        part.iter_records.return_value = self.records()[:3]
+        partials = []
+        known = Diff(
+            'Environment', 'e1', 1, 2,
+            progress=partials.append,
+            left_side=left,
+            keep_sides=True
+        )
+        m_query.assert_called_with(
+            'Environment', 'e1', 1, 2, changed_only=True
+        )
+        self.assertEquals(partials, [])
+        self.assertEquals(list(known.sides), ['right'])
+        self.assertEquals(
+            sorted(n[1] for n in known.sides['right'].nodes),
+            sorted(n[1] for n in d.sides['right'].nodes)
+        )
+        self.assertEquals(
+            known.result().diffdict['nodes'],
+            d.result().diffdict['nodes']
+        )
+        self.assertEquals(known.result().frame(), d.result().frame())
+
+
+class TestNaturalKeys(TestCase):
+
+    def test_natural_key_property(self):
+        """Test the first part of the identity is the natural key."""
+        self.assertEquals(natural_key_property('AptPackage'), 'name')
+        self.assertEquals(natural_key_property('Configfile'), 'path')
+        self.assertEquals(natural_key_property('Host'), 'hostname')
+        self.assertEquals(natural_key_property('NameServer'), 'ip')
+
+    def test_compared(self):
+        """Test properties naming ancestors are not compared."""
+        props = {
+            'path_host': '/etc/a-h1',
+            'path': '/etc/a',
+            'host': 'h1',
+            'created_at': 5,
+            'md5': 'abc'
+        }
+        self.assertEquals(
+            _compared('Configfile', props, {'h1', 'h1-e1'}),
+            {'path': '/etc/a', 'md5': 'abc'}
+        )
+        package = {'name_version': 'nginx-1.2', 'name': 'nginx',
+                   'version': '1.2'}
+        self.assertEquals(
+            _compared('AptPackage', package, {'h1'}),
+            {'name': 'nginx', 'version': '1.2'}
+        )
+
+
+class TestCrossDiff(TestCase):
+
+    def env(self, name):
+        return {
+            'account_number_name': 'a-{}'.format(name),
+            'account_number': 'a',
+            'name': name
+        }
+
+    def host(self, env, hostname):
+        return {
+            'hostname_environment': '{}-{}'.format(hostname, env),
+            'hostname': hostname,
+            'environment': 'a-{}'.format(env)
+        }
+
+    def configfile(self, hostname, path):
+        return {
+            'path_host': '{}-{}'.format(path, hostname),
+            'path': path,
+            'host': hostname
+        }
+
+    def tree(self, env, hosts):
+        """Records of a host subtree keyed by host identity."""
+        trees = {}
+        for hostname, md5s in hosts.items():
+            host = self.host(env, hostname)
+            records = [_record('Host', host)]
+            for path, md5 in md5s.items():
+                records.append(_record(
+                    'Configfile', self.configfile(hostname, path),
+                    'Host', host,
+                    left_state={'md5': md5},
+                    right_state={'md5': md5}
+                ))
+            trees[host['hostname_environment']] = records
+        return trees
+
+    def setUp(self):
+        self.envs = {
+            'a-e1': {'h1': {'/etc/a': '1', '/etc/b': '2'}},
+            'a-e2': {'h1': {'/etc/a': '3', '/etc/b': '2'}, 'h2': {}}
+        }
+        self.trees = {}
+        for identity, hosts in self.envs.items():
+            self.trees.update(self.tree(identity[2:], hosts))
+
+    def query(self, label, identity, left_time, right_time, prefix=None,
+              walk=True):
+        q = mock.Mock()
+        if label == 'Environment' and not prefix:
+            records = [_record('Environment', self.env(identity[2:]))]
+        elif label == 'Environment' and prefix == ['HAS_HOST']:
+            env = self.env(identity[2:])
+            records = [
+                _record('Host', self.host(identity[2:], h), 'Environment',
+                        env)
+                for h in self.envs[identity]
+            ]
+        elif label == 'Host':
+            records = self.trees[identity]
+        else:
+            records = []
+        q.iter_records.return_value = records
+        return q
+
+    @mock.patch('api.diff.SubtreeQuery')
+    def test_cross_diff(self, m_query):
+        """Test children are aligned by natural key across identities."""
+        m_query.side_effect = self.query
+        partials = []
+        d = CrossDiff(
+            'Environment', 'a-e1', 'a-e2', 1, 2,
+            progress=partials.append
+        )
+        self.assertEquals(len(partials), 1)
+        self.assertFalse(partials[0].complete())
+
+        result = d.result()
+        self.assertTrue(result.complete())
+        frame = result.frame()
+        self.assertEquals(frame['id'], 'a-e1 | a-e2')
+        sides = {c['id']: c['side'] for c in frame['children']}
+        self.assertEquals(sides, {'h1': 'both', 'h2': 'right'})
+        h1 = [c for c in frame['children'] if c['id'] == 'h1'][0]
+        self.assertEquals(
+            [(c['id'], c['side']) for c in h1['children']],
+            [('h1//etc/a', 'both')]
+        )
+
+        configfile = result.getnode('Configfile', 'h1//etc/a')
+        self.assertEquals(configfile['left'], {'md5': '1'})
+        self.assertEquals(configfile['right'], {'md5': '3'})
+        self.assertEquals(configfile['both'], {'path': '/etc/a'})
+        self.assertIsNone(result.getnode('Configfile', 'h1//etc/b'))
+
+        host = result.getnode('Host', 'h1')
+        self.assertEquals(host['both'], {'hostname': 'h1'})
+        root = result.getnode('Environment', 'a-e1 | a-e2')
+        self.assertEquals(root['left'], {'name': 'e1'})
+
+    def rename(self, env, hostnames):
+        """Rename hosts of an environment."""
+        hosts = self.envs[env]
+        self.envs[env] = {hostnames[h]: hosts[h] for h in hosts}
+        self.trees.update(self.tree(env[2:], self.envs[env]))
+
+    @mock.patch('api.diff.SubtreeQuery')
+    def test_different_hostnames(self, m_query):
+        """Test hosts with different hostnames are not aligned."""
+        m_query.side_effect = self.query
+        self.rename('a-e2', {'h1': 'e2h1', 'h2': 'e2h2'})
+        d = CrossDiff('Environment', 'a-e1', 'a-e2', 1, 2)
+        sides = {
+            c['id']: c['side'] for c in d.result().frame()['children']
+        }
+        self.assertEquals(sides, {
+            'h1': 'left',
+            'e2h1': 'right',
+            'e2h2': 'right'
+        })
+
+    @mock.patch('api.diff.SubtreeQuery')
+    def test_aliases(self, m_query):
+        """Test hosts with different hostnames are aligned by aliases."""
+        m_query.side_effect = self.query
+        self.rename('a-e2', {'h1': 'e2h1', 'h2': 'e2h2'})
+        d = CrossDiff(
+            'Environment', 'a-e1', 'a-e2', 1, 2,
+            aliases={'Host': {'e2h1': 'h1'}}
+        )
+        result = d.result()
+        sides = {c['id']: c['side'] for c in result.frame()['children']}
+        self.assertEquals(sides, {'h1': 'both', 'e2h2': 'right'})
+
+        host = result.getnode('Host', 'h1')
+        self.assertEquals(host['left'], {'hostname': 'h1'})
+        self.assertEquals(host['right'], {'hostname': 'e2h1'})
+        configfile = result.getnode('Configfile', 'h1//etc/a')
+        self.assertEquals(configfile['left'], {'md5': '1'})
+        self.assertEquals(configfile['right'], {'md5': '3'})
+        self.assertEquals(configfile['both'], {'path': '/etc/a'})
+
+    @mock.patch('api.diff.SubtreeQuery')
+    def test_custom_keys(self, m_query):
+        """Test natural keys can be overridden per model."""
+        m_query.side_effect = self.query
+        d = CrossDiff(
+            'Environment', 'a-e1', 'a-e2', 1, 2,
+            keys={'Host': 'hostname_environment'}
+        )
+        sides = {
+            c['id']: c['side'] for c in d.result().frame()['children']
+        }
+        self.assertEquals(sides, {
+            'h1-e1': 'left',
+            'h1-e2': 'right',
+            'h2-e2': 'right'
+        })
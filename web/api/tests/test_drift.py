@@ -0,0 +1,167 @@
+import mock
+
+from django.test import TestCase
+
+from api.drift import Drift
+from api.drift import FeatureMatrix
+
+
+class TestFeatureMatrix(TestCase):
+
+    def setUp(self):
+        self.matrix = FeatureMatrix(['h1', 'h2', 'h3', 'h4'])
+        for host in ['h1', 'h2', 'h3']:
+            self.matrix.add(host, 'AptPackage', 'nova', '1.0')
+        self.matrix.add('h4', 'AptPackage', 'nova', '2.0')
+        self.matrix.add('h2', 'AptPackage', 'vim', '8.0')
+        for host in ['h1', 'h2', 'h3', 'h4']:
+            self.matrix.add(host, 'Configfile', '/etc/a', 'x')
+
+    def test_unknown_host(self):
+        """Test rows of hosts outside the matrix are ignored."""
+        self.matrix.add('h5', 'AptPackage', 'emacs', '25')
+        self.assertNotIn(('AptPackage', 'emacs'), self.matrix.columns)
+
+    def test_baselines(self):
+        """Test majority values and outliers of each feature."""
+        baselines = list(self.matrix.baselines())
+        self.assertEquals(baselines, [
+            ('AptPackage', 'nova', '1.0', 3, 0b1000),
+            ('AptPackage', 'vim', None, 3, 0b0010)
+        ])
+
+    def test_tie(self):
+        """Test ties are broken the same way every time."""
+        m = FeatureMatrix(['h1', 'h2'])
+        m.add('h1', 'AptPackage', 'nova', '1.0')
+        m.add('h2', 'AptPackage', 'nova', '2.0')
+        (_, _, baseline, count, outliers), = m.baselines()
+        self.assertEquals(baseline, '2.0')
+        self.assertEquals(count, 1)
+        self.assertEquals(outliers, 0b01)
+
+    def test_values(self):
+        self.assertEquals(
+            self.matrix.values('AptPackage', 'nova', 3),
+            ['2.0']
+        )
+        self.assertEquals(self.matrix.values('AptPackage', 'vim', 0), [])
+
+
+def _rows(label):
+    """Fake rows of a query for each label."""
+    env = {'account_number_name': 'env'}
+    hosts = [
+        {'hostname': h, 'hostname_environment': '{}-env'.format(h)}
+        for h in ['h1', 'h2', 'h3']
+    ]
+    rows = {
+        'Host': [{'Environment': env, 'Host': h} for h in hosts],
+        'AptPackage': [
+            {'Environment': env, 'Host': h, 'AptPackage': {
+                'name': 'nova',
+                'version': '2.0' if h['hostname'] == 'h3' else '1.0'
+            }}
+            for h in hosts
+        ],
+        'Configfile': [
+            {'Environment': env, 'Host': h, 'Configfile': {
+                'path': '/etc/nova.conf',
+                'md5': 'x' if h['hostname'] == 'h1' else 'y'
+            }}
+            for h in hosts
+        ] + [
+            {'Environment': env, 'Host': hosts[2], 'Configfile': {
+                'path': '/etc/extra.conf',
+                'md5': 'z'
+            }}
+        ],
+        'PythonPackage': [
+            {
+                'Environment': env,
+                'Host': h,
+                'Virtualenv': {'path': '/openstack/venv'},
+                'PythonPackage': {'name': 'requests', 'version': '2.18'}
+            }
+            for h in hosts
+        ]
+    }
+    query = mock.Mock()
+    query.time.return_value = query
+    query.filter.return_value = query
+    query.iter_rows.side_effect = lambda: iter(rows[label])
+    return query
+
+
+@mock.patch('api.drift.Query', side_effect=_rows)
+class TestDrift(TestCase):
+
+    def test_ranked(self, m_query):
+        """Test hosts are ranked by number of drifting features."""
+        result = Drift('env', 1).result()
+        frame = result.frame()
+        self.assertEquals(
+            [(c['id'], c['score']) for c in frame['children']],
+            [('h3-env', 2), ('h1-env', 1)]
+        )
+        self.assertEquals(result.diffdict['nodecount'], 3)
+        self.assertTrue(result.complete())
+
+        node = result.getnode('Host', 'h3-env')
+        self.assertEquals(node['rank'], 1)
+        self.assertEquals(node['drift'], [
+            {
+                'label': 'AptPackage',
+                'key': 'nova',
+                'value': ['2.0'],
+                'baseline': '1.0'
+            },
+            {
+                'label': 'Configfile',
+                'key': '/etc/extra.conf',
+                'value': ['z'],
+                'baseline': None
+            }
+        ])
+
+    def test_baselines(self, m_query):
+        """Test the environment node lists baselines with outliers."""
+        result = Drift('env', 1).result()
+        env = result.getnode('Environment', 'env')
+        self.assertEquals(env['hosts'], 3)
+        self.assertEquals(
+            [(b['label'], b['key'], b['value']) for b in env['baselines']],
+            [
+                ('AptPackage', 'nova', '1.0'),
+                ('Configfile', '/etc/extra.conf', None),
+                ('Configfile', '/etc/nova.conf', 'y')
+            ]
+        )
+
+    def test_hostnames(self, m_query):
+        """Test only the requested hosts are compared."""
+        result = Drift('env', 1, hostnames=['h1', 'h2']).result()
+        self.assertEquals(result.getnode('Environment', 'env')['hosts'], 2)
+        self.assertEquals(
+            [c['id'] for c in result.frame()['children']],
+            ['h1-env']
+        )
+
+    def test_progress(self, m_query):
+        """Test a partial report is published before the last label."""
+        published = []
+        Drift(
+            'env',
+            1,
+            labels=['Configfile', 'AptPackage'],
+            progress=published.append
+        )
+        self.assertEquals(
+            [r.progress()['done'] for r in published],
+            [1]
+        )
+        first = published[0].getnode('Environment', 'env')
+        self.assertEquals(
+            set(b['label'] for b in first['baselines']),
+            {'AptPackage'}
+        )
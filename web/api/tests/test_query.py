@@ -2,9 +2,14 @@ import mock
 
 from django.test import TestCase
 
+from api.query import CypherCache
 from api.query import Query
+from api.query import cypher_cache
+from api.query import SubtreeQuery
 from api.query import TimesQuery
+from api.query import data_version
 
+from api.exceptions import InvalidCursorError
 from api.exceptions import InvalidLabelError
 from api.exceptions import InvalidPropertyError
 
@@ -167,7 +172,8 @@ class TestQuery(TestCase):
         q = Query('Environment')
         q.limit(5)
         q.limit(10)
-        self.assertTrue('LIMIT 10' in str(q))
+        self.assertTrue('LIMIT $limit' in str(q))
+        self.assertEquals(q.params['limit'], 10)
 
     def test_skip_none(self):
         """Test query where no skip has been set."""
@@ -179,7 +185,8 @@ class TestQuery(TestCase):
         q = Query('Environment')
         q.skip(5)
         q.skip(10)
-        self.assertTrue('SKIP 10' in str(q))
+        self.assertTrue('SKIP $skip' in str(q))
+        self.assertEquals(q.params['skip'], 10)
 
     def test_filter_without_label(self):
         """Test filtering using default label."""
@@ -243,42 +250,384 @@ class TestQuery(TestCase):
         """Test default arguments to page() method."""
         q = Query('Environment')
         q.page()
-
-        expected = 'SKIP 0'
-        self.assertTrue(expected in str(q))
-        expected = 'LIMIT 100'
-        self.assertTrue(expected in str(q))
+        self.assertEquals(q.params['skip'], 0)
+        self.assertEquals(q.params['limit'], 100)
 
     @mock.patch('api.query.get_connection')
     def test_page_with_page(self, m_fetch):
         """Test providing page with a page and a size."""
         q = Query('Environment')
         q.page(page=3, pagesize=500)
-        expected = "SKIP 1000"
-        self.assertTrue(expected in str(q))
-        expected = "LIMIT 500"
-        self.assertTrue(expected in str(q))
+        self.assertEquals(q.params['skip'], 1000)
+        self.assertEquals(q.params['limit'], 500)
 
     @mock.patch('api.query.get_connection')
     def test_page_with_index(self, m_fetch):
         """Test providing page an index and a size."""
         q = Query('Environment')
         q.page(index=3, pagesize=500)
-        expected = "SKIP 2"
-        self.assertTrue(expected in str(q))
-        expected = "LIMIT 500"
-        self.assertTrue(expected in str(q))
+        self.assertEquals(q.params['skip'], 2)
+        self.assertEquals(q.params['limit'], 500)
 
     @mock.patch('api.query.get_connection')
     def test_page_with_negative_index(self, m_fetch):
         """Test providing page with a negative index and a size."""
         q = Query('Environment')
         q.page(index=-10, pagesize=500)
-        expected = "SKIP 0"
+        self.assertEquals(q.params['skip'], 0)
+        self.assertEquals(q.params['limit'], 500)
+
+    @mock.patch('api.query.get_connection')
+    def test_iter_rows(self, m_connection):
+        """Test rows are streamed from a session."""
+        data = FakeRecords([
+            {'environment': {'name': 'a'}},
+            {'environment': {'name': 'b'}}
+        ])
+        m_connection.return_value = FakeConnection([data])
+        rows = Query('Environment').iter_rows()
+        self.assertEquals(next(rows), {'Environment': {'name': 'a'}})
+        self.assertEquals(list(rows), [{'Environment': {'name': 'b'}}])
+
+    stats = {
+        'time': 1,
+        'labels': {
+            'Host': {'total': 5, 'environments': {'env1': 3, 'env2': 2}}
+        }
+    }
+
+    def test_approximate_count_unfiltered(self):
+        """Test estimating an unfiltered query from statistics."""
+        self.assertEquals(Query('Host').approximate_count(self.stats), 5)
+        self.assertEquals(Query('Host').approximate_count(None), None)
+        self.assertEquals(
+            Query('Environment').approximate_count(self.stats),
+            None
+        )
+
+    def test_approximate_count_environment(self):
+        """Test estimating a query filtered by environment."""
+        q = Query('Host')
+        q.filter('account_number_name', '=', 'env1', label='Environment')
+        self.assertEquals(q.approximate_count(self.stats), 3)
+        q = Query('Host')
+        q.filter('account_number_name', '=', 'env3', label='Environment')
+        self.assertEquals(q.approximate_count(self.stats), 0)
+
+    def test_approximate_count_filtered(self):
+        """Test other filters cannot be estimated."""
+        q = Query('Host')
+        q.filter('hostname', '=', 'host1')
+        self.assertEquals(q.approximate_count(self.stats), None)
+        q = Query('Host')
+        q.filter('account_number_name', '<>', 'env1', label='Environment')
+        self.assertEquals(q.approximate_count(self.stats), None)
+
+    @mock.patch('api.query.Query._fetch')
+    def test_count_with_stats(self, m_fetch):
+        """Test count uses statistics when possible."""
+        q = Query('Host')
+        self.assertTrue(q.count_exact)
+        self.assertEquals(q.count(stats=self.stats), 5)
+        self.assertFalse(q.count_exact)
+        self.assertFalse(m_fetch.called)
+
+    @mock.patch('api.query.get_connection')
+    def test_count_by_root(self, m_connection):
+        """Test counting records per environment."""
+        data = FakeRecords([
+            {'root': 'env1', 'total': 3},
+            {'root': 'env2', 'total': 2}
+        ])
+        m_connection.return_value = FakeConnection([data])
+        q = Query('Host')
+        self.assertEquals(q.count_by_root(), {'env1': 3, 'env2': 2})
+
+    @mock.patch('api.query.Query._fetch', return_value=[])
+    def test_query_text_stable_across_pages(self, m_fetch):
+        """Test paging only changes params so neo4j can reuse plans."""
+        texts = set()
+        for page in range(1, 4):
+            q = Query('Host')
+            q.filter('hostname', '=', 'host{}'.format(page))
+            q.page(page=page, pagesize=10 * page)
+            texts.add(m_fetch.call_args[0][0])
+        self.assertEquals(len(texts), 1)
+        text = texts.pop()
+        self.assertTrue(text.endswith('SKIP $skip \nLIMIT $limit'))
+
+    def test_orderby_identity_tiebreaker(self):
+        """Test identity is appended to orderby to make it total."""
+        q = Query('Host')
+        q.orderby('kernel', 'DESC', label='Host')
+        expected = (
+            'ORDER BY host_state.kernel DESC, '
+            'host.hostname_environment ASC'
+        )
+        self.assertTrue(expected in str(q))
+
+    def test_cursor_roundtrip(self):
+        """Test a cursor seeks past the values of its record."""
+        q = Query('Host')
+        q.orderby('kernel', 'DESC', label='Host')
+        record = {
+            'Environment': {},
+            'Host': {'hostname_environment': 'host1', 'kernel': '4.4'}
+        }
+        cursor = q.cursor(record)
+        self.assertTrue(isinstance(cursor, str))
+        q.seek(cursor)
+        self.assertEquals(q.params['cursor0'], '4.4')
+        self.assertEquals(q.params['cursor1'], 'host1')
+        expected = (
+            '((host_state.kernel < $cursor0) OR '
+            '(host_state.kernel = $cursor0 AND '
+            '(host.hostname_environment > $cursor1 OR '
+            'host.hostname_environment IS NULL)))'
+        )
         self.assertTrue(expected in str(q))
-        expected = "LIMIT 500"
+
+    def test_seek_null_value(self):
+        """Test seeking from a record with a null order value."""
+        q = Query('Host')
+        q.orderby('kernel', 'ASC', label='Host')
+        record = {
+            'Environment': {},
+            'Host': {'hostname_environment': 'host1'}
+        }
+        q.seek(q.cursor(record))
+        self.assertFalse('cursor0' in q.params)
+        expected = (
+            '((host_state.kernel IS NULL AND '
+            '(host.hostname_environment > $cursor1 OR '
+            'host.hostname_environment IS NULL)))'
+        )
         self.assertTrue(expected in str(q))
 
+    def test_seek_invalid_cursor(self):
+        """Test that undecodable cursors raise InvalidCursorError."""
+        q = Query('Environment')
+        with self.assertRaises(InvalidCursorError):
+            q.seek('not a cursor')
+
+    def test_seek_mismatched_cursor(self):
+        """Test that cursors from other orderings are rejected."""
+        q = Query('Environment')
+        cursor = q.cursor({'Environment': {'account_number_name': 'a'}})
+        q.orderby('name', 'DESC')
+        with self.assertRaises(InvalidCursorError):
+            q.seek(cursor)
+
+    @mock.patch('api.query.Query._fetch')
+    def test_count_ignores_seek(self, m_fetch):
+        """Test that the count is over all records, not after cursor."""
+        m_fetch.return_value = FakeRecords([{'total': 3}])
+        q = Query('Environment')
+        q.seek(q.cursor({'Environment': {'account_number_name': 'a'}}))
+        q.count()
+        self.assertFalse('cursor0' in m_fetch.call_args[0][0])
+
+    def test_page_and_count_str(self):
+        """Test the combined count and page query."""
+        q = Query('Environment')
+        q.orderby('name', 'DESC')
+        expected = (
+            'MATCH (environment:Environment) '
+            '\nWITH environment '
+            '\nORDER BY environment.name DESC, '
+            'environment.account_number_name ASC '
+            '\nLIMIT $countcap '
+            '\nWITH collect({environment: environment}) AS rows '
+            '\nWITH size(rows) AS total, rows[$skip..$skip + $limit] AS page '
+            '\nUNWIND CASE WHEN size(page) = 0 THEN [null] ELSE page END '
+            'AS row '
+            '\nRETURN total, row'
+        )
+        self.assertEquals(q._page_and_count_str(), expected)
+
+    def test_page_and_count_str_seek(self):
+        """Test the combined query applies seek to the page only."""
+        q = Query('Environment')
+        q.seek(q.cursor({'Environment': {'account_number_name': 'a'}}))
+        query_str = q._page_and_count_str()
+        self.assertTrue(
+            query_str.startswith('MATCH (environment:Environment) \nWITH ')
+        )
+        expected = (
+            '[row IN rows WHERE (((row.environment.account_number_name > '
+            '$cursor0 OR row.environment.account_number_name IS NULL)))]'
+            '[$skip..$skip + $limit]'
+        )
+        self.assertTrue(expected in query_str)
+
+    @mock.patch('api.query.get_connection')
+    def test_page_and_count(self, m_connection):
+        """Test records and total from a single query."""
+        data = FakeRecords([
+            {'total': 2, 'row': {'environment': {'name': 'a'}}},
+            {'total': 2, 'row': {'environment': {'name': 'b'}}},
+        ])
+        m_connection.return_value = FakeConnection([data])
+        q = Query('Environment')
+        records, total = q.page_and_count(page=1, pagesize=2)
+        self.assertEquals(total, 2)
+        self.assertEquals(records, [
+            {'Environment': {'name': 'a'}},
+            {'Environment': {'name': 'b'}}
+        ])
+        self.assertEquals(q.params['skip'], 0)
+        self.assertEquals(q.params['limit'], 2)
+        self.assertEquals(q.count(), 2)
+
+    @mock.patch('api.query.get_connection')
+    def test_page_and_count_empty_page(self, m_connection):
+        """Test total is kept when the page is empty."""
+        data = FakeRecords([{'total': 3, 'row': None}])
+        m_connection.return_value = FakeConnection([data])
+        q = Query('Environment')
+        records, total = q.page_and_count(page=5, pagesize=2)
+        self.assertEquals(total, 3)
+        self.assertEquals(records, [])
+
+    @mock.patch('api.query.Query.fetch', return_value=['fetched'])
+    @mock.patch('api.query.Query.count', return_value=50)
+    @mock.patch('api.query.get_connection')
+    def test_page_and_count_cap(self, m_connection, m_count, m_fetch):
+        """Test falling back to count and fetch when the cap is reached."""
+        data = FakeRecords([{'total': 10, 'row': None}])
+        m_connection.return_value = FakeConnection([data])
+        q = Query('Environment')
+        records, total = q.page_and_count(page=7, pagesize=2, cap=10)
+        self.assertEquals(total, 50)
+        self.assertEquals(records, ['fetched'])
+
+    def test_snapshot_str(self):
+        """Test reading flattened snapshot rows."""
+        q = Query('Host').snapshots()
+        q.filter('hostname', '=', 'host1')
+        q.filter('name', '=', 'env', label='Environment')
+        q.limit(10)
+        query_str = q._snapshot_str()
+        expected = (
+            "MATCH (s:Snapshot)-[:HAS_ROW]->(row:SnapshotRow) \n"
+            "WHERE s.time <= $time < s.until AND row.label = 'Host' "
+            "AND row.`Host.hostname` = $filterval0 "
+            "AND row.`Environment.name` = $filterval1 \n"
+            "RETURN row \n"
+            "ORDER BY row.`Host.hostname_environment` ASC \n"
+            "LIMIT $limit"
+        )
+        self.assertEquals(query_str, expected)
+
+    def test_snapshot_str_seek(self):
+        """Test seeking snapshot rows by flattened properties."""
+        q = Query('Environment').snapshots()
+        q.seek(q.cursor({'Environment': {'account_number_name': 'a'}}))
+        expected = (
+            "((row.`Environment.account_number_name` > $cursor0 "
+            "OR row.`Environment.account_number_name` IS NULL))"
+        )
+        self.assertTrue(expected in q._snapshot_str())
+
+    @mock.patch('api.query.get_connection')
+    def test_snapshot_fetch(self, m_connection):
+        """Test rows are split by label when snapshots are usable."""
+        usable = FakeRecords([{'environments': 2, 'snapshots': 2}])
+        rows = FakeRecords([{'row': {
+            'label': 'Host',
+            'key': '["env", "host1"]',
+            'Environment.name': 'env',
+            'Host.hostname': 'host1',
+            'Host.kernel': '4.4'
+        }}])
+        m_connection.return_value = FakeConnection([usable, rows])
+        q = Query('Host').snapshots()
+        self.assertEquals(q.fetch(), [{
+            'Environment': {'name': 'env'},
+            'Host': {'hostname': 'host1', 'kernel': '4.4'}
+        }])
+
+    @mock.patch('api.query.get_connection')
+    def test_snapshot_not_usable(self, m_connection):
+        """Test falling back when an environment lacks a snapshot."""
+        usable = FakeRecords([{'environments': 2, 'snapshots': 1}])
+        rows = FakeRecords([{'environment': {'name': 'a'}}])
+        m_connection.return_value = FakeConnection([usable, rows])
+        q = Query('Environment').snapshots()
+        self.assertEquals(q.fetch(), [{'Environment': {'name': 'a'}}])
+        self.assertFalse(q._use_snapshot())
+
+    def test_snapshots_disabled(self):
+        """Test snapshots are not checked unless enabled."""
+        self.assertFalse(Query('Environment')._use_snapshot())
+
+    @mock.patch('api.query.get_connection')
+    def test_snapshot_page_and_count(self, m_connection):
+        """Test page and count read from snapshots separately."""
+        usable = FakeRecords([{'environments': 1, 'snapshots': 1}])
+        rows = FakeRecords([{'row': {'Environment.name': 'a'}}])
+        total = FakeRecords([{'total': 7}])
+        m_connection.return_value = FakeConnection([usable, rows, total])
+        q = Query('Environment').snapshots()
+        records, count = q.page_and_count(page=1, pagesize=1)
+        self.assertEquals(records, [{'Environment': {'name': 'a'}}])
+        self.assertEquals(count, 7)
+
+    def test_signature_ignores_params(self):
+        """Test queries differing only in params share a signature."""
+        q1 = Query('Host').time(1)
+        q1.filter('hostname', '=', 'host1')
+        q2 = Query('Host').time(2)
+        q2.filter('hostname', '=', 'host2')
+        self.assertEquals(q1.signature(), q2.signature())
+        self.assertEquals(str(q1), str(q2))
+
+    def test_signature_differs_by_structure(self):
+        """Test that filters and orders change the signature."""
+        q1 = Query('Host')
+        q1.filter('hostname', '=', 'host1')
+        q2 = Query('Host')
+        q2.filter('hostname', 'CONTAINS', 'host1')
+        self.assertNotEquals(q1.signature(), q2.signature())
+        q3 = Query('Host')
+        q3.filter('hostname', '=', 'host1')
+        q3.orderby('kernel', 'DESC')
+        self.assertNotEquals(q1.signature(), q3.signature())
+
+    def test_compiled_once_per_signature(self):
+        """Test cypher is only compiled once for a signature."""
+        cypher_cache.clear()
+        with mock.patch.object(
+            Query,
+            '_compile',
+            autospec=True,
+            return_value='cypher'
+        ) as m_compile:
+            self.assertEquals(str(Query('Environment').time(1)), 'cypher')
+            self.assertEquals(str(Query('Environment').time(2)), 'cypher')
+        self.assertEquals(m_compile.call_count, 1)
+        cypher_cache.clear()
+
+
+class TestCypherCache(TestCase):
+
+    def test_get_builds_on_miss(self):
+        cache = CypherCache()
+        build = mock.Mock(return_value='cypher')
+        self.assertEquals(cache.get(('a',), build), 'cypher')
+        self.assertEquals(cache.get(('a',), build), 'cypher')
+        self.assertEquals(build.call_count, 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = CypherCache(maxsize=2)
+        cache.get(('a',), lambda: 'a')
+        cache.get(('b',), lambda: 'b')
+        cache.get(('a',), lambda: 'a')
+        cache.get(('c',), lambda: 'c')
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get(('a',), lambda: 'rebuilt'), 'a')
+        self.assertEquals(cache.get(('b',), lambda: 'rebuilt'), 'rebuilt')
+
 
 class TestTimesQuery(TestCase):
 
@@ -299,11 +648,117 @@ class TestTimesQuery(TestCase):
 
     @mock.patch('api.query.get_connection')
     def test_fetch(self, m_connection):
-        data = [[{'t': 1}, {'t': 2}, {'t': 3}]]
+        data = [[], [{'t': 1}, {'t': 2}, {'t': 3}]]
         m_connection.return_value = FakeConnection(data)
         q = TimesQuery('Environment', 'someid')
         self.assertListEqual([1, 2, 3], q.fetch())
 
-        data = [[]]
+        data = [[], []]
         m_connection.return_value = FakeConnection(data)
         self.assertListEqual([], q.fetch())
+
+    @mock.patch('api.query.get_connection')
+    def test_fetch_timeline(self, m_connection):
+        """Test root times are read from the timeline."""
+        data = [[{'times': [3, 2, 1]}]]
+        m_connection.return_value = FakeConnection(data)
+        q = TimesQuery('Environment', 'someid')
+        self.assertListEqual([3, 2, 1], q.fetch())
+
+    @mock.patch('api.query.get_connection')
+    def test_fetch_non_root(self, m_connection):
+        """Test times of non root labels walk the graph."""
+        data = [[{'t': 2}, {'t': 1}]]
+        m_connection.return_value = FakeConnection(data)
+        q = TimesQuery('Host', 'somehost')
+        self.assertListEqual([2, 1], q.fetch())
+
+
+class TestDataVersion(TestCase):
+
+    @mock.patch('api.query.get_connection')
+    def test_data_version(self, m_connection):
+        data = [FakeRecords([{'version': 4}])]
+        m_connection.return_value = FakeConnection(data)
+        self.assertEquals(data_version('someid'), 4)
+
+
+class TestSubtreeQuery(TestCase):
+
+    def test_query_str_and_params(self):
+        q = SubtreeQuery('Host', 'h1', 20, 10)
+        query_str = str(q)
+        self.assertTrue(query_str.startswith(
+            "MATCH p = (root:Host {hostname_environment: $identity})"
+            "-[:HAS_APT_PACKAGE|HAS_CONFIG_FILE|HAS_DEVICE|HAS_INTERFACE|"
+            "HAS_MOUNT|HAS_NAMESERVER|HAS_PARTITION|HAS_PYTHON_PACKAGE|"
+            "HAS_VIRTUALENV*0..]->(n)"
+        ))
+        self.assertEquals(q.params['earliest'], 10)
+        self.assertEquals(q.params['latest'], 20)
+
+    def test_query_str_walk_cut(self):
+        """Test relationships valid at neither time are cut per hop."""
+        query_str = str(SubtreeQuery('Host', 'h1', 10, 20))
+        self.assertTrue(
+            "\nWHERE all(r IN relationships(p) WHERE r.from <= $left < r.to"
+            " OR r.from <= $right < r.to)" in query_str
+        )
+        self.assertTrue(
+            "on_left AS in_left, on_right AS in_right" in query_str
+        )
+
+    def test_query_str_leaf(self):
+        q = SubtreeQuery('Partition', 'p1', 10, 20)
+        self.assertTrue('-[*0..0]->(n)' in str(q))
+
+    def test_query_str_changed_only(self):
+        query_str = str(SubtreeQuery('Host', 'h1', 10, 20))
+        self.assertFalse('UNWIND' in query_str)
+        q = SubtreeQuery('Host', 'h1', 10, 20, changed_only=True)
+        query_str = str(q)
+        self.assertTrue(
+            "WHERE NOT (on_left AND on_right)"
+            "\n    OR any(hs IN [(n)-[s:HAS_STATE]->() | s]"
+            " WHERE $earliest < hs.from <= $latest"
+            " OR $earliest < hs.to <= $latest)" in query_str
+        )
+        self.assertTrue("UNWIND range(0, length(p)) AS i" in query_str)
+
+        # Nodes are checked against every path from the root upwards.
+        self.assertTrue(
+            "CASE WHEN on_right THEN true ELSE size([q = (n)"
+            "<-[:HAS_APT_PACKAGE|HAS_CONFIG_FILE|HAS_DEVICE|HAS_INTERFACE|"
+            "HAS_MOUNT|HAS_NAMESERVER|HAS_PARTITION|HAS_PYTHON_PACKAGE|"
+            "HAS_VIRTUALENV*0..]-(root) WHERE all(r IN relationships(q)"
+            " WHERE r.from <= $right < r.to) | 1]) > 0 END AS in_right"
+            in query_str
+        )
+        self.assertTrue(query_str.endswith(
+            "RETURN head(labels(n)) AS label, n AS node,"
+            "\n    head(labels(parent)) AS parent_label, parent,"
+            "\n    on_left, on_right, in_left, in_right,"
+            "\n    left_state, right_state"
+        ))
+        self.assertTrue(all(p.changed_only for p in q.partitions()))
+
+    def test_partitions(self):
+        parts = SubtreeQuery('Environment', 'e1', 10, 20).partitions()
+        paths = [(q.prefix, q.walk) for q in parts]
+        self.assertEquals(paths[0], ([], False))
+        self.assertTrue((['HAS_HOST'], False) in paths)
+        self.assertTrue((['HAS_HOST', 'HAS_APT_PACKAGE'], True) in paths)
+        self.assertTrue((['HAS_USERVAR'], True) in paths)
+        self.assertTrue(all(q.params['left'] == 10 for q in parts))
+        self.assertTrue(
+            "(root:Environment {account_number_name: $identity})"
+            "-[:HAS_HOST]->()-[:HAS_DEVICE]->()-[:HAS_PARTITION*0..]->(n)"
+            in [str(q).split('\n')[0][10:] for q in parts]
+        )
+
+    @mock.patch('api.query.get_connection')
+    def test_iter_records(self, m_connection):
+        data = FakeRecords([{'label': 'Host'}])
+        m_connection.return_value = FakeConnection([data])
+        q = SubtreeQuery('Host', 'h1', 10, 20)
+        self.assertEquals(list(q.iter_records()), [{'label': 'Host'}])
@@ -2,9 +2,11 @@ import logging
 
 from django.test import TestCase
 
+from api.serializers import BatchSearchSerializer
 from api.serializers import DiffNodeSerializer
 from api.serializers import DiffNodesSerializer
 from api.serializers import DiffSerializer
+from api.serializers import ExportSerializer
 from api.serializers import FilterSerializer
 from api.serializers import ModelSerializer
 from api.serializers import OrderSerializer
@@ -261,6 +263,59 @@ class TestSearchSerializer(SerializerCase):
         self.data['index'] = -1
         self.assertInvalid()
 
+    def test_cursor(self):
+        self.data['cursor'] = 'WyJhIl0='
+        self.assertValid()
+
+    def test_cursor_too_long(self):
+        self.data['cursor'] = 'c' * 4097
+        self.assertInvalid()
+
+
+class TestBatchSearchSerializer(SerializerCase):
+
+    serializer_class = BatchSearchSerializer
+
+    def setUp(self):
+        self.data = {'searches': [{'model': 'Environment'}, {'bad': 1}]}
+
+    def test_valid(self):
+        """Test items are not validated as searches by the batch."""
+        self.assertValid()
+
+    def test_missing_searches(self):
+        del self.data['searches']
+        self.assertInvalid()
+
+    def test_empty_searches(self):
+        self.data['searches'] = []
+        self.assertInvalid()
+
+    def test_too_many_searches(self):
+        self.data['searches'] = [{'model': 'Environment'}] * 21
+        self.assertInvalid()
+
+class TestExportSerializer(SerializerCase):
+
+    serializer_class = ExportSerializer
+
+    def setUp(self):
+        self.data = {
+            'model': 'Environment',
+            'format': 'csv'
+        }
+
+    def test_valid(self):
+        self.assertValid()
+
+    def test_missing_format(self):
+        del self.data['format']
+        self.assertValid()
+        self.assertEquals(self.serializer.validated_data['format'], 'ndjson')
+
+    def test_invalid_format(self):
+        self.data['format'] = 'xml'
+        self.assertInvalid()
 
 class TestTimesChangedSerializer(SerializerCase):
 
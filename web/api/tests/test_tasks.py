@@ -0,0 +1,265 @@
+import mock
+
+from celery.exceptions import TimeoutError as CeleryTimeoutError
+from django.core.cache import cache
+from django.test import TestCase
+from django.test import override_settings
+
+from api.diff import DiffResult
+from api.exceptions import JobError
+from api.exceptions import JobRunningError
+from api.tasks import PARTIAL_TIMEOUT
+from api.tasks import STATUS_ERROR
+from api.tasks import TIMEOUT
+from api.tasks import _Lease
+from api.tasks import _cached_diff
+from api.tasks import _diff_cache_key
+from api.tasks import _diffdict
+from api.tasks import _lease_key
+from api.tasks import _load_diff
+from api.tasks import _load_side
+from api.tasks import _store_diff
+
+from .test_diff import _record
+
+
+class TestStoreDiff(TestCase):
+
+    args = ('Environment', 'e1', 1, 2)
+
+    def setUp(self):
+        cache.clear()
+        self.key = _diff_cache_key(*self.args)
+
+    def result(self, complete=True, count=1200):
+        return DiffResult({
+            'frame': {'model': 'Environment', 'id': 'e1'},
+            'nodes': [{'model': 'Host', 'n': i} for i in range(count)],
+            'nodemap': {'Host': {'h{}'.format(i): i for i in range(count)}},
+            'nodecount': count,
+            'progress': {'done': 2, 'total': 2, 'complete': complete}
+        })
+
+    def test_round_trip(self):
+        """Test a stored diff reads back page by page."""
+        _store_diff(self.key, self.result())
+        data = cache.get(self.key)
+        self.assertTrue(isinstance(data, bytes))
+
+        loaded = _load_diff(self.key, data)
+        self.assertEquals(loaded.diffdict['nodecount'], 1200)
+        self.assertNotIn('nodes', loaded.diffdict)
+        self.assertEquals(loaded.frame()['id'], 'e1')
+        self.assertEquals(
+            loaded.getnodes(490, 20),
+            self.result().getnodes(490, 20)
+        )
+        self.assertEquals(loaded.getnode('Host', 'h1100')['n'], 1100)
+
+    def test_partial_generations(self):
+        """Test a partial header keeps reading its own pages."""
+        _store_diff(self.key, self.result(complete=False, count=3))
+        partial = _load_diff(self.key, cache.get(self.key))
+        _store_diff(self.key, self.result(count=5))
+        self.assertEquals(len(partial.getnodes(0, 10)), 3)
+
+    @mock.patch('api.tasks.cache')
+    def test_timeouts(self, m_cache):
+        """Test headers expire with their pages."""
+        _store_diff(self.key, self.result(complete=False))
+        self.assertEquals(m_cache.set_many.call_args[0][1], PARTIAL_TIMEOUT)
+        self.assertEquals(m_cache.set.call_args[0][2], PARTIAL_TIMEOUT)
+
+        _store_diff(self.key, self.result())
+        self.assertEquals(m_cache.set_many.call_args[0][1], TIMEOUT)
+        self.assertEquals(m_cache.set.call_args[0][2], TIMEOUT)
+
+    def test_missing_page(self):
+        """Test a complete diff missing pages is computed again."""
+        _store_diff(self.key, self.result())
+        key = self.key
+        loaded = _load_diff(key, cache.get(key))
+        cache.clear()
+        cache.set(key, b'header')
+        with self.assertRaises(JobRunningError):
+            loaded.getnodes(0, 10)
+        self.assertIsNone(cache.get(key))
+
+
+def _result(complete=True):
+    return DiffResult({
+        'frame': {'model': 'Environment', 'id': 'e1'},
+        'nodes': [],
+        'nodemap': {},
+        'nodecount': 0,
+        'progress': {'done': 1, 'total': 2, 'complete': complete}
+    })
+
+
+class TestCachedDiff(TestCase):
+
+    args = ('Environment', 'e1', 1, 2)
+
+    def setUp(self):
+        cache.clear()
+        self.key = _diff_cache_key(*self.args)
+        self.task = mock.Mock()
+        self.task.apply_async.return_value.get.side_effect = \
+            CeleryTimeoutError()
+        self.task.AsyncResult.return_value.state = 'PENDING'
+
+    def test_scheduled_once(self):
+        """Test concurrent requests schedule a job once."""
+        for _ in range(2):
+            with self.assertRaises(JobRunningError):
+                _cached_diff(self.key, self.task, *self.args)
+        self.task.apply_async.assert_called_once_with(
+            self.args,
+            task_id=cache.get(_lease_key(self.key))
+        )
+
+    def test_complete(self):
+        """Test a complete diff is served without scheduling."""
+        _store_diff(self.key, _result())
+        result = _cached_diff(self.key, self.task, *self.args)
+        self.assertTrue(result.complete())
+        self.task.apply_async.assert_not_called()
+
+    def test_failed_task(self):
+        """Test a failed task releases its claim."""
+        with self.assertRaises(JobRunningError):
+            _cached_diff(self.key, self.task, *self.args)
+        self.task.AsyncResult.return_value.state = 'FAILURE'
+        with self.assertRaises(JobError):
+            _cached_diff(self.key, self.task, *self.args)
+        self.assertIsNone(cache.get(_lease_key(self.key)))
+
+        with self.assertRaises(JobRunningError):
+            _cached_diff(self.key, self.task, *self.args)
+        self.assertEquals(self.task.apply_async.call_count, 2)
+
+    def test_task_error(self):
+        """Test the error status stored by a failed task is raised."""
+        def fail(*args, **kwargs):
+            cache.set(self.key, STATUS_ERROR)
+            return mock.DEFAULT
+        self.task.apply_async.side_effect = fail
+        self.task.apply_async.return_value.get.side_effect = None
+        with self.assertRaises(JobError):
+            _cached_diff(self.key, self.task, *self.args)
+        self.task.apply_async.return_value.get.assert_called_once_with(
+            timeout=2,
+            propagate=False
+        )
+
+    def test_abandoned_partial(self):
+        """Test a partial diff without a claim is scheduled again."""
+        _store_diff(self.key, _result(complete=False))
+        result = _cached_diff(self.key, self.task, *self.args)
+        self.assertFalse(result.complete())
+        self.assertEquals(self.task.apply_async.call_count, 1)
+
+        # The new job holds the claim so it is not scheduled again.
+        _cached_diff(self.key, self.task, *self.args)
+        self.assertEquals(self.task.apply_async.call_count, 1)
+
+
+class TestLease(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.key = _diff_cache_key('Environment', 'e1', 1, 2)
+
+    def test_held_while_running(self):
+        """Test the claim is held while running and then released."""
+        with _Lease(self.key, 't1'):
+            self.assertEquals(cache.get(_lease_key(self.key)), 't1')
+        self.assertIsNone(cache.get(_lease_key(self.key)))
+
+    def test_run_directly(self):
+        """Test tasks run outside of a worker hold no claim."""
+        with _Lease(self.key, None):
+            self.assertIsNone(cache.get(_lease_key(self.key)))
+
+    def test_lost(self):
+        """Test a claim taken over by another task is left alone."""
+        with _Lease(self.key, 't1') as lease:
+            cache.set(_lease_key(self.key), 't2')
+            self.assertFalse(lease.renew())
+        self.assertEquals(cache.get(_lease_key(self.key)), 't2')
+
+
+class TestDiffTask(TestCase):
+
+    env = {'account_number_name': 'e1'}
+
+    # Host kernels at each time
+    kernels = {1: '4.4', 2: '4.15', 3: '4.18'}
+
+    def setUp(self):
+        cache.clear()
+
+    def partitions(self, model, identity, left_time, right_time,
+                   changed_only=False):
+        host = {'hostname_environment': 'h1'}
+        part = mock.Mock()
+        part.iter_records.return_value = [
+            _record('Environment', self.env),
+            _record(
+                'Host', host, 'Environment', self.env,
+                left_state={'kernel': self.kernels[left_time]},
+                right_state={'kernel': self.kernels[right_time]}
+            )
+        ]
+        query = mock.Mock()
+        query.partitions.return_value = [part]
+        return query
+
+    @mock.patch('api.diff.SubtreeQuery', side_effect=Exception('boom'))
+    def test_error(self, m_query):
+        """Test a failed diff stores its error status and fails the task."""
+        with self.assertRaises(Exception):
+            _diffdict('Environment', 'e1', 1, 2)
+        key = _diff_cache_key('Environment', 'e1', 1, 2)
+        self.assertEquals(cache.get(key), STATUS_ERROR)
+
+    @override_settings(DIFF_CACHE_SIDES=False)
+    @mock.patch('api.diff.SubtreeQuery')
+    def test_cold_changed_only(self, m_query):
+        """Test only changes are fetched when trees are not cached."""
+        m_query.side_effect = self.partitions
+        _diffdict('Environment', 'e1', 1, 2)
+        m_query.assert_called_once_with(
+            'Environment', 'e1', 1, 2, changed_only=True
+        )
+        self.assertIsNone(_load_side('Environment', 'e1', 1))
+        self.assertIsNone(_load_side('Environment', 'e1', 2))
+
+    @mock.patch('api.diff.SubtreeQuery')
+    def test_reuse_sides(self, m_query):
+        """Test diffs reuse trees cached by diffs sharing a time."""
+        m_query.side_effect = self.partitions
+        _diffdict('Environment', 'e1', 1, 2)
+        m_query.assert_called_once_with(
+            'Environment', 'e1', 1, 2, changed_only=False
+        )
+
+        # Only changes are queried when one time is cached and the
+        # filled tree of the other time is cached too.
+        _diffdict('Environment', 'e1', 2, 3)
+        m_query.assert_called_with(
+            'Environment', 'e1', 2, 3, changed_only=True
+        )
+        self.assertIsNotNone(_load_side('Environment', 'e1', 3))
+
+        # Both times are cached so the database is not queried.
+        m_query.reset_mock()
+        _diffdict('Environment', 'e1', 1, 3)
+        m_query.assert_not_called()
+
+        args = ('Environment', 'e1', 1, 3)
+        key = _diff_cache_key(*args)
+        result = _load_diff(key, cache.get(key))
+        host = result.getnode('Host', 'h1')
+        self.assertEquals(host['left'], {'kernel': '4.4'})
+        self.assertEquals(host['right'], {'kernel': '4.18'})
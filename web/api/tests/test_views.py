@@ -1,7 +1,9 @@
+import json
 import logging
 import mock
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 
 from rest_framework import status
 from rest_framework.test import APITestCase
@@ -29,6 +31,12 @@ class BaseApiTestCase(APITestCase):
         )
         self.client.logout()
 
+        # Results are cached by data version so start each test cold.
+        cache.clear()
+        patcher = mock.patch('api.views.data_version', return_value=1)
+        self.m_data_version = patcher.start()
+        self.addCleanup(patcher.stop)
+
 
 class TestModelViewSetList(BaseApiTestCase):
 
@@ -153,9 +161,11 @@ class TestObjectViewSetSearch(BaseApiTestCase):
         resp = self.client.post('/api/objects/search/', {})
         self.assertEquals(resp.status_code, status.HTTP_400_BAD_REQUEST)
 
-    @mock.patch('api.query.Query.count', return_value=5)
-    @mock.patch('api.query.Query.page', return_value='testpage')
-    def test_resp(self, m_page, m_count):
+    @mock.patch(
+        'api.query.Query.page_and_count',
+        return_value=('testpage', 5)
+    )
+    def test_resp(self, m_page):
         self.maxDiff = None
         self.client.login(**self.credentials)
         resp = self.client.post('/api/objects/search/', self.body)
@@ -169,19 +179,271 @@ class TestObjectViewSetSearch(BaseApiTestCase):
         self.assertTrue(isinstance(data['params'], dict))
         self.assertTrue('count' in data)
         self.assertEquals(data['count'], 5)
+        self.assertTrue(data['count_exact'])
         self.assertTrue('pagesize' in data)
         self.assertEquals(data['pagesize'], 500)
         self.assertTrue('page' in data)
         self.assertEquals(data['page'], 1)
         self.assertTrue('records' in data)
         self.assertEquals(data['records'], 'testpage')
+        self.assertTrue('cursor' in data)
+        self.assertEquals(data['cursor'], None)
+
+    @mock.patch('api.query.Query.page_and_count')
+    def test_resp_full_page_cursor(self, m_page):
+        self.client.login(**self.credentials)
+        self.body['pagesize'] = 1
+        m_page.return_value = (
+            [{'Environment': {'account_number_name': 'a'}}],
+            5
+        )
+        resp = self.client.post('/api/objects/search/', self.body)
+        cursor = resp.json()['cursor']
+        self.assertTrue(isinstance(cursor, str))
+
+        self.body['cursor'] = cursor
+        resp = self.client.post('/api/objects/search/', self.body)
+        self.assertEquals(resp.status_code, status.HTTP_200_OK)
+        m_page.assert_called_with(pagesize=1, cap=10000)
+
+    @mock.patch(
+        'api.query.Query.page_and_count',
+        return_value=('testpage', 5)
+    )
+    def test_resp_cached_by_version(self, m_page):
+        self.client.login(**self.credentials)
+        self.client.post('/api/objects/search/', self.body)
+        self.client.post('/api/objects/search/', self.body)
+        self.assertEquals(m_page.call_count, 1)
+
+        # A sync bumps the version so the search runs again.
+        self.m_data_version.return_value = 2
+        self.client.post('/api/objects/search/', self.body)
+        self.assertEquals(m_page.call_count, 2)
+
+    @mock.patch(
+        'api.query.Query.page_and_count',
+        return_value=('testpage', 5)
+    )
+    def test_resp_version_of_root(self, m_page):
+        self.client.login(**self.credentials)
+        self.body['identity'] = 'someid'
+        self.client.post('/api/objects/search/', self.body)
+        self.m_data_version.assert_called_with('someid')
+
+        self.body['model'] = 'Host'
+        self.client.post('/api/objects/search/', self.body)
+        self.m_data_version.assert_called_with()
+
+    def test_invalid_cursor(self):
+        self.client.login(**self.credentials)
+        self.body['cursor'] = 'notacursor'
+        resp = self.client.post('/api/objects/search/', self.body)
+        self.assertEquals(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @mock.patch('api.views.cardinality')
+    @mock.patch('api.query.Query.page', return_value=[])
+    def test_resp_approximate_count(self, m_page, m_cardinality):
+        self.client.login(**self.credentials)
+        m_cardinality.return_value = {
+            'labels': {'Environment': {'total': 7, 'environments': {}}}
+        }
+        resp = self.client.post('/api/objects/search/', self.body)
+        data = resp.json()
+        self.assertEquals(data['count'], 7)
+        self.assertFalse(data['count_exact'])
+
+    @mock.patch('api.views.cardinality', return_value=None)
+    @mock.patch('api.query.Query.page', return_value=[])
+    @mock.patch(
+        'api.query.Query.page_and_count',
+        return_value=([], 5)
+    )
+    def test_resp_cached_by_stats_time(self, m_page_and_count, m_page,
+                                       m_cardinality):
+        self.client.login(**self.credentials)
+        resp = self.client.post('/api/objects/search/', self.body)
+        self.assertTrue(resp.json()['count_exact'])
+
+        # Statistics computed after the search was cached are used.
+        m_cardinality.return_value = {
+            'time': 1,
+            'labels': {'Environment': {'total': 7, 'environments': {}}}
+        }
+        resp = self.client.post('/api/objects/search/', self.body)
+        self.assertEquals(resp.json()['count'], 7)
+
+        # Refreshed statistics are used too.
+        m_cardinality.return_value = {
+            'time': 2,
+            'labels': {'Environment': {'total': 8, 'environments': {}}}
+        }
+        resp = self.client.post('/api/objects/search/', self.body)
+        self.assertEquals(resp.json()['count'], 8)
+
+    @mock.patch('api.views.cardinality')
+    @mock.patch(
+        'api.query.Query.page_and_count',
+        return_value=('testpage', 5)
+    )
+    def test_resp_past_time_exact_count(self, m_page, m_cardinality):
+        self.client.login(**self.credentials)
+        self.body['time'] = 1
+        resp = self.client.post('/api/objects/search/', self.body)
+        data = resp.json()
+        self.assertEquals(data['count'], 5)
+        self.assertTrue(data['count_exact'])
+        self.assertFalse(m_cardinality.called)
+
+
+class TestStatsViewSet(BaseApiTestCase):
 
+    def test_no_auth(self):
+        resp = self.client.get('/api/stats/')
+        self.assertEquals(resp.status_code, status.HTTP_403_FORBIDDEN)
+
+    @mock.patch('api.tasks.refresh_cardinality')
+    @mock.patch('api.views.cardinality', return_value=None)
+    def test_not_computed(self, m_cardinality, m_refresh):
+        self.client.login(**self.credentials)
+        resp = self.client.get('/api/stats/')
+        self.assertEquals(resp.status_code, status.HTTP_202_ACCEPTED)
+        m_refresh.delay.assert_called_once_with()
+
+        # Later requests do not schedule the task again.
+        resp = self.client.get('/api/stats/')
+        self.assertEquals(resp.status_code, status.HTTP_202_ACCEPTED)
+        m_refresh.delay.assert_called_once_with()
+
+    @mock.patch('api.views.cardinality', return_value={'time': 1})
+    def test_resp(self, m_cardinality):
+        self.client.login(**self.credentials)
+        resp = self.client.get('/api/stats/')
+        self.assertEquals(resp.status_code, status.HTTP_200_OK)
+        self.assertEquals(resp.json(), {'time': 1})
+
+
+class TestObjectViewSetBatch(BaseApiTestCase):
+
+    def setUp(self):
+        super(TestObjectViewSetBatch, self).setUp()
+        self.body = {
+            'searches': [
+                {'model': 'Environment', 'pagesize': 10},
+                {'model': 'SomeRandomModel'},
+                {'model': 'Host', 'pagesize': 10}
+            ]
+        }
+
+    def post(self):
+        return self.client.post(
+            '/api/objects/batch/',
+            self.body,
+            format='json'
+        )
+
+    def test_no_auth(self):
+        resp = self.post()
+        self.assertEquals(resp.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_empty(self):
+        self.client.login(**self.credentials)
+        self.body['searches'] = []
+        resp = self.post()
+        self.assertEquals(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_too_many(self):
+        self.client.login(**self.credentials)
+        self.body['searches'] = [{'model': 'Environment'}] * 21
+        resp = self.post()
+        self.assertEquals(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @mock.patch('api.query.Query.page_and_count')
+    def test_resp(self, m_page):
+        self.client.login(**self.credentials)
+        m_page.side_effect = [([], 1), Exception('boom')]
+        resp = self.post()
+        self.assertEquals(resp.status_code, status.HTTP_200_OK)
+        results = resp.json()['results']
+        self.assertEquals(len(results), 3)
+        statuses = [r['status'] for r in results]
+        self.assertEquals(statuses[1], status.HTTP_400_BAD_REQUEST)
+        self.assertTrue('model' in results[1]['errors'])
+
+        # Remaining searches ran in any order. One failed.
+        ran = [results[0], results[2]]
+        self.assertEquals(
+            sorted(r['status'] for r in ran),
+            [status.HTTP_200_OK, status.HTTP_500_INTERNAL_SERVER_ERROR]
+        )
+        for result, model in zip(ran, ['Environment', 'Host']):
+            if result['status'] == status.HTTP_200_OK:
+                self.assertEquals(result['result']['data']['model'], model)
+
+class TestObjectViewSetExport(BaseApiTestCase):
+
+    rows = [
+        {'Environment': {'account_number_name': 'a', 'name': 'one'}},
+        {'Environment': {'account_number_name': 'b', 'name': 'two'}}
+    ]
+
+    def setUp(self):
+        super(TestObjectViewSetExport, self).setUp()
+        self.body = {'model': 'Environment'}
+
+    def content(self, resp):
+        return b''.join(resp.streaming_content).decode('utf-8')
+
+    def test_no_auth(self):
+        resp = self.client.post('/api/objects/export/', self.body)
+        self.assertEquals(resp.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_invalid_format(self):
+        self.client.login(**self.credentials)
+        self.body['format'] = 'xml'
+        resp = self.client.post('/api/objects/export/', self.body)
+        self.assertEquals(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @mock.patch('api.query.Query.iter_rows', return_value=iter(rows))
+    def test_ndjson(self, m_rows):
+        self.client.login(**self.credentials)
+        resp = self.client.post('/api/objects/export/', self.body)
+        self.assertEquals(resp.status_code, status.HTTP_200_OK)
+        self.assertEquals(resp['Content-Type'], 'application/x-ndjson')
+        lines = self.content(resp).splitlines()
+        self.assertEquals(
+            [json.loads(line) for line in lines],
+            self.rows
+        )
+
+    @mock.patch('api.query.Query.iter_rows', return_value=iter(rows))
+    def test_csv(self, m_rows):
+        self.client.login(**self.credentials)
+        self.body['format'] = 'csv'
+        resp = self.client.post('/api/objects/export/', self.body)
+        self.assertEquals(resp['Content-Type'], 'text/csv')
+        self.assertTrue(
+            'Environment.csv' in resp['Content-Disposition']
+        )
+        lines = self.content(resp).splitlines()
+        self.assertEquals(len(lines), 3)
+        header = lines[0].split(',')
+        self.assertTrue('Environment.name' in header)
+        name_index = header.index('Environment.name')
+        self.assertEquals(lines[2].split(',')[name_index], 'two')
 
 class FakeDiffResult:
 
-    def __init__(self, find_node=True):
+    def __init__(self, find_node=True, complete=True):
         self.find_node = find_node
         self.diffdict = {'nodecount': 5, 'nodemap': 'nodemap'}
+        self._progress = {'done': 1, 'total': 2, 'complete': complete}
+
+    def progress(self):
+        return self._progress
+
+    def complete(self):
+        return self._progress['complete']
 
     def frame(self):
         return 'frame'
@@ -246,6 +508,16 @@ class TestObjectDiffViewSetNode(BaseApiTestCase):
         resp = self.client.post(self.baseurl, self.body)
         self.assertEquals(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    @mock.patch('api.query.Query.fetch', side_effect=[[1], [1]])
+    @mock.patch(
+        'api.views.objectdiff',
+        return_value=FakeDiffResult(find_node=False, complete=False)
+    )
+    def test_node_not_found_yet(self, m_diff, m_fetch):
+        self.client.login(**self.credentials)
+        resp = self.client.post(self.baseurl, self.body)
+        self.assertEquals(resp.status_code, status.HTTP_202_ACCEPTED)
+
     @mock.patch('api.query.Query.fetch', side_effect=[[1], [1]])
     @mock.patch('api.views.objectdiff', side_effect=JobError())
     def test_job_error(self, m_diff, m_fetch):
@@ -401,3 +673,159 @@ class TestObjectDiffViewSetStructure(BaseApiTestCase):
         self.assertEquals(data['nodecount'], 5)
         self.assertEquals(data['nodemap'], 'nodemap')
         self.assertEquals(data['frame'], 'frame')
+        self.assertTrue(data['progress']['complete'])
+
+    @mock.patch('api.query.Query.fetch', side_effect=[[1], [1]])
+    @mock.patch(
+        'api.views.objectdiff',
+        return_value=FakeDiffResult(complete=False)
+    )
+    def test_partial_frame(self, m_diff, m_fetch):
+        self.client.login(**self.credentials)
+        resp = self.client.post(self.baseurl, self.body)
+        self.assertEquals(resp.status_code, status.HTTP_200_OK)
+
+        data = resp.json()
+        self.assertEquals(data['frame'], 'frame')
+        self.assertEquals(
+            data['progress'],
+            {'done': 1, 'total': 2, 'complete': False}
+        )
+
+
+class TestCrossDiffViewSetStructure(BaseApiTestCase):
+
+    baseurl = '/api/crossdiffs/structure/'
+
+    def setUp(self):
+        super(TestCrossDiffViewSetStructure, self).setUp()
+        self.body = {
+            'model': 'Environment',
+            'left_identity': 'e1',
+            'right_identity': 'e2',
+            'left_time': 1,
+            'right_time': 1,
+            'keys': {'Host': 'hostname'}
+        }
+
+    def test_invalid_keys(self):
+        self.client.login(**self.credentials)
+        self.body['keys'] = {'Host': 'notaprop'}
+        resp = self.client.post(self.baseurl, self.body, format='json')
+        self.assertEquals(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_invalid_aliases(self):
+        self.client.login(**self.credentials)
+        self.body['aliases'] = {'NotAModel': {'h2': 'h1'}}
+        resp = self.client.post(self.baseurl, self.body, format='json')
+        self.assertEquals(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @mock.patch('api.query.Query.fetch', side_effect=[[1], [1]])
+    @mock.patch('api.views.crossdiff', return_value=FakeDiffResult())
+    def test_aliases(self, m_diff, m_fetch):
+        self.client.login(**self.credentials)
+        self.body['aliases'] = {'Host': {'h2': 'h1'}}
+        resp = self.client.post(self.baseurl, self.body, format='json')
+        self.assertEquals(resp.status_code, status.HTTP_200_OK)
+        m_diff.assert_called_once_with(
+            'Environment', 'e1', 'e2', 1, 1,
+            keys={'Host': 'hostname'},
+            aliases={'Host': {'h2': 'h1'}}
+        )
+
+    @mock.patch('api.query.Query.fetch', side_effect=[[1], []])
+    def test_right_not_found(self, m_fetch):
+        self.client.login(**self.credentials)
+        resp = self.client.post(self.baseurl, self.body, format='json')
+        self.assertEquals(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    @mock.patch('api.query.Query.fetch', side_effect=[[1], [1]])
+    @mock.patch('api.views.crossdiff', return_value=FakeDiffResult())
+    def test_frame(self, m_diff, m_fetch):
+        self.client.login(**self.credentials)
+        resp = self.client.post(self.baseurl, self.body, format='json')
+        self.assertEquals(resp.status_code, status.HTTP_200_OK)
+        m_diff.assert_called_once_with(
+            'Environment', 'e1', 'e2', 1, 1,
+            keys={'Host': 'hostname'},
+            aliases=None
+        )
+        data = resp.json()
+        self.assertEquals(data['frame'], 'frame')
+        self.assertEquals(data['nodecount'], 5)
+
+
+class TestCrossDiffViewSetNodes(BaseApiTestCase):
+
+    baseurl = '/api/crossdiffs/nodes/'
+
+    @mock.patch('api.query.Query.fetch', side_effect=[[1], [1]])
+    @mock.patch('api.views.crossdiff', side_effect=JobRunningError())
+    def test_job_running(self, m_diff, m_fetch):
+        self.client.login(**self.credentials)
+        resp = self.client.post(self.baseurl, {
+            'model': 'Environment',
+            'left_identity': 'e1',
+            'right_identity': 'e2',
+            'left_time': 1,
+            'right_time': 1,
+            'offset': 0,
+            'limit': 10
+        }, format='json')
+        self.assertEquals(resp.status_code, status.HTTP_202_ACCEPTED)
+
+
+class TestDriftViewSetStructure(BaseApiTestCase):
+
+    baseurl = '/api/drifts/structure/'
+
+    def setUp(self):
+        super(TestDriftViewSetStructure, self).setUp()
+        self.body = {
+            'identity': 'env',
+            'time': 1,
+            'labels': ['AptPackage'],
+            'hostnames': ['h1', 'h2']
+        }
+
+    def test_invalid_label(self):
+        self.client.login(**self.credentials)
+        self.body['labels'] = ['Host']
+        resp = self.client.post(self.baseurl, self.body, format='json')
+        self.assertEquals(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @mock.patch('api.query.Query.fetch', return_value=[])
+    def test_not_found(self, m_fetch):
+        self.client.login(**self.credentials)
+        resp = self.client.post(self.baseurl, self.body, format='json')
+        self.assertEquals(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    @mock.patch('api.query.Query.fetch', return_value=[1])
+    @mock.patch('api.views.drift', return_value=FakeDiffResult())
+    def test_frame(self, m_drift, m_fetch):
+        self.client.login(**self.credentials)
+        resp = self.client.post(self.baseurl, self.body, format='json')
+        self.assertEquals(resp.status_code, status.HTTP_200_OK)
+        m_drift.assert_called_once_with(
+            'env', 1,
+            labels=['AptPackage'],
+            hostnames=['h1', 'h2']
+        )
+        self.assertEquals(resp.json()['frame'], 'frame')
+
+
+class TestDriftViewSetNodes(BaseApiTestCase):
+
+    baseurl = '/api/drifts/nodes/'
+
+    @mock.patch('api.query.Query.fetch', return_value=[1])
+    @mock.patch('api.views.drift', side_effect=JobRunningError())
+    def test_job_running(self, m_drift, m_fetch):
+        self.client.login(**self.credentials)
+        resp = self.client.post(self.baseurl, {
+            'identity': 'env',
+            'time': 1,
+            'offset': 0,
+            'limit': 10
+        }, format='json')
+        self.assertEquals(resp.status_code, status.HTTP_202_ACCEPTED)
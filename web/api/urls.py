@@ -1,8 +1,11 @@
+from .views import CrossDiffViewSet
+from .views import DriftViewSet
 from .views import ModelViewSet
 from .views import ObjectDiffViewSet
 from .views import PathViewSet
 from .views import PropertyViewSet
 from .views import ObjectViewSet
+from .views import StatsViewSet
 from rest_framework.routers import DefaultRouter
 
 router = DefaultRouter()
@@ -11,4 +14,7 @@ router.register(r'paths', PathViewSet, base_name='paths')
 router.register(r'properties', PropertyViewSet, base_name='properties')
 router.register(r'objects', ObjectViewSet, base_name='objects')
 router.register(r'objectdiffs', ObjectDiffViewSet, base_name='objectdiffs')
+router.register(r'crossdiffs', CrossDiffViewSet, base_name='crossdiffs')
+router.register(r'drifts', DriftViewSet, base_name='drifts')
+router.register(r'stats', StatsViewSet, base_name='stats')
 urlpatterns = router.urls
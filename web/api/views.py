@@ -1,7 +1,11 @@
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
+
 from cloud_snitch.models import registry
+from django.conf import settings
 from django.http import Http404
+from django.http import StreamingHttpResponse
 from rest_framework import viewsets
 from rest_framework import status
 from rest_framework.decorators import list_route
@@ -10,24 +14,81 @@ from rest_framework.response import Response
 
 from .decorators import cls_cached_result
 
+from .export import csv_chunks
+from .export import ndjson_chunks
+
+from .exceptions import InvalidCursorError
 from .exceptions import JobError
 from .exceptions import JobRunningError
 
+from .serializers import BatchSearchSerializer
+from .serializers import CrossDiffSerializer
+from .serializers import CrossDiffNodeSerializer
+from .serializers import CrossDiffNodesSerializer
 from .serializers import DiffSerializer
 from .serializers import DiffNodeSerializer
 from .serializers import DiffNodesSerializer
+from .serializers import DriftSerializer
+from .serializers import DriftNodeSerializer
+from .serializers import DriftNodesSerializer
+from .serializers import ExportSerializer
 from .serializers import ModelSerializer
 from .serializers import PropertySerializer
 from .serializers import SearchSerializer
 from .serializers import TimesChangedSerializer
 
+from .query import data_version
 from .query import Query
 from .query import TimesQuery
 
+from .tasks import cardinality
+from .tasks import crossdiff
+from .tasks import drift
 from .tasks import objectdiff
+from .tasks import schedule_cardinality
 
 logger = logging.getLogger(__name__)
 
+# Results cached under a data version stay valid until a sync changes data
+VERSIONED_TIMEOUT = 60 * 60 * 24
+
+
+def _root_version(model, identity):
+    """Get the data version covering objects of a model.
+
+    Objects of a root model identified by identity depend only on the
+    version of that root. Anything else depends on every root.
+
+    :param model: Name of the model
+    :type model: str
+    :param identity: Optional identity of the object
+    :type identity: str
+    :returns: Data version
+    :rtype: int
+    """
+    roots = [n.label for n in registry.forest.roots]
+    if model in roots and identity is not None:
+        return data_version(identity)
+    return data_version()
+
+
+def _times_version(view, model, identity):
+    """Get the data version for cached times of an object."""
+    return _root_version(model, identity)
+
+
+def _search_version(view, vd):
+    """Get the data version for a cached search.
+
+    Searches of the present may be counted from cardinality statistics
+    so the time of the statistics is part of their version.
+    """
+    version = _root_version(vd.get('model'), vd.get('identity'))
+    if vd.get('time') is None:
+        stats = cardinality()
+        version = '{}:{}'.format(version, stats and stats.get('time'))
+    return version
+
 
 class ModelViewSet(viewsets.ViewSet):
     """Viewset around model information."""
@@ -80,7 +141,11 @@ class PropertyViewSet(viewsets.ViewSet):
 class ObjectViewSet(viewsets.ViewSet):
     """View set for searching, viewing objects."""
 
-    @cls_cached_result(prefix="times", timeout=3600)
+    @cls_cached_result(
+        prefix="times",
+        timeout=VERSIONED_TIMEOUT,
+        version=_times_version
+    )
     def _times(self, model, identity):
         """Get times a specific instance of a model has changed.
 
@@ -111,7 +176,8 @@ class ObjectViewSet(viewsets.ViewSet):
         # Find object by type and identity
         query = Query(vd.get('model')) \
             .identity(vd.get('identity')) \
-            .time(vd.get('time'))
+            .time(vd.get('time')) \
+            .snapshots(getattr(settings, 'SEARCH_SNAPSHOTS', True))
 
         records = query.fetch()
 
@@ -134,17 +200,18 @@ class ObjectViewSet(viewsets.ViewSet):
         })
         return Response(results.data)
 
-    @list_route(methods=['post'])
-    def search(self, request):
-        """Search objects by type, identity, and property filters."""
-        search = SearchSerializer(data=request.data)
-        if not search.is_valid():
-            raise ValidationError(search.errors)
+    def _search_query(self, vd):
+        """Build a query from validated search data.
 
-        vd = search.validated_data
+        :param vd: Validated data from a SearchSerializer
+        :type vd: dict
+        :returns: Query with identity, time, filters and orders applied
+        :rtype: Query
+        """
         query = Query(vd.get('model')) \
             .identity(vd.get('identity')) \
-            .time(vd.get('time'))
+            .time(vd.get('time')) \
+            .snapshots(getattr(settings, 'SEARCH_SNAPSHOTS', True))
 
         for f in vd.get('filters', []):
             query.filter(
@@ -156,30 +223,178 @@ class ObjectViewSet(viewsets.ViewSet):
 
         for o in vd.get('orders', []):
             query.orderby(o['prop'], o['direction'], label=o['model'])
-
-        count = query.count()
-
-        records = query.page(
-            page=vd['page'],
-            pagesize=vd['pagesize'],
-            index=vd.get('index')
-        )
-
-        serializer = ModelSerializer({
+        return query
+
+    @cls_cached_result(
+        prefix="search",
+        timeout=VERSIONED_TIMEOUT,
+        version=_search_version
+    )
+    def _search(self, vd):
+        """Run a search and create the result.
+
+        :param vd: Validated data from a SearchSerializer
+        :type vd: dict
+        :returns: Search result with records and counts
+        :rtype: dict
+        """
+        query = self._search_query(vd)
+
+        # A cursor replaces page and index with a keyset seek.
+        cursor = vd.get('cursor')
+        if cursor is not None:
+            try:
+                query.seek(cursor)
+            except InvalidCursorError as e:
+                raise ValidationError({'cursor': [str(e)]})
+
+        if cursor is not None:
+            page_args = {'pagesize': vd['pagesize']}
+        else:
+            page_args = {
+                'page': vd['page'],
+                'pagesize': vd['pagesize'],
+                'index': vd.get('index')
+            }
+
+        # Searches of the present may be counted from statistics.
+        # Otherwise count and page in one round trip.
+        stats = cardinality() if vd.get('time') is None else None
+        if query.approximate_count(stats) is not None:
+            count = query.count(stats=stats)
+            records = query.page(**page_args)
+        else:
+            cap = getattr(settings, 'SEARCH_COUNT_CAP', 10000)
+            records, count = query.page_and_count(cap=cap, **page_args)
+
+        next_cursor = None
+        if len(records) == vd['pagesize']:
+            next_cursor = query.cursor(records[-1])
+
+        return {
             'query': str(query),
             'data': vd,
             'params': query.params,
             'count': count,
+            'count_exact': query.count_exact,
             'pagesize': vd['pagesize'],
             'page': vd['page'],
+            'cursor': next_cursor,
             'records': records
-        })
+        }
+
+    def _batch_item(self, data):
+        """Validate and run one search of a batch.
+
+        :param data: Unvalidated search payload
+        :type data: dict
+        :returns: Dict with status and either result or errors
+        :rtype: dict
+        """
+        search = SearchSerializer(data=data)
+        if not search.is_valid():
+            return {
+                'status': status.HTTP_400_BAD_REQUEST,
+                'errors': search.errors
+            }
+        try:
+            return {
+                'status': status.HTTP_200_OK,
+                'result': self._search(search.validated_data)
+            }
+        except ValidationError as e:
+            return {
+                'status': status.HTTP_400_BAD_REQUEST,
+                'errors': e.detail
+            }
+        except Exception:
+            logger.exception('Unable to complete search in batch.')
+            return {
+                'status': status.HTTP_500_INTERNAL_SERVER_ERROR,
+                'errors': 'The search failed.'
+            }
+
+    @list_route(methods=['post'])
+    def search(self, request):
+        """Search objects by type, identity, and property filters."""
+        search = SearchSerializer(data=request.data)
+        if not search.is_valid():
+            raise ValidationError(search.errors)
+
+        serializer = ModelSerializer(self._search(search.validated_data))
+        return Response(serializer.data)
+
+    @list_route(methods=['post'])
+    def batch(self, request):
+        """Run several searches concurrently.
+
+        Results are returned in the order of the searches, each with its
+        own status and errors.
+        """
+        batch = BatchSearchSerializer(data=request.data)
+        if not batch.is_valid():
+            raise ValidationError(batch.errors)
+
+        searches = batch.validated_data['searches']
+        workers = min(
+            len(searches),
+            getattr(settings, 'SEARCH_BATCH_WORKERS', 4)
+        )
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(self._batch_item, searches))
+
+        serializer = ModelSerializer({'results': results})
+        return Response(serializer.data)
+
+    @list_route(methods=['post'])
+    def export(self, request):
+        """Stream every result of a search as ndjson or csv."""
+        export = ExportSerializer(data=request.data)
+        if not export.is_valid():
+            raise ValidationError(export.errors)
+
+        vd = export.validated_data
+        query = self._search_query(vd)
+        rows = query.iter_rows()
+
+        if vd['format'] == 'csv':
+            chunks = csv_chunks(query.return_labels, rows)
+            content_type = 'text/csv'
+        else:
+            chunks = ndjson_chunks(rows)
+            content_type = 'application/x-ndjson'
+
+        resp = StreamingHttpResponse(chunks, content_type=content_type)
+        resp['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(
+            vd['model'],
+            vd['format']
+        )
+        return resp
+
+
+class StatsViewSet(viewsets.ViewSet):
+    """Viewset around cardinality statistics."""
+
+    def list(self, request):
+        """Get counts of current records per label and environment."""
+        stats = cardinality()
+        if stats is None:
+            schedule_cardinality()
+            return Response(
+                {'status': 'Statistics are being computed. Try later.'},
+                status=status.HTTP_202_ACCEPTED
+            )
+        serializer = ModelSerializer(stats)
         return Response(serializer.data)
 
 
 class ObjectDiffViewSet(viewsets.ViewSet):
     """Viewset for diffing the same object at different points in time."""
 
+    structure_serializer = DiffSerializer
+    nodes_serializer = DiffNodesSerializer
+    node_serializer = DiffNodeSerializer
+
     def _data(self, request, serializer):
         """Serialize input from request and validate.
 
@@ -210,28 +425,48 @@ class ObjectDiffViewSet(viewsets.ViewSet):
         logger.debug("Found {} matches for time {}".format(len(records), time))
         return len(records) > 0
 
+    def _sides(self, data):
+        """Get the identity and time of each side of a diff.
+
+        :param data: Validated request data
+        :type data: dict
+        :returns: List of (identity, time) for left then right
+        :rtype: list
+        """
+        return [
+            (data.get('identity'), data.get('left_time')),
+            (data.get('identity'), data.get('right_time'))
+        ]
+
+    def _diff(self, data):
+        """Get the diff for a request.
+
+        :param data: Validated request data
+        :type data: dict
+        :returns: Result of the diff
+        :rtype: diff.DiffResult
+        """
+        return objectdiff(
+            data['model'],
+            data['identity'],
+            data['left_time'],
+            data['right_time']
+        )
+
     def _check_sides(self, data):
         """Check both sides of diff for existence.
 
         :param data: Validate request data
         :type data: dict
         """
+        (left, left_time), (right, right_time) = self._sides(data)
+
         # Find left side
-        exists = self._exists(
-            data.get('model'),
-            data.get('identity'),
-            data.get('left_time')
-        )
-        if not exists:
+        if not self._exists(data.get('model'), left, left_time):
             raise Http404("Left not found")
 
         # Find right side
-        exists = self._exists(
-            data.get('model'),
-            data.get('identity'),
-            data.get('right_time')
-        )
-        if not exists:
+        if not self._exists(data.get('model'), right, right_time):
             raise Http404("Right not found")
 
     def _job_running_response(self):
@@ -260,30 +495,28 @@ class ObjectDiffViewSet(viewsets.ViewSet):
     def node(self, request):
         """Get a specific node in the diff tree."""
         # Validate request
-        data = self._data(request, DiffNodeSerializer)
+        data = self._data(request, self.node_serializer)
 
         # Make sure both sides are kosher
         self._check_sides(data)
         try:
-            diff = objectdiff(
-                data['model'],
-                data['identity'],
-                data['left_time'],
-                data['right_time']
-            )
+            diff = self._diff(data)
+            node = diff.getnode(data['node_model'], data['node_identity'])
         except JobRunningError:
             return self._job_running_response()
         except JobError:
             return self._job_error_response()
 
-        # 404 if node not found.
-        node = diff.getnode(data['node_model'], data['node_identity'])
+        # 404 if node not found. A partial diff may not have it yet.
         if node is None:
+            if not diff.complete():
+                return self._job_running_response()
             raise Http404()
 
         results = ModelSerializer({
             'node': node,
             'nodecount': diff.diffdict['nodecount'],
+            'progress': diff.progress(),
             'data': data
         })
         return Response(results.data)
@@ -292,26 +525,23 @@ class ObjectDiffViewSet(viewsets.ViewSet):
     def nodes(self, request):
         """Get a range of nodes from the diff tree."""
         # Validate request
-        data = self._data(request, DiffNodesSerializer)
+        data = self._data(request, self.nodes_serializer)
 
         # Make sure both sides are kosher
         self._check_sides(data)
 
         try:
-            diff = objectdiff(
-                data['model'],
-                data['identity'],
-                data['left_time'],
-                data['right_time']
-            )
+            diff = self._diff(data)
+            nodes = diff.getnodes(data['offset'], data['limit'])
         except JobRunningError:
             return self._job_running_response()
         except JobError:
             return self._job_error_response()
 
         results = ModelSerializer({
-            'nodes': diff.getnodes(data['offset'], data['limit']),
+            'nodes': nodes,
             'nodecount': diff.diffdict['nodecount'],
+            'progress': diff.progress(),
             'data': data
         })
         return Response(results.data)
@@ -320,18 +550,13 @@ class ObjectDiffViewSet(viewsets.ViewSet):
     def structure(self, request):
         """Get structure of the tree."""
         # Validate the data
-        data = self._data(request, DiffSerializer)
+        data = self._data(request, self.structure_serializer)
 
         # Make sure both sides are kosher
         self._check_sides(data)
 
         try:
-            diff = objectdiff(
-                data['model'],
-                data['identity'],
-                data['left_time'],
-                data['right_time']
-            )
+            diff = self._diff(data)
         except JobRunningError:
             return self._job_running_response()
         except JobError:
@@ -342,6 +567,88 @@ class ObjectDiffViewSet(viewsets.ViewSet):
             'frame': diff.frame(),
             'nodemap': diff.diffdict['nodemap'],
             'nodecount': diff.diffdict['nodecount'],
+            'progress': diff.progress(),
             'data': data
         })
         return Response(results.data)
+
+
+class CrossDiffViewSet(ObjectDiffViewSet):
+    """Viewset for diffing two objects of a model aligned by natural keys.
+
+    Children are matched by a natural key such as package name or config
+    path instead of identities that embed the host or environment. Hosts
+    match by hostname unless aliases pair differently named hosts.
+    """
+
+    structure_serializer = CrossDiffSerializer
+    nodes_serializer = CrossDiffNodesSerializer
+    node_serializer = CrossDiffNodeSerializer
+
+    def _sides(self, data):
+        """Get the identity and time of each side of a diff.
+
+        :param data: Validated request data
+        :type data: dict
+        :returns: List of (identity, time) for left then right
+        :rtype: list
+        """
+        return [
+            (data.get('left_identity'), data.get('left_time')),
+            (data.get('right_identity'), data.get('right_time'))
+        ]
+
+    def _diff(self, data):
+        """Get the diff for a request.
+
+        :param data: Validated request data
+        :type data: dict
+        :returns: Result of the diff
+        :rtype: diff.DiffResult
+        """
+        return crossdiff(
+            data['model'],
+            data['left_identity'],
+            data['right_identity'],
+            data['left_time'],
+            data['right_time'],
+            keys=data.get('keys'),
+            aliases=data.get('aliases')
+        )
+
+
+class DriftViewSet(ObjectDiffViewSet):
+    """Viewset for ranking hosts of an environment by drift.
+
+    Hosts are compared to the majority of hosts in the environment for
+    apt packages, python packages and config files. The report is read
+    like a diff with the most drifting hosts first.
+    """
+
+    structure_serializer = DriftSerializer
+    nodes_serializer = DriftNodesSerializer
+    node_serializer = DriftNodeSerializer
+
+    def _check_sides(self, data):
+        """Check the environment exists at the time of the report.
+
+        :param data: Validated request data
+        :type data: dict
+        """
+        if not self._exists('Environment', data['identity'], data['time']):
+            raise Http404("Environment not found")
+
+    def _diff(self, data):
+        """Get the drift report for a request.
+
+        :param data: Validated request data
+        :type data: dict
+        :returns: Result of the drift
+        :rtype: diff.DiffResult
+        """
+        return drift(
+            data['identity'],
+            data['time'],
+            labels=data.get('labels'),
+            hostnames=data.get('hostnames')
+        )
@@ -0,0 +1,219 @@
+"""Benchmark memory held by a diff of a synthetic environment.
+
+Feeds a Diff with records shaped like SubtreeQuery rows for an
+environment of hosts with packages, config files and interfaces, then
+reports the build time, the memory retained by the diff and the peak
+while building it. No database is needed.
+
+Run from the web directory so the api package is importable.
+
+example:
+    python benchmarks/diff_memory.py --hosts 300 --packages 400
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(
+    0,
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+)
+
+from api.diff import Diff  # noqa E402
+
+parser = argparse.ArgumentParser(
+    description="Measure memory of a diff of a synthetic environment."
+)
+parser.add_argument(
+    '--hosts',
+    type=int,
+    default=300,
+    help="Number of hosts in the environment."
+)
+parser.add_argument(
+    '--packages',
+    type=int,
+    default=400,
+    help="Number of apt packages per host."
+)
+parser.add_argument(
+    '--configfiles',
+    type=int,
+    default=40,
+    help="Number of config files per host."
+)
+parser.add_argument(
+    '--changed',
+    type=float,
+    default=0.1,
+    help="Fraction of hosts and packages whose state changes."
+)
+
+ENV = 'acct-env'
+
+
+def _record(label, node, parent_label=None, parent=None, left_state=None,
+            right_state=None, on_left=True, on_right=True):
+    return {
+        'label': label,
+        'node': node,
+        'parent_label': parent_label,
+        'parent': parent,
+        'on_left': on_left,
+        'on_right': on_right,
+        'left_state': left_state,
+        'right_state': right_state
+    }
+
+
+def _changed(i, fraction):
+    return fraction > 0 and i % max(int(1 / fraction), 1) == 0
+
+
+def synthetic_records(args):
+    """Yield records of a synthetic environment tree.
+
+    :param args: Parsed command line arguments
+    :type args: argparse.Namespace
+    :yields: Records shaped like SubtreeQuery rows
+    :ytype: dict
+    """
+    env = {
+        'account_number_name': ENV,
+        'account_number': 'acct',
+        'name': 'env',
+        'created_at': 1
+    }
+    yield _record('Environment', env)
+
+    for h in range(args.hosts):
+        hostname = 'host{}.example.com'.format(h)
+        host = {
+            'hostname_environment': '{}-{}'.format(hostname, ENV),
+            'hostname': hostname,
+            'created_at': 1
+        }
+        host_state = {
+            'architecture': 'x86_64',
+            'bios_date': '01/01/2018',
+            'bios_version': '2.5.2',
+            'kernel': '4.4.0-{}'.format(h % 5),
+            'memtotal_mb': 257000,
+            'processor_cores': 24,
+            'processor_count': 2,
+            'processor_threads_per_core': 2,
+            'processor_vcpus': 96,
+            'python_version': '2.7.12',
+            'service_mgr': 'systemd',
+            'selinux': False,
+            'lsb_codename': 'xenial',
+            'lsb_release': '16.04'
+        }
+        right_host_state = dict(host_state)
+        if _changed(h, args.changed):
+            right_host_state['kernel'] = '4.15.0-1'
+        yield _record(
+            'Host', host, 'Environment', env,
+            left_state=host_state,
+            right_state=right_host_state
+        )
+
+        for p in range(args.packages):
+            name = 'package{}'.format(p)
+            package = {
+                'name_version': '{}-1.{}'.format(name, p % 7),
+                'name': name,
+                'version': '1.{}'.format(p % 7),
+                'created_at': 1
+            }
+            on_left = True
+            on_right = not _changed(p + h, args.changed)
+            yield _record(
+                'AptPackage', package, 'Host', host,
+                on_left=on_left,
+                on_right=on_right
+            )
+
+        for c in range(args.configfiles):
+            path = '/etc/service{}/service.conf'.format(c)
+            configfile = {
+                'path_host': '{}-{}'.format(path, host['hostname']),
+                'path': path,
+                'created_at': 1
+            }
+            state = {
+                'md5': 'd41d8cd98f00b204e9800998ecf8427{}'.format(c % 10),
+                'contents': 'option = {}\n'.format(c) * 20,
+                'is_binary': False
+            }
+            right_state = dict(state)
+            if _changed(c + h, args.changed):
+                right_state['md5'] = '0' * 32
+            yield _record(
+                'Configfile', configfile, 'Host', host,
+                left_state=state,
+                right_state=right_state
+            )
+
+        for i in range(4):
+            device = 'eth{}'.format(i)
+            interface = {
+                'device_host': '{}-{}'.format(device, host['hostname']),
+                'device': device,
+                'created_at': 1
+            }
+            state = {
+                'active': True,
+                'macaddress': '00:00:00:00:{:02x}:{:02x}'.format(h % 256, i),
+                'mtu': 1500,
+                'promisc': False,
+                'ipv4_address': '10.0.{}.{}'.format(h % 256, i)
+            }
+            yield _record(
+                'Interface', interface, 'Host', host,
+                left_state=state,
+                right_state=state
+            )
+
+
+class SyntheticDiff(Diff):
+    """Diff fed from synthetic records instead of the database."""
+
+    def __init__(self, args):
+        self.args = args
+        super(SyntheticDiff, self).__init__('Environment', ENV, 1, 2)
+
+    def feed(self):
+        for record in synthetic_records(self.args):
+            self.feedrecord(record)
+
+
+def _mb(size):
+    return size / 1024.0 / 1024.0
+
+
+def main():
+    args = parser.parse_args()
+
+    # Time without tracing since tracemalloc slows every allocation.
+    start = time.time()
+    SyntheticDiff(args)
+    elapsed = time.time() - start
+
+    tracemalloc.start()
+    diff = SyntheticDiff(args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    nodes = sum(len(nodedict) for nodedict in diff.nodes.values())
+    print("Hosts:              {}".format(args.hosts))
+    print("Nodes kept:         {}".format(nodes))
+    print("Build time:         {:.2f}s".format(elapsed))
+    print("Retained memory:    {:.1f} MB".format(_mb(current)))
+    print("Peak memory:        {:.1f} MB".format(_mb(peak)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import logging
+import threading
 import time
 
 from neo4j.v1 import GraphDatabase
@@ -6,6 +7,10 @@ from django.conf import settings
 
 logger = logging.getLogger(__name__)
 _CONNECTION = None
+_CONNECTION_LOCK = threading.Lock()
+
+# Expired connections whose drivers may still be in use by other threads
+_RETIRED = []
 
 
 class Connection:
@@ -26,6 +31,7 @@ class Connection:
             max_connection_pool_size=self.max_connection_pool_size
         )
         self.start = time.time()
+        self.retired = None
 
     def isvalid(self):
         """Check connection age
@@ -54,11 +60,29 @@ class Connection:
         self.close()
 
 
+def _close_retired():
+    """Close drivers retired long enough ago to be idle.
+
+    Sessions borrowed from a driver just before it expired keep using it,
+    so retired drivers are closed only after a grace period that no
+    request runs for.
+    """
+    grace = settings.NEO4J.get('retired_connection_grace', 60 * 60)
+    now = time.time()
+    for connection in list(_RETIRED):
+        if now - connection.retired > grace:
+            connection.close()
+            _RETIRED.remove(connection)
+
+
 def get_connection():
     global _CONNECTION
-    if _CONNECTION is None or not _CONNECTION.isvalid():
-        if _CONNECTION is not None:
-            _CONNECTION.close()
-            _CONNECTION = None
-        _CONNECTION = Connection()
-    return _CONNECTION.driver
+    # Threads running batched searches share one driver and its pool.
+    with _CONNECTION_LOCK:
+        _close_retired()
+        if _CONNECTION is None or not _CONNECTION.isvalid():
+            if _CONNECTION is not None:
+                _CONNECTION.retired = time.time()
+                _RETIRED.append(_CONNECTION)
+            _CONNECTION = Connection()
+        return _CONNECTION.driver
@@ -1,3 +1,52 @@
-from django.test import TestCase # noqa F401
+import mock
 
-# Create your tests here.
+from django.test import TestCase
+from django.test import override_settings
+
+from neo4jdriver import connection
+
+
+@mock.patch('neo4jdriver.connection.GraphDatabase')
+class TestGetConnection(TestCase):
+
+    def setUp(self):
+        connection._CONNECTION = None
+        connection._RETIRED[:] = []
+
+    def tearDown(self):
+        connection._CONNECTION = None
+        connection._RETIRED[:] = []
+
+    @mock.patch('neo4jdriver.connection.time.time', return_value=0)
+    def test_shared(self, m_time, m_db):
+        """Test the driver is created once and shared."""
+        self.assertIs(connection.get_connection(), connection.get_connection())
+        self.assertEquals(m_db.driver.call_count, 1)
+
+    @override_settings(NEO4J={
+        'max_connection_age': 15,
+        'retired_connection_grace': 5
+    })
+    @mock.patch('neo4jdriver.connection.time.time')
+    def test_expired_not_closed_in_use(self, m_time, m_db):
+        """Test an expired driver is swapped and closed only once idle."""
+        old, new = mock.Mock(), mock.Mock()
+        m_db.driver.side_effect = [old, new]
+        m_time.return_value = 0
+        self.assertIs(connection.get_connection(), old)
+
+        # Expired drivers are replaced without being closed.
+        m_time.return_value = 20
+        self.assertIs(connection.get_connection(), new)
+        old.close.assert_not_called()
+
+        m_time.return_value = 25
+        self.assertIs(connection.get_connection(), new)
+        old.close.assert_not_called()
+
+        # Closed after the grace period
+        m_time.return_value = 26
+        self.assertIs(connection.get_connection(), new)
+        old.close.assert_called_once_with()
+        new.close.assert_not_called()
+        self.assertEquals(connection._RETIRED, [])
@@ -24,6 +24,7 @@ angular.module('cloudSnitch').component('pagedtable', {
         titles: '<',
         records: '<',
         total: '<',
+        approximate: '<',
         onRowClick: '&',
         onSortChange: '&'
     }
@@ -7,6 +7,7 @@ angular.module('cloudSnitch').controller('DiffController', ['$scope', '$interval
     $scope.nodeMap = undefined;
     $scope.nodes = undefined;
     $scope.nodeCount = 0;
+    $scope.progress = undefined;
     $scope.state = 'loadingStructure';
 
     $scope.detailNode = undefined;
@@ -272,6 +273,9 @@ angular.module('cloudSnitch').controller('DiffController', ['$scope', '$interval
                 return 'Loading Structure';
             case 'loadingNodes':
                 return 'Loading Nodes';
+            case 'partial':
+                return 'Computed ' + $scope.progress.done + ' of ' +
+                    $scope.progress.total + ' parts';
             case 'done':
                 return 'Done';
             default:
@@ -329,6 +333,21 @@ angular.module('cloudSnitch').controller('DiffController', ['$scope', '$interval
                 return;
             }
 
+            // Show partial results and keep polling until complete.
+            $scope.progress = result.progress;
+            if (result.progress && !result.progress.complete) {
+                if (result.frame !== null) {
+                    $scope.state = 'partial';
+                    $scope.frame = result.frame;
+                    $scope.nodeMap = result.nodemap;
+                    $scope.nodeCount = result.nodecount;
+                    $scope.nodes = new Array($scope.nodeCount);
+                    root = undefined;
+                    render();
+                }
+                return;
+            }
+
             stopPolling();
 
             if (result.frame !== null) {
@@ -338,6 +357,7 @@ angular.module('cloudSnitch').controller('DiffController', ['$scope', '$interval
                 $scope.nodeCount = result.nodecount;
                 $scope.nodes = new Array($scope.nodeCount);
                 pollNodes = $interval(getNodes, pollInterval);
+                root = undefined;
                 render();
             } else {
                 $scope.state = 'empty'
@@ -357,6 +377,7 @@ angular.module('cloudSnitch').controller('DiffController', ['$scope', '$interval
         $scope.nodeMap = undefined;
         $scope.nodes = undefined;
         $scope.nodeCount = 0;
+        $scope.progress = undefined;
         $scope.state = 'loadingStructure';
         pollStructure = $interval(getStructure, pollInterval);
     };
@@ -69,15 +69,39 @@ angular.module('cloudSnitch').controller('ResultsController', ['$scope', 'cloudS
             sortDirection: 'asc'
         }
     }
+    // Cursors returned by the api keyed by the page they start.
+    if (!angular.isDefined($scope.f.ctx.cursors)) {
+        $scope.f.ctx.cursors = {};
+    }
     $scope.records = [];
     $scope.rows = [];
     $scope.count = 0;
+    $scope.countExact = true;
     $scope.dataPath = dataPath();
     $scope.headers = recordHeaders();
     var columns = recordColumns();
 
+    // Show an approximate count from statistics until results arrive.
+    function approximateCount() {
+        var search = $scope.paneObj.search;
+        if (search.identity || search.time ||
+            (search.filters && search.filters.length)) {
+            return;
+        }
+        cloudSnitchApi.stats().then(function(stats) {
+            var labelStats = (stats.labels || {})[search.type];
+            if ($scope.busy && labelStats) {
+                $scope.count = labelStats.total;
+                $scope.countExact = false;
+            }
+        });
+    }
+
     $scope.searchPage = function() {
         $scope.busy = true;
+        if ($scope.count == 0) {
+            approximateCount();
+        }
         var params = {
             model: $scope.paneObj.search.type,
             identity: $scope.paneObj.search.identity,
@@ -87,6 +111,12 @@ angular.module('cloudSnitch').controller('ResultsController', ['$scope', 'cloudS
             count: $scope.f.ctx.pagesize
         }
 
+        // Seek to the next page instead of skipping when possible.
+        var page = $scope.f.ctx.page;
+        if (angular.isDefined($scope.f.ctx.cursors[page])) {
+            params.cursor = $scope.f.ctx.cursors[page];
+        }
+
         if ($scope.f.ctx.sortColumnIndex >= 0) {
             var sortIndex = $scope.f.ctx.sortColumnIndex;
             params.orders = [{
@@ -100,6 +130,10 @@ angular.module('cloudSnitch').controller('ResultsController', ['$scope', 'cloudS
             $scope.records = data.records;
             $scope.rows = recordTable(data.records);
             $scope.count = data.count;
+            $scope.countExact = data.count_exact;
+            if (data.cursor) {
+                $scope.f.ctx.cursors[page + 1] = data.cursor;
+            }
             $scope.busy = false;
         }, function(resp) {
             console.log("error searching page.");
@@ -131,6 +165,7 @@ angular.module('cloudSnitch').controller('ResultsController', ['$scope', 'cloudS
 
         $scope.f.ctx.sortColumnIndex = index;
         $scope.f.ctx.sortDirection = newDirection;
+        $scope.f.ctx.cursors = {};
         $scope.searchPage();
     };
 
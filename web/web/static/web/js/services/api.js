@@ -23,11 +23,15 @@ angular.module('cloudSnitch').factory('csrfService', [function() {
     return service;
 }]);
 
-angular.module('cloudSnitch').factory('cloudSnitchApi', ['$http', '$q', 'timeService', 'csrfService', function($http, $q, timeService, csrfService) {
+angular.module('cloudSnitch').factory('cloudSnitchApi', ['$http', '$q', '$timeout', 'timeService', 'csrfService', function($http, $q, $timeout, timeService, csrfService) {
 
     var typesDeferred = $q.defer();
     var service = {};
 
+    // Searches queued during the current digest, sent as one batch.
+    var pendingSearches = [];
+    var maxBatchSize = 20;
+
     function convertTime(str) {
         var t = timeService.fromstr(str);
         t = timeService.milliseconds(t);
@@ -74,6 +78,22 @@ angular.module('cloudSnitch').factory('cloudSnitchApi', ['$http', '$q', 'timeSer
         });
     };
 
+    service.stats = function() {
+        var defer = $q.defer();
+        return $http({
+            method: 'GET',
+            url: '/api/stats/'
+        }).then(function(resp) {
+            // Success - statistics may still be computing
+            defer.resolve(resp.status == 200 ? resp.data : {});
+            return defer.promise;
+        }, function(resp) {
+            // Error
+            defer.reject(resp);
+            return defer.promise;
+        });
+    };
+
     service.times = function(model, identity, time) {
         var defer = $q.defer();
         var req = {
@@ -125,6 +145,11 @@ angular.module('cloudSnitch').factory('cloudSnitchApi', ['$http', '$q', 'timeSer
         }
         req.index = params.index;
 
+        // A cursor from a previous page takes precedence over index
+        if (angular.isDefined(params.cursor)) {
+            req.cursor = params.cursor;
+        }
+
         // Check identity
         if (angular.isDefined(params.identity) && params.identity != "") {
             req.identity = params.identity;
@@ -166,82 +191,54 @@ angular.module('cloudSnitch').factory('cloudSnitchApi', ['$http', '$q', 'timeSer
             req.orders = orders;
         }
 
-        return $http({
-            method: 'POST',
-            url: '/api/objects/search/',
-            data: req,
-            headers: makeHeaders(),
-            }).then(function(resp) {
-                defer.resolve(resp.data);
-                return defer.promise;
-            }, function(resp) {
-                // @TODO - handle errors
-                defer.reject(resp);
-                return defer.promise;
-        });
-    };
-
-    service.searchAll = function(model, identity, time, filters, sink) {
-
-        var defer = $q.defer();
-        var req = {
-            model: model,
-            page: 1,
-            pagesize: 500
-        };
-
-        if (identity !== undefined && identity != "") {
-            req.identity = identity;
+        if (pendingSearches.length == 0) {
+            $timeout(flushSearches, 0, false);
         }
-
-        if (time !== undefined) {
-            // Convert string time to timestamp
-            time = convertTime(time);
-            if (time > 0) {
-                req.time = time;
-            }
+        pendingSearches.push({req: req, defer: defer});
+        if (pendingSearches.length >= maxBatchSize) {
+            flushSearches();
         }
+        return defer.promise;
+    };
 
-        if (filters !== undefined) {
-            var apiFilters = [];
-            angular.forEach(filters, function(item) {
-                apiFilters.push({
-                    model: item.model,
-                    prop: item.property,
-                    operator: item.operator,
-                    value: item.value
-                });
-            });
-            req.filters = apiFilters;
+    /**
+     * Send queued searches to the batch endpoint.
+     *
+     * Each search promise is resolved with its own result or rejected
+     * with its own errors.
+     */
+    function flushSearches() {
+        var batch = pendingSearches;
+        pendingSearches = [];
+        if (batch.length == 0) {
+            return;
         }
 
-        function more(page) {
-            req.page = page
-            return $http({
-                method: 'POST',
-                headers: makeHeaders(),
-                url: '/api/objects/search/',
-                data: req
-            }).then(function(resp) {
-                sink(resp.data);
-                if (req.page * req.pagesize >= resp.data.count) {
-                    defer.resolve({});
-                    return defer.promise
-                }
-                else {
-                    return more(page + 1);
+        var searches = [];
+        angular.forEach(batch, function(item) {
+            searches.push(item.req);
+        });
+
+        $http({
+            method: 'POST',
+            url: '/api/objects/batch/',
+            data: {searches: searches},
+            headers: makeHeaders(),
+        }).then(function(resp) {
+            angular.forEach(resp.data.results, function(result, index) {
+                if (result.status == 200) {
+                    batch[index].defer.resolve(result.result);
+                } else {
+                    batch[index].defer.reject(result);
                 }
-            }, function(resp) {
-                // @TODO - handle errors
-                defer.reject(resp);
-                return defer.promise;
             });
-        }
-
-        return more(1);
-    };
-
-
+        }, function(resp) {
+            // @TODO - handle errors
+            angular.forEach(batch, function(item) {
+                item.defer.reject(resp);
+            });
+        });
+    }
 
     service.searchAll = function(model, identity, time, filters, sink) {
 
@@ -277,8 +274,10 @@ angular.module('cloudSnitch').factory('cloudSnitchApi', ['$http', '$q', 'timeSer
             req.filters = apiFilters;
         }
 
-        function more(page) {
-            req.page = page
+        function more(cursor) {
+            if (cursor) {
+                req.cursor = cursor;
+            }
             return $http({
                 method: 'POST',
                 headers: makeHeaders(),
@@ -286,12 +285,12 @@ angular.module('cloudSnitch').factory('cloudSnitchApi', ['$http', '$q', 'timeSer
                 data: req
             }).then(function(resp) {
                 sink(resp.data);
-                if (req.page * req.pagesize >= resp.data.count) {
+                if (!resp.data.cursor) {
                     defer.resolve({});
                     return defer.promise
                 }
                 else {
-                    return more(page + 1);
+                    return more(resp.data.cursor);
                 }
             }, function(resp) {
                 // @TODO - handle errors
@@ -300,7 +299,7 @@ angular.module('cloudSnitch').factory('cloudSnitchApi', ['$http', '$q', 'timeSer
             });
         }
 
-        return more(1);
+        return more(null);
     };
 
     service.diffStructure = function(model, identity, leftTime, rightTime) {